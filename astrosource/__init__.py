@@ -2,10 +2,15 @@ import warnings
 warnings.simplefilter('ignore')
 
 from astrosource.analyse import *
+from astrosource.calibstore import *
+from astrosource.catalogue import *
 from astrosource.comparison import *
+from astrosource.crossmatch import *
+from astrosource.cube import *
 from astrosource.detrend import *
 from astrosource.eebls import *
 from astrosource.identify import *
 from astrosource.main import *
 from astrosource.plots import *
 from astrosource.utils import *
+from astrosource.variability import *
@@ -12,39 +12,61 @@ import os
 
 import logging
 
-from astrosource.utils import photometry_files_to_array, AstrosourceException
+from astrosource.cube import build_cube, cube_stars, reference_row
+from astrosource.utils import photometry_files_to_array, used_images, AstrosourceException
 from astrosource.plots import plot_variability
+from astrosource.variability import variability_indices
 
 logger = logging.getLogger('astrosource')
 
 
-def get_total_counts(photFileArray, compFile, loopLength):
-
-    compArray = []
-    allCountsArray = []
+def get_total_counts(compData):
+    # compData holds the measurements of each comparison in each file, as taken from the photometry cube
     logger.debug("***************************************")
     logger.debug("Calculating total counts")
-    for photFile in photFileArray:
-        allCounts = 0.0
-        allCountsErr = 0.0
-        fileRaDec = SkyCoord(ra=photFile[:, 0]*degree, dec=photFile[:, 1]*degree)
-        #Array of comp measurements
-        for j in range(loopLength):
-            if compFile.size == 2 or (compFile.shape[0]== 3 and compFile.size ==3) or (compFile.shape[0]== 5 and compFile.size ==5):
-                matchCoord = SkyCoord(ra=compFile[0]*degree, dec=compFile[1]*degree)
-            else:
-                matchCoord = SkyCoord(ra=compFile[j][0]*degree, dec=compFile[j][1]*degree)
-
-            idx, d2d, d3d = matchCoord.match_to_catalog_sky(fileRaDec)
-            allCounts = add(allCounts, photFile[idx][4])
-            allCountsErr = add(allCountsErr, photFile[idx][5])
-            if (compFile.shape[0] == 5 and compFile.size == 5) or (compFile.shape[0] == 3 and compFile.size == 3):
-                break
-        allCountsArray.append([allCounts, allCountsErr])
+    # Counts and count errors of the comparisons in each file, summed in order
+    allCountsArray = compData[:,:,4:6].sum(axis=1)
     logger.debug(allCountsArray)
     return allCountsArray
 
-def find_variable_stars(targets, acceptDistance=1.0, errorReject=0.05, parentPath=None):
+def masked_stats(values, keep):
+    '''
+    Mean and standard deviation of the kept values in each row of values
+    '''
+    count = keep.sum(axis=1)
+    mean = np.where(keep, values, 0).sum(axis=1) / count
+    return mean, np.sqrt((np.where(keep, values - mean[:,None], 0)**2).sum(axis=1) / count)
+
+def clip_outliers(values, keep, sigma=4):
+    '''
+    Sigma clip each row of values
+
+    Parameters
+    ----------
+    values : numpy array
+            Array of shape (rows, measurements)
+    keep : numpy array
+            Boolean array of the same shape, True for the measurements to use
+    sigma : float
+            Measurements further than this many standard deviations from the mean of their row are rejected,
+            and the mean and standard deviation found again, until there are none left to reject
+
+    Returns
+    -------
+    keep : numpy array
+            The measurements that are left
+    '''
+    keep = keep.copy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        while True:
+            mean, stdVar = masked_stats(values, keep)
+            reject = keep & ((values > (mean + sigma*stdVar)[:,None]) | (values < (mean - sigma*stdVar)[:,None]))
+            if not reject.any():
+                return keep
+            logger.debug("Rejected {} outlying measurements".format(reject.sum()))
+            keep &= ~reject
+
+def find_variable_stars(targets, acceptDistance=1.0, errorReject=0.05, parentPath=None, cube=None):
     '''
     Find stable comparison stars for the target photometry and remove variables
 
@@ -58,6 +80,8 @@ def find_variable_stars(targets, acceptDistance=1.0, errorReject=0.05, parentPat
         reject measurements with instrumental errors larger than this (this is not total error, just the estimated error in the single measurement of the variable)
     acceptDistance : float
         Furthest distance in arcseconds for matches
+    cube : PhotometryCube
+        Photometry cube of the used images (see cube.build_cube). Built from usedImages.txt if not given.
 
     Returns
     -------
@@ -66,19 +90,12 @@ def find_variable_stars(targets, acceptDistance=1.0, errorReject=0.05, parentPat
     minimumVariableCounts = 10000  # Do not try to detect variables dimmer than this.
     minimumNoOfObs = 10 # Minimum number of observations to count as a potential variable.
 
-    # Load in list of used files
-    fileList = []
-    with open(parentPath / "usedImages.txt", "r") as f:
-        for line in f:
-            fileList.append(line.strip())
+    if cube is None:
+        # Load in list of used files
+        fileList = used_images(parentPath)
 
-    # LOAD Phot FILES INTO LIST
-    photFileArray = []
-    for file in fileList:
-        photFileArray.append(load(parentPath / file))
-
-    if not photFileArray:
-        raise AstrosourceException("No input files")
+        if not fileList:
+            raise AstrosourceException("No input files")
 
     # LOAD IN COMPARISON FILE
     preFile = genfromtxt(parentPath / 'stdComps.csv', dtype=float, delimiter=',')
@@ -86,85 +103,66 @@ def find_variable_stars(targets, acceptDistance=1.0, errorReject=0.05, parentPat
     if preFile.shape[0] != 13:
         preFile=(preFile[preFile[:, 2].argsort()])
 
-    # GET REFERENCE IMAGE
-    # Sort through and find the largest file and use that as the reference file
-    fileSizer = 0
-    logger.debug("Finding image with most stars detected")
-    for photFile in photFileArray:
-        if photFile.size > fileSizer:
-            referenceFrame = photFile
-            fileSizer = photFile.size
-
     compFile = genfromtxt(parentPath / "compsUsed.csv", dtype=float, delimiter=',')
     logger.debug("Stable Comparison Candidates below variability threshold")
     outputPhot = []
 
-    # Get total counts for each file
-    allCountsArray = get_total_counts(photFileArray, compFile, loopLength=compFile.shape[0])
+    # GET REFERENCE IMAGE
+    # The image with the most stars detected is the reference file
+    logger.debug("Finding image with most stars detected")
+    if cube is None:
+        photFileArray = [load(parentPath / file) for file in fileList]
+        referenceFrame = photFileArray[int(np.argmax([photFile.shape[0] for photFile in photFileArray]))]
+    else:
+        referenceFrame = load(parentPath / cube.files[reference_row(cube)])
 
     # Define targetlist as every star in referenceImage above a count threshold
     logger.debug("Setting up Variable Search List")
     targetFile = referenceFrame
     # Although remove stars that are below the variable countrate
-    starReject=[]
-    for q in range(targetFile.shape[0]):
-        if targetFile[q][4] < minimumVariableCounts:
-            starReject.append(q)
     logger.debug("Total number of stars in reference Frame: {}".format(targetFile.shape[0]))
-    targetFile = delete(targetFile, starReject, axis=0)
+    targetFile = targetFile[~(targetFile[:,4] < minimumVariableCounts)]
     logger.debug("Total number of stars with sufficient counts: {}".format(targetFile.shape[0]))
 
-    ## NEED TO REMOVE COMPARISON STARS FROM TARGETLIST
+    if cube is None:
+        cube = build_cube(parentPath, np.vstack([np.atleast_2d(compFile)[:,0:2], targetFile[:,0:2]]), fileList, photFileArray)
 
-    allcountscount=0
-    # For each variable calculate the variability
-    outputVariableHolder=[]
-    q=0
-    for target in targetFile:
-        q=q+1
-        logger.debug("*********************")
-        logger.debug("Processing Target {}".format(str(q)))
-        logger.debug("RA {}".format(target[0]))
-        logger.debug("DEC {}".format(target[1]))
-        varCoord = SkyCoord(target[0],(target[1]), frame='icrs', unit=degree) # Need to remove target stars from consideration
-        outputPhot=[]
-        compArray=[]
-        compList=[]
-
-        diffMagHolder=[]
-
-        allcountscount=0
-
-        for photFile in photFileArray:
-            compList=[]
-            fileRaDec = SkyCoord(ra=photFile[:,0]*degree, dec=photFile[:,1]*degree)
-            idx, d2d, d3d = varCoord.match_to_catalog_sky(fileRaDec)
-            if (less(d2d.arcsecond, acceptDistance) and ((multiply(-2.5,log10(divide(photFile[idx][4],allCountsArray[allcountscount][0])))) != inf )):
-                diffMagHolder=append(diffMagHolder,(multiply(-2.5,log10(divide(photFile[idx][4],allCountsArray[allcountscount][0])))))
-            allcountscount=add(allcountscount,1)
+    # Get total counts for each file
+    compData, _ = cube_stars(cube, compFile, parentPath)
+    allCountsArray = get_total_counts(compData)
 
-        ## REMOVE MAJOR OUTLIERS FROM CONSIDERATION
-        while True:
-            stdVar=std(diffMagHolder)
-            avgVar=average(diffMagHolder)
-            starReject=[]
-            z=0
-            for j in range(asarray(diffMagHolder).shape[0]):
-                if diffMagHolder[j] > avgVar+(4*stdVar) or diffMagHolder[j] < avgVar-(4*stdVar) :
-                    starReject.append(j)
-                    logger.debug("REJECT {}".format(diffMagHolder[j]))
-                    z=1
-            diffMagHolder=delete(diffMagHolder, starReject, axis=0)
-            if z==0:
-                break
-
-        diffmag = asarray(diffMagHolder)
-        logger.debug("Standard Deviation in mag: {}".format(std(diffmag)))
-        logger.debug("Median Magnitude: {}".format(median(diffmag)))
-        logger.debug("Number of Observations: {}".format(diffmag.shape[0]))
-
-        if (diffmag.shape[0] > minimumNoOfObs):
-            outputVariableHolder.append( [target[0],target[1],median(diffmag), std(diffmag), diffmag.shape[0]])
+    ## NEED TO REMOVE COMPARISON STARS FROM TARGETLIST
+
+    # Measurements and separation of every search star in every frame
+    targetData, targetSep = cube_stars(cube, targetFile, parentPath)
+
+    # Differential magnitude of every search star in every frame, as an array of shape (stars, frames)
+    totalCounts = asarray(allCountsArray)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        diffMag = multiply(-2.5,log10(divide(targetData[:,:,4],totalCounts[:,0:1]))).T
+        diffMagErr = 1.0857 * np.sqrt((targetData[:,:,5]/targetData[:,:,4])**2 + (totalCounts[:,1:2]/totalCounts[:,0:1])**2).T
+    measured = less(targetSep.T, acceptDistance) & (diffMag != inf)
+
+    ## REMOVE MAJOR OUTLIERS FROM CONSIDERATION
+    measured = clip_outliers(diffMag, measured)
+
+    # Keep the stars with enough observations as potential variables
+    nObs = measured.sum(axis=1)
+    variable = nObs > minimumNoOfObs
+    logger.debug("Stars with more than {} observations: {}".format(minimumNoOfObs, variable.sum()))
+    diffMag = diffMag[variable]
+    measured = measured[variable]
+    with np.errstate(invalid='ignore'):
+        _, stdVar = masked_stats(diffMag, measured)
+    medianVar = np.nanmedian(np.where(measured, diffMag, nan), axis=1)
+    # A nan measurement that was kept makes the median nan
+    medianVar[(measured & isnan(diffMag)).any(axis=1)] = nan
+
+    # Variability indices from the same measurements, in time order
+    timeOrder = np.argsort(cube.time, kind='stable')
+    indices = variability_indices(diffMag[:,timeOrder], diffMagErr[variable][:,timeOrder], measured[:,timeOrder])
+
+    outputVariableHolder = np.c_[targetFile[variable,0:2], medianVar, stdVar, nObs[variable], np.column_stack(indices)].tolist()
 
     plot_variability(outputVariableHolder, parentPath)
 
@@ -172,13 +170,10 @@ def find_variable_stars(targets, acceptDistance=1.0, errorReject=0.05, parentPat
 
     return outputVariableHolder
 
-def photometric_calculations(targets, paths, acceptDistance=5.0, errorReject=0.5, filesave=True):
-    fileCount=[]
+def photometric_calculations(targets, paths, acceptDistance=5.0, errorReject=0.5, filesave=True, cube=None):
     photometrydata = []
     sys.stdout.write('🖥 Starting photometric calculations\n')
 
-    photFileArray,fileList = photometry_files_to_array(paths['parent'])
-
     if (paths['parent'] / 'calibCompsUsed.csv').exists():
         logger.debug("Calibrated")
         compFile=genfromtxt(paths['parent'] / 'calibCompsUsed.csv', dtype=float, delimiter=',')
@@ -188,148 +183,70 @@ def photometric_calculations(targets, paths, acceptDistance=5.0, errorReject=0.5
         compFile=genfromtxt(paths['parent'] / 'compsUsed.csv', dtype=float, delimiter=',')
         calibFlag=0
 
-    # Get total counts for each file
-    if compFile.shape[0]== 5 and compFile.size ==5:
-        loopLength=1
-    else:
-        loopLength=compFile.shape[0]
-    allCountsArray = get_total_counts(photFileArray, compFile, loopLength)
-
-    allcountscount=0
+    if cube is None:
+        photFileArray,fileList = photometry_files_to_array(paths['parent'])
+        cube = build_cube(paths['parent'], np.vstack([np.atleast_2d(compFile)[:,0:2], np.atleast_2d(targets)[:,0:2]]), fileList, photFileArray)
 
-    if len(targets)== 4 and targets.size == 4:
-        loopLength=1
-    else:
-        loopLength=targets.shape[0]
+    # Get total counts for each file
+    compData, _ = cube_stars(cube, compFile, paths['parent'])
+    allCountsArray = get_total_counts(compData)
+
+    # Measurements and separation of each target in each file
+    targetData, targetSep = cube_stars(cube, targets, paths['parent'])
+
+    # Total comparison counts and their error, one row per file
+    totalCounts = asarray(allCountsArray)
+    nComps = compData.shape[1]
+    magErrEns = 1.0857 * (totalCounts[:,1]/totalCounts[:,0])
+
+    # Differential magnitudes of every target in every file at once, as arrays of shape (files, targets)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        magErrVar = 1.0857 * (targetData[:,:,5]/targetData[:,:,4])
+        distanceRej = ~less(targetSep, acceptDistance)
+        errorRej = ~distanceRej & ~(magErrVar < errorReject)
+        accepted = ~(distanceRej | errorRej)
+        diffMag = np.where(accepted, 2.5 * log10(totalCounts[:,0:1]/targetData[:,:,4]), nan)
+        magErrTotal = np.where(accepted, pow( pow(magErrVar,2) + pow(magErrEns[:,None],2),0.5), nan)
+    starErrorRejCounts = errorRej.sum(axis=0)
+    starDistanceRejCounts = distanceRej.sum(axis=0)
+
+    targetList = np.atleast_2d(targets)
     # For each variable calculate all the things
-    for q in range(loopLength):
-        starErrorRejCount=0
-        starDistanceRejCount=0
+    for q in range(targetData.shape[1]):
         logger.debug("****************************")
         logger.debug("Processing Variable {}".format(q+1))
-        if int(len(targets)) == 4 and targets.size==4:
-            logger.debug("RA {}".format(targets[0]))
-        else:
-            logger.debug("RA {}".format(targets[q][0]))
-        if int(len(targets)) == 4 and targets.size==4:
-            logger.debug("Dec {}".format(targets[1]))
-        else:
-            logger.debug("Dec {}".format(targets[q][1]))
-        if int(len(targets)) == 4 and targets.size==4:
-            varCoord = SkyCoord(targets[0],(targets[1]), frame='icrs', unit=degree) # Need to remove target stars from consideration
-        else:
-            varCoord = SkyCoord(targets[q][0],(targets[q][1]), frame='icrs', unit=degree) # Need to remove target stars from consideration
+        logger.debug("RA {}".format(targetList[q][0]))
+        logger.debug("Dec {}".format(targetList[q][1]))
 
         # Grabbing variable rows
         logger.debug("Extracting and Measuring Differential Magnitude in each Photometry File")
-        outputPhot=[] # new
-        compArray=[]
-        compList=[]
-        allcountscount=0
-        for imgs, photFile in enumerate(photFileArray):
-            sys.stdout.write('.')
-            compList=[]
-            fileRaDec = SkyCoord(ra=photFile[:,0]*degree, dec=photFile[:,1]*degree)
-            idx, d2d, _ = varCoord.match_to_catalog_sky(fileRaDec)
-            starRejected=0
-            if (less(d2d.arcsecond, acceptDistance)):
-                magErrVar = 1.0857 * (photFile[idx][5]/photFile[idx][4])
-                if magErrVar < errorReject:
-
-                    magErrEns = 1.0857 * (allCountsArray[allcountscount][1]/allCountsArray[allcountscount][0])
-                    magErrTotal = pow( pow(magErrVar,2) + pow(magErrEns,2),0.5)
-
-                    #templist is a temporary holder of the resulting file.
-                    tempList=photFile[idx,0:6]
-                    # logger.debug(f"{tempList}")
-                    googFile = Path(fileList[imgs]).name
-                    tempList = append(tempList, float(googFile.split("_")[2].replace("d",".")))
-                    tempList = append(tempList, float(googFile.split("_")[4].replace("a",".")))
-                    tempList = append(tempList, allCountsArray[allcountscount][0])
-                    tempList = append(tempList, allCountsArray[allcountscount][1])
-
-                    #Differential Magnitude
-                    tempList = append(tempList, 2.5 * log10(allCountsArray[allcountscount][0]/photFile[idx][4]))
-                    tempList = append(tempList, magErrTotal)
-                    tempList = append(tempList, photFile[idx][4])
-                    tempList = append(tempList, photFile[idx][5])
-
-                    if (compFile.shape[0]== 5 and compFile.size ==5) or (compFile.shape[0]== 3 and compFile.size ==3):
-                        loopLength=1
-                    else:
-                        loopLength=compFile.shape[0]
-                    for j in range(loopLength):
-                        if compFile.size == 2 or (compFile.shape[0]== 3 and compFile.size ==3) or (compFile.shape[0]== 5 and compFile.size ==5):
-                            matchCoord=SkyCoord(ra=compFile[0]*degree, dec=compFile[1]*degree)
-                        else:
-                            matchCoord=SkyCoord(ra=compFile[j][0]*degree, dec=compFile[j][1]*degree)
-                        idx, d2d, d3d = matchCoord.match_to_catalog_sky(fileRaDec)
-                        tempList=append(tempList, photFileArray[imgs][idx][4])
-                    # logger.debug(f"{tempList}")
-                    outputPhot.append(tempList)
-
-                    fileCount.append(allCountsArray[allcountscount][0])
-                    allcountscount=allcountscount+1
-
-                else:
-                    starErrorRejCount=starErrorRejCount+1
-                    starRejected=1
-            else:
-                starDistanceRejCount=starDistanceRejCount+1
-                starRejected=1
-            if ( starRejected == 1):
-
-                    #templist is a temporary holder of the resulting file.
-                    tempList=photFileArray[imgs][idx,:]
-                    googFile = Path(fileList[imgs]).name
-                    tempList=append(tempList, float(googFile.split("_")[2].replace("d",".")))
-                    tempList=append(tempList, float(googFile.split("_")[4].replace("a",".")))
-                    tempList=append(tempList, allCountsArray[allcountscount][0])
-                    tempList=append(tempList, allCountsArray[allcountscount][1])
-
-                    #Differential Magnitude
-                    tempList=append(tempList,nan)
-                    tempList=append(tempList,nan)
-                    tempList=append(tempList, photFileArray[imgs][idx][4])
-                    tempList=append(tempList, photFileArray[imgs][idx][5])
-
-                    if (compFile.shape[0]== 5 and compFile.size ==5) or (compFile.shape[0]== 3 and compFile.size ==3):
-                        loopLength=1
-                    else:
-                        loopLength=compFile.shape[0]
-
-                    for j in range(loopLength):
-                        if compFile.size == 2 or (compFile.shape[0]== 3 and compFile.size ==3) or (compFile.shape[0]== 5 and compFile.size ==5):
-                            matchCoord=SkyCoord(ra=compFile[0]*degree, dec=compFile[1]*degree)
-                        else:
-                            matchCoord=SkyCoord(ra=compFile[j][0]*degree, dec=compFile[j][1]*degree)
-                        idx, d2d, d3d = matchCoord.match_to_catalog_sky(fileRaDec)
-                        tempList=append(tempList, photFileArray[imgs][idx][4])
-                    outputPhot.append(tempList)
-                    fileCount.append(allCountsArray[allcountscount][0])
-                    allcountscount=allcountscount+1
+        starErrorRejCount = int(starErrorRejCounts[q])
+        starDistanceRejCount = int(starDistanceRejCounts[q])
+
+        # One row per file: target measurements, time, airmass, total comparison counts and error,
+        # differential magnitude and error, target counts and error, counts of each comparison
+        # and two calibration columns
+        outputPhot = np.ones((targetData.shape[0], 16 + nComps))
+        outputPhot[:,0:6] = targetData[:,q,0:6]
+        outputPhot[:,6] = cube.time
+        outputPhot[:,7] = cube.airmass
+        outputPhot[:,8:10] = totalCounts
+        outputPhot[:,10] = diffMag[:,q]
+        outputPhot[:,11] = magErrTotal[:,q]
+        outputPhot[:,12] = targetData[:,q,4]
+        outputPhot[:,13] = targetData[:,q,5]
+        outputPhot[:,14:14+nComps] = compData[:,:,4]
 
         # Check for dud images
-        imageReject=[]
-        for j in range(asarray(outputPhot).shape[0]):
-            if isnan(outputPhot[j][11]):
-                imageReject.append(j)
-        outputPhot=delete(outputPhot, imageReject, axis=0)
-        try:
-            outputPhot=np.vstack(asarray(outputPhot))
-        except ValueError:
+        outputPhot = outputPhot[~isnan(outputPhot[:,11])]
+        if outputPhot.shape[0] == 0:
             raise AstrosourceException("No target stars were detected in your dataset. Check your input target(s) RA/Dec")
 
         ## REMOVE MAJOR OUTLIERS FROM CONSIDERATION
         stdVar=nanstd((outputPhot)[:,10])
         avgVar=nanmean((outputPhot)[:,10])
-        starReject=[]
-        stdevReject=0
-        for j in range(asarray(outputPhot).shape[0]):
-            if outputPhot[j][10] > avgVar+(4*stdVar) or outputPhot[j][10] < avgVar-(4*stdVar) :
-                starReject.append(j)
-                stdevReject=stdevReject+1
-        sys.stdout.write('\n')
+        starReject = (outputPhot[:,10] > avgVar+(4*stdVar)) | (outputPhot[:,10] < avgVar-(4*stdVar))
+        stdevReject = int(starReject.sum())
         logger.info("Rejected Stdev Measurements: : {}".format(stdevReject))
         logger.info("Rejected Error Measurements: : {}".format(starErrorRejCount))
         logger.info("Rejected Distance Measurements: : {}".format(starDistanceRejCount))
@@ -337,10 +254,7 @@ def photometric_calculations(targets, paths, acceptDistance=5.0, errorReject=0.5
         logger.info("Average : {}".format(avgVar))
         logger.info("Stdev   : {}".format(stdVar))
 
-        outputPhot=delete(outputPhot, starReject, axis=0)
-
-        # Add calibration columns
-        outputPhot= np.c_[outputPhot, np.ones(outputPhot.shape[0]),np.ones(outputPhot.shape[0])]
+        outputPhot = outputPhot[~starReject]
 
         if outputPhot.shape[0] > 2:
             savetxt(paths['outcatPath'] / f"doerPhot_V{str(q+1)}.csv", outputPhot, delimiter=",", fmt='%0.8f')
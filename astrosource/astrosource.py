@@ -9,12 +9,14 @@ if (not os.environ.get('PYTHONHTTPSVERIFY', '') and getattr(ssl, '_create_unveri
 
 from astrosource.analyse import find_variable_stars, photometric_calculations, calibrated_photometry
 from astrosource.comparison import find_comparisons, find_comparisons_calibrated
+from astrosource.crossmatch import load_match_index
+from astrosource.cube import build_cube, save_cube, load_cube
 from astrosource.detrend import detrend_data
 from astrosource.eebls import plot_bls
 from astrosource.identify import find_stars, gather_files
 from astrosource.periodic import plot_with_period
 from astrosource.plots import make_plots, make_calibrated_plots, open_photometry_files, output_files, phased_plots
-from astrosource.utils import AstrosourceException, folder_setup, cleanup, setup_logger
+from astrosource.utils import AstrosourceException, folder_setup, cleanup, setup_logger, used_images
 
 
 class TimeSeries:
@@ -27,6 +29,10 @@ class TimeSeries:
         self.periodupper = kwargs.get('periodupper', -99.9)
         self.periodlower = kwargs.get('periodlower', 0.05)
         self.periodtests = kwargs.get('periodtests', -99)
+        self.periodworkers = kwargs.get('periodworkers', 1)
+        self.adaptiveperiods = kwargs.get('adaptiveperiods', False)
+        self.periodoversampling = kwargs.get('periodoversampling', None)
+        self.deferperiodplots = kwargs.get('deferperiodplots', False)
         self.rejectbrighter = kwargs.get('rejectbrighter', 99)
         self.rejectdimmer = kwargs.get('rejectdimmer', 99)
         self.thresholdcounts = kwargs.get('thresholdcounts', 1000000)
@@ -48,9 +54,15 @@ class TimeSeries:
         self.restrictmagdimmest = kwargs.get('restrictmagdimmest', -99.0)
         verbose = kwargs.get('verbose', False)
         bjd = kwargs.get('bjd', False)
+        workers = kwargs.get('workers', 1)
+        cachedir = kwargs.get('cachedir', None)
+        self.catalogue_cache = kwargs.get('catalogue_cache', None)
+        self.query_deadline = kwargs.get('query_deadline', None)
+        self.calibcsv = kwargs.get('calibcsv', False)
         self.paths = folder_setup(self.indir)
         logger = setup_logger('astrosource', verbose)
-        self.files, self.filtercode = gather_files(self.paths, filelist=filelist, filetype=self.format, bjd=bjd)
+        self.files, self.filtercode = gather_files(self.paths, filelist=filelist, filetype=self.format, bjd=bjd, workers=workers, cachePath=cachedir)
+        self.cube = None
 
     def analyse(self, calib=True):
         self.usedimages, self.stars = find_stars(targets=self.targets,
@@ -61,7 +73,10 @@ class TimeSeries:
                                                  starreject=self.starreject,
                                                  hicounts=self.hicounts,
                                                  lowcounts=self.lowcounts)
-        find_comparisons(self.targets, self.indir, self.usedimages, thresholdCounts=self.thresholdcounts)
+        # Every star in the match index (comparisons, targets and the reference frame) over every used image
+        self.cube = build_cube(self.paths['parent'], load_match_index(self.paths['parent']).stars, self.usedimages)
+        save_cube(self.paths['parent'], self.cube)
+        find_comparisons(self.targets, self.indir, self.usedimages, thresholdCounts=self.thresholdcounts, cube=self.cube, catalogueCache=self.catalogue_cache, queryDeadline=self.query_deadline)
         # Check that it is a filter that can actually be calibrated - in the future I am considering calibrating w against V to give a 'rough V' calibration, but not for now.
         self.calibrated = False
         if calib and self.filtercode in ['B', 'V', 'up', 'gp', 'rp', 'ip', 'zs']:
@@ -77,7 +92,10 @@ class TimeSeries:
                                                                                 colourTerm=self.colourterm,
                                                                                 colourError=self.colourerror,
                                                                                 restrictmagbrightest=self.restrictmagbrightest,
-                                                                                restrictmagdimmest=self.restrictmagdimmest)
+                                                                                restrictmagdimmest=self.restrictmagdimmest,
+                                                                                catalogueCache=self.catalogue_cache,
+                                                                                exportCsv=self.calibcsv,
+                                                                                queryDeadline=self.query_deadline)
 
                 self.calibrated = True
             except AstrosourceException as e:
@@ -85,11 +103,20 @@ class TimeSeries:
         elif calib:
             sys.stdout.write(f'⚠️ filter {self.filtercode} not supported for calibration\n')
 
+    def photometry_cube(self):
+        # The cube from analyse, or the one saved by an earlier run as long as it covers the same images
+        if self.cube is None:
+            cube = load_cube(self.paths['parent'])
+            usedImages = self.paths['parent'] / 'usedImages.txt'
+            if cube is not None and usedImages.exists() and list(cube.files) == used_images(self.paths['parent']):
+                self.cube = cube
+        return self.cube
+
     def find_variables(self):
-        find_variable_stars(targets=self.targets, parentPath=self.paths['parent'])
+        find_variable_stars(targets=self.targets, parentPath=self.paths['parent'], cube=self.photometry_cube())
 
     def photometry(self, filesave=False):
-        data = photometric_calculations(targets=self.targets, paths=self.paths, filesave=filesave)
+        data = photometric_calculations(targets=self.targets, paths=self.paths, filesave=filesave, cube=self.photometry_cube())
         self.output(mode='diff', data=data)
         if self.calibrated:
             self.data = calibrated_photometry(paths=self.paths, photometrydata=data, colourterm=self.colourterm,colourerror=self.colourerror,colourdetect=self.colourdetect,linearise=self.linearise,targetcolour=self.targetcolour)
@@ -106,11 +133,11 @@ class TimeSeries:
         if detrend:
             detrend_data(filterCode=self.filtercode, paths=self.paths)
         if period:
-            self.period = plot_with_period(filterCode=self.filtercode, paths=self.paths, minperiod=self.periodlower, maxperiod=self.periodupper, periodsteps=self.periodtests)
+            self.period = plot_with_period(filterCode=self.filtercode, paths=self.paths, minperiod=self.periodlower, maxperiod=self.periodupper, periodsteps=self.periodtests, workers=self.periodworkers, adaptive=self.adaptiveperiods, oversampling=self.periodoversampling, deferplots=self.deferperiodplots)
             if self.calibrated:
                 phased_plots(filterCode=self.filtercode, paths=self.paths, targets=self.targets, period=self.period, phaseShift=phaseShift)
         if eebls:
-            plot_bls(paths=self.paths)
+            plot_bls(paths=self.paths, oversampling=self.periodoversampling)
 
     def output(self, mode, data):
         output_files(paths=self.paths, photometrydata=data, mode=mode)
@@ -0,0 +1,159 @@
+from pathlib import Path
+
+from numpy import asarray, atleast_2d, ascontiguousarray, zeros, memmap, savetxt, load, savez, cumsum, concatenate
+
+import logging
+
+logger = logging.getLogger('astrosource')
+
+# Store for the per-frame output of the calibration in calibcats, in place of a .calibrated.csv and a .compared.csv
+# text file for every frame.
+#
+# The rows of every frame are appended to two raw float64 files, calibrated.dat and compared.dat, as they are made.
+# calibratedIndex.npz holds the frame names, the number of columns of each file and the number of rows each frame
+# added, so a frame can be read back by name, and the whole table can be memory-mapped to work on every frame at once.
+# export_csv writes the old text files when they are wanted.
+
+CALIBRATED_FILE = "calibrated.dat"
+COMPARED_FILE = "compared.dat"
+STORE_INDEX_FILE = "calibratedIndex.npz"
+STORE_DTYPE = '<f8'
+
+
+class CalibratedStore:
+    '''
+    Calibrated photometry frames and calibration standard comparisons, indexed by frame name
+
+    Create one with CalibratedStore.create, add frames with append and write the index with close.
+    A closed store is opened again with CalibratedStore.open. Used as a context manager, the store is closed when
+    the block ends, or discarded if it ends with an exception.
+    '''
+    def __init__(self, path, files, calibratedRows, comparedRows, calibratedCols, comparedCols):
+        self.path = Path(path)
+        self.files = list(files)
+        self.calibratedRows = list(calibratedRows)
+        self.comparedRows = list(comparedRows)
+        self.calibratedCols = calibratedCols
+        self.comparedCols = comparedCols
+        self._handles = None
+
+    @classmethod
+    def create(cls, path):
+        '''
+        Start a new, empty store in the directory path, replacing any store already there
+        '''
+        store = cls(path, [], [], [], 0, 0)
+        store.path.mkdir(parents=True, exist_ok=True)
+        if (store.path / STORE_INDEX_FILE).exists():
+            (store.path / STORE_INDEX_FILE).unlink()
+        store._handles = (open(store.path / CALIBRATED_FILE, 'wb'), open(store.path / COMPARED_FILE, 'wb'))
+        return store
+
+    @classmethod
+    def open(cls, path):
+        '''
+        Open the store saved in the directory path. Returns None if there is none.
+        '''
+        if not (Path(path) / STORE_INDEX_FILE).exists():
+            return None
+        with load(Path(path) / STORE_INDEX_FILE) as index:
+            return cls(path, index['files'], index['calibratedRows'], index['comparedRows'],
+                       int(index['calibratedCols']), int(index['comparedCols']))
+
+    def append(self, name, calibrated, compared):
+        '''
+        Add the calibrated photometry and the calibration standard comparison of one frame
+        '''
+        if self._handles is None:
+            raise ValueError("Calibrated store {} is not open for writing".format(self.path))
+        calibrated = atleast_2d(asarray(calibrated, dtype=STORE_DTYPE))
+        compared = atleast_2d(asarray(compared, dtype=STORE_DTYPE))
+        self.calibratedCols = self.calibratedCols or calibrated.shape[1]
+        self.comparedCols = self.comparedCols or compared.shape[1]
+        self._handles[0].write(ascontiguousarray(calibrated).tobytes())
+        self._handles[1].write(ascontiguousarray(compared).tobytes())
+        self.files.append(Path(name).stem)
+        self.calibratedRows.append(calibrated.shape[0])
+        self.comparedRows.append(compared.shape[0])
+
+    def close(self):
+        '''
+        Finish writing and save the index
+        '''
+        if self._handles is not None:
+            for handle in self._handles:
+                handle.close()
+            self._handles = None
+        savez(self.path / STORE_INDEX_FILE, files=asarray(self.files, dtype=str),
+              calibratedRows=asarray(self.calibratedRows, dtype=int), comparedRows=asarray(self.comparedRows, dtype=int),
+              calibratedCols=self.calibratedCols, comparedCols=self.comparedCols)
+        logger.debug("Calibrated store of {} frames saved to {}".format(len(self.files), self.path))
+
+    def discard(self):
+        '''
+        Stop writing and remove the data files, so an unfinished store is not left behind
+        '''
+        if self._handles is not None:
+            for handle in self._handles:
+                handle.close()
+            self._handles = None
+        for filename in (CALIBRATED_FILE, COMPARED_FILE, STORE_INDEX_FILE):
+            if (self.path / filename).exists():
+                (self.path / filename).unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+        else:
+            self.discard()
+
+    def _table(self, filename, rows, cols, mode):
+        if sum(rows) == 0:
+            return zeros((0, cols))
+        return memmap(self.path / filename, dtype=STORE_DTYPE, mode=mode, shape=(sum(rows), cols))
+
+    def calibrated_table(self, mode='r'):
+        '''
+        Calibrated photometry of every frame, one after the other, memory-mapped. Use mode='r+' to change it in place.
+        '''
+        return self._table(CALIBRATED_FILE, self.calibratedRows, self.calibratedCols, mode)
+
+    def compared_table(self, mode='r'):
+        '''
+        Calibration standard comparisons of every frame, one after the other, memory-mapped
+        '''
+        return self._table(COMPARED_FILE, self.comparedRows, self.comparedCols, mode)
+
+    def _rows(self, rows, name):
+        q = self.files.index(Path(name).stem)
+        start = int(concatenate([[0], cumsum(rows)])[q])
+        return slice(start, start + rows[q])
+
+    def calibrated(self, name):
+        '''
+        Calibrated photometry of the frame called name
+        '''
+        return asarray(self.calibrated_table()[self._rows(self.calibratedRows, name)])
+
+    def compared(self, name):
+        '''
+        Calibration standard comparison of the frame called name
+        '''
+        return asarray(self.compared_table()[self._rows(self.comparedRows, name)])
+
+    def export_csv(self, path=None):
+        '''
+        Write each frame to <frame>.calibrated.csv and <frame>.compared.csv in path, the store directory by default
+        '''
+        path = Path(path) if path else self.path
+        calibratedTable = self.calibrated_table()
+        comparedTable = self.compared_table()
+        calibratedStart = concatenate([[0], cumsum(self.calibratedRows)]).astype(int)
+        comparedStart = concatenate([[0], cumsum(self.comparedRows)]).astype(int)
+        for q, name in enumerate(self.files):
+            savetxt(path / "{}.calibrated.csv".format(name), calibratedTable[calibratedStart[q]:calibratedStart[q+1]], delimiter=",", fmt='%0.8f')
+            savetxt(path / "{}.compared.csv".format(name), comparedTable[comparedStart[q]:comparedStart[q+1]], delimiter=",", fmt='%0.8f')
+        logger.info("Exported {} calibrated frames to {}".format(len(self.files), path))
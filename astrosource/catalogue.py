@@ -0,0 +1,251 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from numpy import floor, cos, radians, asarray
+from astropy.units import degree
+from astropy.coordinates import SkyCoord, Angle
+from astropy.table import Table
+from astroquery.utils import TableList
+from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout
+
+from astrosource.utils import AstrosourceException
+
+import logging
+
+logger = logging.getLogger('astrosource')
+
+# On-disk cache of catalogue cone searches (VSX, APASS, SDSS, PanSTARRS, SkyMapper).
+#
+# The sky is cut into tiles of roughly TILE_SIZE degrees on a side: bands of declination, each split into equal
+# steps of RA. A query is looked up by the tile its centre falls in. On a miss the catalogue is queried once with the
+# cone widened by TILE_SIZE, around the centre of the tile, so any later cone of the same size centred in that tile
+# is covered by the saved result. Either way the rows are then cut down to the cone that was asked for, so the result
+# does not depend on whether it came from the cache.
+#
+# Each tile is a directory cachePath/<catalogue>/<tile>/ holding one ECSV file per table and query.json, which records
+# the table names, the radius that was fetched and when. Entries older than the ttl are fetched again, but are still
+# used if the catalogue cannot be reached.
+
+TILE_SIZE = 0.1
+CATALOGUE_TTL = 30 * 86400
+QUERY_FILE = "query.json"
+
+# A failed query is retried with exponential backoff, starting at QUERY_BACKOFF seconds, until QUERY_DEADLINE seconds
+# after the first attempt, unless a shorter or longer deadline is given.
+QUERY_DEADLINE = 120
+QUERY_BACKOFF = 1.0
+NETWORK_ERRORS = (ConnectionError, RequestsConnectionError, Timeout)
+
+# Names of the RA and Dec columns in the catalogues that are used
+RADEC_COLUMNS = (('RAJ2000', 'DEJ2000'), ('RA_ICRS', 'DE_ICRS'), ('RAICRS', 'DEICRS'), ('raj2000', 'dej2000'))
+
+
+def sky_tile(coord):
+    '''
+    Tile a sky position falls in
+
+    Returns
+    -------
+    name : str
+            Name of the tile, as used for the cache directory
+    centre : SkyCoord
+            Centre of the tile
+    '''
+    nDec = int(round(180. / TILE_SIZE))
+    decIndex = min(int(floor((coord.dec.degree + 90.) / TILE_SIZE)), nDec - 1)
+    decCentre = -90. + (decIndex + 0.5) * TILE_SIZE
+    nRa = max(1, int(floor(360. * cos(radians(decCentre)) / TILE_SIZE)))
+    raWidth = 360. / nRa
+    raIndex = int(floor((coord.ra.degree % 360.) / raWidth)) % nRa
+    centre = SkyCoord(ra=(raIndex + 0.5) * raWidth * degree, dec=decCentre * degree)
+    return "{}_{}".format(decIndex, raIndex), centre
+
+
+def cone_cut(tables, coord, radius):
+    '''
+    Keep the rows of each table within radius of coord. Tables without known RA and Dec columns are left alone.
+    '''
+    cut = OrderedDict()
+    for name, table in tables.items():
+        columns = [c for c in RADEC_COLUMNS if c[0] in table.colnames and c[1] in table.colnames]
+        if columns and len(table) > 0:
+            raName, decName = columns[0]
+            rowCoords = SkyCoord(ra=asarray(table[raName], dtype=float)*degree, dec=asarray(table[decName], dtype=float)*degree)
+            table = table[rowCoords.separation(coord) <= radius]
+        cut[name] = table
+    return cut
+
+
+def read_tile(tilePath):
+    '''
+    Read a cached tile. Returns the query record and the tables, or None if the tile is not there.
+    '''
+    try:
+        record = json.loads((tilePath / QUERY_FILE).read_text())
+        tables = OrderedDict()
+        for q, name in enumerate(record['tables']):
+            tables[name] = Table.read(tilePath / "{}.ecsv".format(q), format='ascii.ecsv')
+    except (OSError, ValueError, KeyError):
+        return None
+    return record, tables
+
+
+def write_tile(tilePath, tables, radius):
+    '''
+    Save the tables from a query to tilePath, replacing anything already there
+    '''
+    tilePath.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a scratch directory and move it into place, so an interrupted run never leaves half a tile behind
+    scratch = Path(tempfile.mkdtemp(dir=tilePath.parent))
+    try:
+        for q, table in enumerate(tables.values()):
+            table.write(scratch / "{}.ecsv".format(q), format='ascii.ecsv')
+        record = {'tables': list(tables.keys()), 'radius': radius, 'fetched': time.time()}
+        (scratch / QUERY_FILE).write_text(json.dumps(record))
+        if tilePath.exists():
+            shutil.rmtree(tilePath)
+        os.rename(scratch, tilePath)
+    except Exception:
+        shutil.rmtree(scratch, ignore_errors=True)
+        raise
+
+
+def cached_query(query, coord, radius, catalogue, cachePath=None, ttl=CATALOGUE_TTL):
+    '''
+    Cone search of a catalogue through the on-disk cache
+
+    Parameters
+    ----------
+    query : function
+            Called as query(coord, radius) to fetch a cone from the catalogue, returning a TableList
+    coord : SkyCoord
+            Centre of the cone
+    radius : str or Quantity
+            Radius of the cone
+    catalogue : str
+            Name of the catalogue, used to keep each catalogue separate in the cache
+    cachePath : Path
+            Directory holding the cache. When not given the catalogue is queried directly every time.
+    ttl : float
+            Age in seconds after which a cached tile is fetched again
+
+    Returns
+    -------
+    result : TableList
+            Tables of the catalogue sources within radius of coord
+    '''
+    if cachePath is None:
+        return query(coord, radius)
+
+    radius = Angle(radius).to(degree)
+    tileName, tileCentre = sky_tile(coord)
+    tilePath = Path(cachePath) / catalogue / tileName
+    needed = (coord.separation(tileCentre) + radius).degree
+
+    cached = read_tile(tilePath)
+    if cached is not None and cached[0]['radius'] >= needed:
+        record, tables = cached
+        if time.time() - record['fetched'] < ttl:
+            logger.debug("{} tile {} read from the catalogue cache".format(catalogue, tileName))
+            return TableList(cone_cut(tables, coord, radius))
+    else:
+        cached = None
+
+    fetchRadius = max(needed, radius.degree + TILE_SIZE)
+    try:
+        result = query(tileCentre, fetchRadius * degree)
+    except NETWORK_ERRORS:
+        if cached is None:
+            raise
+        logger.warning("Could not reach {}, using the out of date catalogue cache".format(catalogue))
+        return TableList(cone_cut(cached[1], coord, radius))
+    tables = OrderedDict((name, result[name]) for name in result.keys())
+    write_tile(tilePath, tables, fetchRadius)
+    logger.debug("{} tile {} saved to the catalogue cache".format(catalogue, tileName))
+    return TableList(cone_cut(tables, coord, radius))
+
+
+def retry_query(fetch, catalogue, deadline=None, backoff=QUERY_BACKOFF, stop=None):
+    '''
+    Call fetch until it gets through to the catalogue, waiting twice as long after each failure.
+    Raises AstrosourceException once deadline seconds (QUERY_DEADLINE if not given) have passed without an answer,
+    or as soon as the threading.Event stop is set while waiting to try again.
+    '''
+    if deadline is None:
+        deadline = QUERY_DEADLINE
+    if stop is None:
+        stop = threading.Event()
+    start = time.monotonic()
+    wait = backoff
+    while True:
+        try:
+            return fetch()
+        except NETWORK_ERRORS:
+            remaining = deadline - (time.monotonic() - start)
+            if remaining <= 0:
+                raise AstrosourceException("Could not reach {} within {} seconds".format(catalogue, deadline))
+            logger.info("Connection to {} failed, trying again in {:.0f} seconds".format(catalogue, min(wait, remaining)))
+            if stop.wait(min(wait, remaining)):
+                raise AstrosourceException("Stopped trying to reach {}".format(catalogue))
+            wait *= 2
+
+
+class CatalogueQueries:
+    '''
+    Catalogue queries running at the same time, one thread each, as started by fetch_catalogues
+
+    queries[name] waits for the query of that catalogue and returns its result, or the AstrosourceException it raised.
+    close() gives up on the queries that are no longer wanted: those not yet started are cancelled and those retrying
+    a catalogue that cannot be reached stop before their next attempt.
+    '''
+    def __init__(self, fetches):
+        self.stop = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(fetches)))
+        self.futures = OrderedDict((name, self.executor.submit(fetch, stop=self.stop)) for name, fetch in fetches.items())
+
+    def __getitem__(self, name):
+        try:
+            return self.futures[name].result()
+        except AstrosourceException as e:
+            return e
+
+    def keys(self):
+        return self.futures.keys()
+
+    def close(self):
+        self.stop.set()
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def fetch_catalogues(fetches):
+    '''
+    Run catalogue queries at the same time, one thread each
+
+    Parameters
+    ----------
+    fetches : OrderedDict
+            Functions that query each catalogue, keyed by catalogue name. Each is called with the keyword argument
+            stop, a threading.Event to pass on to retry_query, which is set once its result is no longer wanted.
+
+    Returns
+    -------
+    queries : CatalogueQueries
+            The queries, whose results are looked up by catalogue name. Close it once a catalogue has given enough
+            stars, so the ones after it are not waited on.
+    '''
+    return CatalogueQueries(fetches)
@@ -2,9 +2,9 @@ import glob
 import sys
 import os
 from pathlib import Path
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from functools import partial
 import numpy as np
-import time
 
 import matplotlib
 matplotlib.use('Agg')
@@ -18,14 +18,18 @@ from astroquery.vo_conesearch.exceptions import VOSError
 from astroquery.vizier import Vizier
 
 
-from astrosource.utils import AstrosourceException
+from astrosource.calibstore import CalibratedStore
+from astrosource.catalogue import cached_query, retry_query, fetch_catalogues
+from astrosource.crossmatch import frame_matches, match_frame, star_coords
+from astrosource.cube import build_cube, cube_stars, reference_row
+from astrosource.utils import AstrosourceException, used_images
 
 import logging
 
 logger = logging.getLogger('astrosource')
 
 
-def find_comparisons(targets, parentPath=None, fileList=None, stdMultiplier=2.5, thresholdCounts=10000000, variabilityMultiplier=2.5, removeTargets=True, acceptDistance=1.0):
+def find_comparisons(targets, parentPath=None, fileList=None, stdMultiplier=2.5, thresholdCounts=10000000, variabilityMultiplier=2.5, removeTargets=True, acceptDistance=1.0, cube=None, catalogueCache=None, queryDeadline=None):
     '''
     Find stable comparison stars for the target photometry
 
@@ -43,6 +47,12 @@ def find_comparisons(targets, parentPath=None, fileList=None, stdMultiplier=2.5,
             Set this to 1 to remove targets from consideration for comparison stars
     acceptDistance : float
             Furthest distance in arcseconds for matches
+    cube : PhotometryCube
+            Photometry cube of the used images (see cube.build_cube). Built from the files in fileList if not given.
+    catalogueCache : Path
+            Directory of the on-disk catalogue cache (see catalogue.cached_query). VSX is queried directly if not given.
+    queryDeadline : float
+            Seconds to keep retrying VSX if it cannot be reached (see catalogue.retry_query)
 
     Returns
     -------
@@ -57,21 +67,28 @@ def find_comparisons(targets, parentPath=None, fileList=None, stdMultiplier=2.5,
     if type(parentPath) == 'str':
         parentPath = Path(parentPath)
 
-    compFile, photFileArray = read_data_files(parentPath, fileList)
-
-    compFile = remove_stars_targets(parentPath, compFile, acceptDistance, targets, removeTargets)
+    if cube is None:
+        fileList = list(fileList)
+        compFile, photFileArray = read_data_files(parentPath, fileList)
+        compFile = remove_stars_targets(parentPath, compFile, acceptDistance, targets, removeTargets, cachePath=catalogueCache, deadline=queryDeadline)
+        cube = build_cube(parentPath, compFile, fileList, photFileArray)
+    else:
+        compFile = genfromtxt(parentPath / "screenedComps.csv", dtype=float, delimiter=',')
+        compFile = remove_stars_targets(parentPath, compFile, acceptDistance, targets, removeTargets, cachePath=catalogueCache, deadline=queryDeadline)
 
-    while True:
-        # First half of Loop: Add up all of the counts of all of the comparison stars
-        # To create a gigantic comparison star.
+    # Counts of each candidate in each image
+    compCounts = cube_stars(cube, compFile, parentPath)[0][:,:,4]
 
-        logger.debug("Please wait... calculating ensemble comparison star for each image")
-        fileCount = ensemble_comparisons(photFileArray, compFile)
+    # First half of Loop: Add up all of the counts of all of the comparison stars
+    # To create a gigantic comparison star. This is done once, rejected stars are taken back out of it below.
+    logger.debug("Please wait... calculating ensemble comparison star for each image")
+    fileCount = ensemble_comparisons(compCounts)
 
+    while True:
         # Second half of Loop: Calculate the variation in each candidate comparison star in brightness
         # compared to this gigantic comparison star.
 
-        stdCompStar, sortStars = calculate_comparison_variation(compFile, photFileArray, fileCount)
+        stdCompStar, sortStars = calculate_comparison_variation(compFile, compCounts, fileCount)
 
         variabilityMax=(min(stdCompStar)*variabilityMultiplier)
 
@@ -88,24 +105,20 @@ def find_comparisons(targets, parentPath=None, fileList=None, stdMultiplier=2.5,
 
         starRejecter=[]
         if min(stdCompStar) > 0.0009:
-            for j in range(len(stdCompStar)):
-
-                if ( stdCompStar[j] > (stdCompMed + (stdMultiplier*stdCompStd)) ):
-                    logger.debug(f"Star {j} Rejected, Variability too high!")
-                    starRejecter.append(j)
-
-                if ( isnan(stdCompStar[j]) ) :
-                    logger.debug("Star Rejected, Invalid Entry!")
-                    starRejecter.append(j)
-                sys.stdout.write('.')
-                sys.stdout.flush()
-            if starRejecter:
+            starRejecter = where((stdCompStar > (stdCompMed + (stdMultiplier*stdCompStd))) | isnan(stdCompStar))[0]
+            for j in starRejecter:
+                logger.debug(f"Star {j} Rejected, Variability too high!")
+            sys.stdout.write('.' * len(stdCompStar))
+            sys.stdout.flush()
+            if len(starRejecter):
                 logger.warning("Rejected {} stars".format(len(starRejecter)))
         else:
             logger.info("Minimum variability is too low for comparison star rejection by variability.")
 
 
+        fileCount = remove_from_ensemble(fileCount, compCounts, starRejecter)
         compFile = delete(compFile, starRejecter, axis=0)
+        compCounts = delete(compCounts, starRejecter, axis=1)
         sortStars = delete(sortStars, starRejecter, axis=0)
 
         # Calculate and present statistics of sample of candidate comparison stars.
@@ -115,7 +128,7 @@ def find_comparisons(targets, parentPath=None, fileList=None, stdMultiplier=2.5,
         logger.info("Max variability {:.6f}".format(max(stdCompStar)))
         logger.info("Number of Stable Comparison Candidates {}".format(compFile.shape[0]))
         # Once we have stopped rejecting stars, this is our final candidate catalogue then we start to select the subset of this final catalogue that we actually use.
-        if (starRejecter == []):
+        if len(starRejecter) == 0:
             break
         else:
             logger.warning("Trying again")
@@ -125,10 +138,10 @@ def find_comparisons(targets, parentPath=None, fileList=None, stdMultiplier=2.5,
     sys.stdout.write('\n')
     logger.info('Statistical stability reached.')
 
-    outfile, num_comparisons = final_candidate_catalogue(parentPath, photFileArray, sortStars, thresholdCounts, variabilityMax)
+    outfile, num_comparisons = final_candidate_catalogue(parentPath, cube, sortStars, thresholdCounts, variabilityMax)
     return outfile, num_comparisons
 
-def final_candidate_catalogue(parentPath, photFileArray, sortStars, thresholdCounts, variabilityMax):
+def final_candidate_catalogue(parentPath, cube, sortStars, thresholdCounts, variabilityMax):
 
     logger.info('List of stable comparison candidates output to stdComps.csv')
 
@@ -137,7 +150,7 @@ def final_candidate_catalogue(parentPath, photFileArray, sortStars, thresholdCou
     # The following process selects the subset of the candidates that we will use (the least variable comparisons that hopefully get the request countrate)
 
     # Sort through and find the largest file and use that as the reference file
-    referenceFrame, fileRaDec = find_reference_frame(photFileArray)
+    referenceFrame, fileRaDec = find_reference_frame([load(parentPath / cube.files[reference_row(cube)])])
 
     savetxt(parentPath / "referenceFrame.csv", referenceFrame, delimiter=",", fmt='%0.8f')
 
@@ -147,36 +160,23 @@ def final_candidate_catalogue(parentPath, photFileArray, sortStars, thresholdCou
 
     # PICK COMPS UNTIL OVER THE THRESHOLD OF COUNTS OR VRAIABILITY ACCORDING TO REFERENCE IMAGE
     logger.debug("PICK COMPARISONS UNTIL OVER THE THRESHOLD ACCORDING TO REFERENCE IMAGE")
-    compFile=[]
-    tempCountCounter=0.0
-    finalCountCounter=0.0
-    for j in range(sortStars.shape[0]):
-        if sortStars.size == 13 and sortStars.shape[0] == 1:
-            matchCoord=SkyCoord(ra=sortStars[0][0]*degree, dec=sortStars[0][1]*degree)
-        else:
-            matchCoord=SkyCoord(ra=sortStars[j][0]*degree, dec=sortStars[j][1]*degree)
-        idx, d2d, d3d = matchCoord.match_to_catalog_sky(fileRaDec)
-
-        if tempCountCounter < thresholdCounts:
-            if sortStars.size == 13 and sortStars.shape[0] == 1:
-                compFile.append([sortStars[0][0],sortStars[0][1],sortStars[0][2]])
-                logger.debug("Comp " + str(j+1) + " std: " + str(sortStars[0][2]))
-                logger.debug("Cumulative Counts thus far: " + str(tempCountCounter))
-                finalCountCounter=add(finalCountCounter,referenceFrame[idx][4])
-
-            elif sortStars[j][2] < variabilityMax:
-                compFile.append([sortStars[j][0],sortStars[j][1],sortStars[j][2]])
-                logger.debug("Comp " + str(j+1) + " std: " + str(sortStars[j][2]))
-                logger.debug("Cumulative Counts thus far: " + str(tempCountCounter))
-                finalCountCounter=add(finalCountCounter,referenceFrame[idx][4])
-
-        tempCountCounter=add(tempCountCounter,referenceFrame[idx][4])
+    idx, _ = match_frame(star_coords(sortStars), referenceFrame)
+    referenceCounts = referenceFrame[idx,4]
+    # Counts of the candidates before each one, added up in order
+    tempCountCounter = np.concatenate([[0.0], referenceCounts.cumsum()[:-1]])
+    selected = tempCountCounter < thresholdCounts
+    if not (sortStars.size == 13 and sortStars.shape[0] == 1):
+        selected &= sortStars[:,2] < variabilityMax
+    for j in where(selected)[0]:
+        logger.debug("Comp " + str(j+1) + " std: " + str(sortStars[j][2]))
+        logger.debug("Cumulative Counts thus far: " + str(tempCountCounter[j]))
+    finalCountCounter = referenceCounts[selected].sum()
+    compFile = sortStars[selected][:,0:3]
 
     logger.debug("Selected stars listed below:")
     logger.debug(compFile)
 
     logger.info("Finale Ensemble Counts: " + str(finalCountCounter))
-    compFile=asarray(compFile)
 
     logger.info(str(compFile.shape[0]) + " Stable Comparison Candidates below variability threshold output to compsUsed.csv")
 
@@ -199,95 +199,54 @@ def find_reference_frame(photFileArray):
 
 def read_data_files(parentPath, fileList):
     # LOAD Phot FILES INTO LIST
+    # Frames have different numbers of stars so they are kept as a list
     photFileArray = []
     for file in fileList:
         photFileArray.append(load(parentPath / file))
-    photFileArray = asarray(photFileArray)
 
     #Grab the candidate comparison stars
     screened_file = parentPath / "screenedComps.csv"
     compFile = genfromtxt(screened_file, dtype=float, delimiter=',')
     return compFile, photFileArray
 
-def ensemble_comparisons(photFileArray, compFile):
-    fileCount = []
-    for photFile in photFileArray:
-        allCounts = 0.0
-        fileRaDec = SkyCoord(ra=photFile[:,0]*degree, dec=photFile[:,1]*degree)
-        if compFile.size ==2 and compFile.shape[0]==2:
-            matchCoord = SkyCoord(ra=compFile[0]*degree, dec=compFile[1]*degree)
-            idx, d2d, d3d = matchCoord.match_to_catalog_sky(fileRaDec)
-            allCounts = add(allCounts,photFile[idx][4])
-        else:
-            for cf in compFile:
-                matchCoord = SkyCoord(ra=cf[0]*degree, dec=cf[1]*degree)
-                idx, d2d, d3d = matchCoord.match_to_catalog_sky(fileRaDec)
-                allCounts = add(allCounts,photFile[idx][4])
-        logger.debug("Total Counts in Image: {:.2f}".format(allCounts))
-        fileCount.append(allCounts)
-    logger.debug("Total total {}".format(np.sum(np.array(fileCount))))
+def ensemble_comparisons(compCounts):
+    # compCounts holds the counts of each comparison (columns) in each image (rows).
+    # Summation order matters for byte-identical output: summing the contiguous columns adds the comparisons
+    # up one after another, as the ensemble has always been summed, where sum(axis=1) would pair them up
+    fileCount = np.ascontiguousarray(compCounts.T).sum(axis=0)
+    logger.debug("Total total {}".format(np.sum(fileCount)))
     return fileCount
 
-def calculate_comparison_variation(compFile, photFileArray, fileCount):
-    stdCompStar=[]
-    sortStars=[]
-
-    if compFile.size ==2 and compFile.shape[0]==2:
-        compDiffMags = []
-        logger.debug("*************************")
-        logger.debug("RA : " + str(compFile[0]))
-        logger.debug("DEC: " + str(compFile[1]))
-        for q, photFile in enumerate(photFileArray):
-            fileRaDec = SkyCoord(ra=photFile[:,0]*degree, dec=photFile[:,1]*degree)
-            matchCoord = SkyCoord(ra=compFile[0]*degree, dec=compFile[1]*degree)
-            idx, d2d, d3d = matchCoord.match_to_catalog_sky(fileRaDec)
-            compDiffMags = append(compDiffMags,2.5 * log10(photFile[idx][4]/fileCount[q]))
-            instrMags = -2.5 * log10(photFile[idx][4])
-
-
-        stdCompDiffMags=std(compDiffMags)
-        medCompDiffMags=np.nanmedian(compDiffMags)
-        medInstrMags= np.nanmedian(instrMags)
-
-        logger.debug("VAR: " +str(stdCompDiffMags))
-        if np.isnan(stdCompDiffMags) :
-            logger.error("Star Variability non rejected")
-            stdCompDiffMags=99
-        stdCompStar.append(stdCompDiffMags)
-        sortStars.append([compFile[0],compFile[1],stdCompDiffMags,medCompDiffMags,medInstrMags,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0])
-
-
-
-    else:
-        for cf in compFile:
-            compDiffMags = []
-            instrMags=[]
-            logger.debug("*************************")
-            logger.debug("RA : " + str(cf[0]))
-            logger.debug("DEC: " + str(cf[1]))
-            for q, photFile in enumerate(photFileArray):
-                fileRaDec = SkyCoord(ra=photFile[:,0]*degree, dec=photFile[:,1]*degree)
-                matchCoord = SkyCoord(ra=cf[0]*degree, dec=cf[1]*degree)
-                idx, d2d, d3d = matchCoord.match_to_catalog_sky(fileRaDec)
-                compDiffMags = append(compDiffMags,2.5 * log10(photFile[idx][4]/fileCount[q]))
-                instrMags = -2.5 * log10(photFile[idx][4])
-
-            stdCompDiffMags=std(compDiffMags)
-            medCompDiffMags=np.nanmedian(compDiffMags)
-            medInstrMags=np.nanmedian(instrMags)
-
-            logger.debug("VAR: " +str(stdCompDiffMags))
-
-            if np.isnan(stdCompDiffMags) :
-                logger.error("Star Variability non rejected")
-                stdCompDiffMags=99
-            stdCompStar.append(stdCompDiffMags)
-
-            sortStars.append([cf[0],cf[1],stdCompDiffMags,medCompDiffMags,medInstrMags,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0])
+def remove_from_ensemble(fileCount, compCounts, starRejecter):
+    # Take the rejected comparisons (columns of compCounts) out of the ensemble counts of each image
+    if len(starRejecter) == 0:
+        return fileCount
+    return fileCount - compCounts[:,starRejecter].sum(axis=1)
+
+def calculate_comparison_variation(compFile, compCounts, fileCount):
+    compFile = np.atleast_2d(compFile)
+
+    # Differential magnitude of each candidate (rows) in each image (columns). Each row is contiguous so the
+    # statistics reduce it exactly as they reduce a single star's list of magnitudes.
+    compDiffMags = np.ascontiguousarray((2.5 * log10(compCounts / fileCount[:,None])).T)
+    stdCompStar = std(compDiffMags, axis=1)
+    medCompDiffMags = np.nanmedian(compDiffMags, axis=1)
+    # Instrumental magnitude in the last image
+    medInstrMags = -2.5 * log10(compCounts[-1])
+
+    for j in where(isnan(stdCompStar))[0]:
+        logger.error("Star Variability non rejected")
+    stdCompStar[isnan(stdCompStar)] = 99
+
+    sortStars = np.zeros((compFile.shape[0], 13))
+    sortStars[:,0:2] = compFile[:,0:2]
+    sortStars[:,2] = stdCompStar
+    sortStars[:,3] = medCompDiffMags
+    sortStars[:,4] = medInstrMags
 
     return stdCompStar, sortStars
 
-def remove_stars_targets(parentPath, compFile, acceptDistance, targetFile, removeTargets):
+def remove_stars_targets(parentPath, compFile, acceptDistance, targetFile, removeTargets, cachePath=None, deadline=None):
     max_sep=acceptDistance * arcsecond
     logger.info("Removing Target Stars from potential Comparisons")
 
@@ -335,31 +294,20 @@ def remove_stars_targets(parentPath, compFile, acceptDistance, targetFile, remov
 
 
     # Check VSX for any known variable stars and remove them from the list
-    try:
+    def vsx_query(coord, radius):
         v=Vizier(columns=['all']) # Skymapper by default does not report the error columns
         v.ROW_LIMIT=-1
-        logger.info(avgCoord)
-        variableResult=v.query_region(avgCoord, '0.33 deg', catalog='VSX')
-        logger.info(variableResult)
-        if str(variableResult)=="Empty TableList":
-            logger.info("VSX Returned an Empty Table.")
-            varTable=0
-        else:
-            variableResult=variableResult['B/vsx/vsx']
-            varTable=1
-    except ConnectionError:
-        connected=False
-        logger.info("Connection failed, waiting and trying again")
-        while connected==False:
-            try:
-                v=Vizier(columns=['all']) # Skymapper by default does not report the error columns
-                v.ROW_LIMIT=-1
-                variableResult=v.query_region(avgCoord, '0.33 deg', catalog='VSX')['B/vsx/vsx']
-                connected=True
-            except ConnectionError:
-                time.sleep(10)
-                logger.info("Failed again.")
-                connected=False
+        return v.query_region(coord, radius=radius, catalog='VSX')
+
+    logger.info(avgCoord)
+    variableResult=retry_query(lambda: cached_query(vsx_query, avgCoord, '0.33 deg', 'VSX', cachePath=cachePath), 'VSX', deadline=deadline)
+    logger.info(variableResult)
+    if str(variableResult)=="Empty TableList":
+        logger.info("VSX Returned an Empty Table.")
+        varTable=0
+    else:
+        variableResult=variableResult['B/vsx/vsx']
+        varTable=1
 
     if varTable==1:
         logger.debug(variableResult)
@@ -408,7 +356,25 @@ def remove_stars_targets(parentPath, compFile, acceptDistance, targetFile, remov
     return compFile
 
 
-def catalogue_call(avgCoord, opt, cat_name, targets, closerejectd):
+def catalogue_query(avgCoord, cat_name, cachePath=None, deadline=None, stop=None):
+    '''
+    Query a catalogue for the sources within 0.33 degrees of avgCoord, through the catalogue cache when cachePath is
+    given. Connection failures are retried with backoff up to deadline seconds, or until stop is set
+    (see catalogue.retry_query).
+    '''
+    def vizier_query(coord, radius):
+        v=Vizier(columns=['all']) # Skymapper by default does not report the error columns
+        v.ROW_LIMIT=-1
+        return v.query_region(coord, radius=radius, catalog=cat_name)
+
+    try:
+        return retry_query(lambda: cached_query(vizier_query, avgCoord, '0.33 deg', cat_name, cachePath=cachePath), cat_name,
+                           deadline=deadline, stop=stop)
+    except VOSError:
+        raise AstrosourceException("Could not find RA {} Dec {} in {}".format(avgCoord.ra.value,avgCoord.dec.value, cat_name))
+
+
+def catalogue_call(avgCoord, opt, cat_name, targets, closerejectd, cachePath=None, query=None):
     data = namedtuple(typename='data',field_names=['ra','dec','mag','emag','cat_name', 'colmatch', 'colerr'])
 
     TABLES = {'APASS':'II/336/apass9',
@@ -418,28 +384,9 @@ def catalogue_call(avgCoord, opt, cat_name, targets, closerejectd):
               }
 
     tbname = TABLES.get(cat_name, None)
-    kwargs = {'radius':'0.33 deg'}
-    kwargs['catalog'] = cat_name
 
-    try:
-        v=Vizier(columns=['all']) # Skymapper by default does not report the error columns
-        v.ROW_LIMIT=-1
-        query = v.query_region(avgCoord, **kwargs)
-    except VOSError:
-        raise AstrosourceException("Could not find RA {} Dec {} in {}".format(avgCoord.ra.value,avgCoord.dec.value, cat_name))
-    except ConnectionError:
-        connected=False
-        logger.info("Connection failed, waiting and trying again")
-        while connected==False:
-            try:
-                v=Vizier(columns=['all']) # Skymapper by default does not report the error columns
-                v.ROW_LIMIT=-1
-                query = v.query_region(avgCoord, **kwargs)
-                connected=True
-            except ConnectionError:
-                time.sleep(10)
-                logger.info("Failed again.")
-                connected=False
+    if query is None:
+        query = catalogue_query(avgCoord, cat_name, cachePath=cachePath)
 
     if query.keys():
         resp = query[tbname]
@@ -469,33 +416,31 @@ def catalogue_call(avgCoord, opt, cat_name, targets, closerejectd):
     # Remove any objects close to targets from potential calibrators
     if targets.shape == (4,):
         targets = [targets]
+    catRa = np.asarray(resp[radecname['ra']], dtype=float)
+    catDec = np.asarray(resp[radecname['dec']], dtype=float)
+    nearTarget = np.zeros(len(resp), dtype=bool)
     for tg in targets:
-        resp = resp[where(np.abs(resp[radecname['ra']]-tg[0]) > 0.0014) and where(np.abs(resp[radecname['dec']]-tg[1]) > 0.0014)]
+        nearTarget |= (np.abs(catRa-tg[0]) <= 0.0014) & (np.abs(catDec-tg[1]) <= 0.0014)
+    resp = resp[~nearTarget]
 
     logger.info("Number of calibration sources after removal of sources near targets: "+str(len(resp)))
 
 
-    # Remove any star that has invalid values for mag or magerror
-    catReject=[]
-    for q in range(len(resp)):
-        if np.asarray(resp[opt['filter']][q]) == 0.0 or np.asarray(resp[opt['error']][q]) == 0.0 or np.isnan(resp[opt['filter']][q]) or np.isnan(resp[opt['error']][q]):
-            catReject.append(q)
-    del resp[catReject]
-    logger.info(f"Stars rejected that are have invalid mag or magerror entries: {len(catReject)}")
+    # Remove any star that has invalid values for mag or magerror, masked entries count as invalid
+    catMag = np.ma.filled(np.ma.asarray(resp[opt['filter']], dtype=float), np.nan)
+    catErr = np.ma.filled(np.ma.asarray(resp[opt['error']], dtype=float), np.nan)
+    catReject = (catMag == 0.0) | (catErr == 0.0) | np.isnan(catMag) | np.isnan(catErr)
+    resp = resp[~catReject]
+    logger.info(f"Stars rejected that are have invalid mag or magerror entries: {catReject.sum()}")
 
     # Remove any star from calibration catalogue that has another star in the catalogue within closerejectd arcseconds of it.
-    catReject=[]
-    while True:
+    # Removing stars only moves the nearest neighbours of the others further away, so one nearest neighbour search finds them all.
+    if len(resp) > 1:
         fileRaDec = SkyCoord(ra=resp[radecname['ra']].data*degree, dec=resp[radecname['dec']].data*degree)
         idx, d2d, _ = fileRaDec.match_to_catalog_sky(fileRaDec, nthneighbor=2) # Closest matches that isn't itself.
-        catReject = []
-        for q in range(len(d2d)):
-            if d2d[q] < closerejectd*arcsecond:
-                catReject.append(q)
-        if catReject == []:
-            break
-        del resp[catReject]
-        logger.info(f"Stars rejected that are too close (<5arcsec) in calibration catalogue: {len(catReject)}")
+        catReject = d2d < closerejectd*arcsecond
+        resp = resp[~catReject]
+        logger.info(f"Stars rejected that are too close (<5arcsec) in calibration catalogue: {catReject.sum()}")
 
     logger.info(f"Number of calibration sources after removal of sources near other sources: {len(resp)}")
 
@@ -511,7 +456,94 @@ def catalogue_call(avgCoord, opt, cat_name, targets, closerejectd):
 
     return data
 
-def find_comparisons_calibrated(targets, paths, filterCode, nopanstarrs=False, nosdss=False, colourdetect=False, linearise=False, closerejectd=5.0, max_magerr=0.05, stdMultiplier=2, variabilityMultiplier=2, colourTerm=0.0, colourError=0.0, restrictmagbrightest=-99.9, restrictmagdimmest=99.9):
+def colour_table(calibStands, photRows, colrev):
+    '''
+    Catalogue magnitude and error, instrumental magnitude and error and catalogue colour of each calibration standard,
+    as used to estimate the colour term. photRows holds the row of each standard from a frame already converted to
+    instrumental magnitudes.
+    '''
+    if colrev == 1:
+        colour = calibStands[:,6]-calibStands[:,3]
+    else:
+        colour = calibStands[:,3]-calibStands[:,6]
+    return np.column_stack([calibStands[:,3],calibStands[:,4],photRows[:,4],photRows[:,5],colour,np.zeros(len(calibStands))])
+
+
+def calibrate_frame(photFile, catCoords, coords, max_sep, colrev, colourTerm, calibStands, calibRows):
+    '''
+    Calibrate the magnitudes in one photometry frame against the calibration catalogue
+
+    Parameters
+    ----------
+    photFile : numpy array
+            Photometry frame
+    catCoords : SkyCoord
+            Positions of the catalogue sources. Pass the same object for every frame so its KD-tree is only built once.
+    coords : data
+            Catalogue as returned by catalogue_call
+    max_sep : Quantity
+            Furthest distance for a catalogue match
+    colrev : int
+            1 if the colour is colmatch - mag rather than mag - colmatch
+    colourTerm : float
+            Colour term applied to the instrumental magnitudes
+    calibStands : numpy array
+            Calibration standards, with catalogue magnitude and error in columns 3 and 4
+    calibRows : numpy array
+            Row of each calibration standard in photFile
+
+    Returns
+    -------
+    photFile : numpy array
+            The frame with calibrated magnitudes and errors in columns 4 and 5, and three extra columns: the catalogue
+            colour (the field median if there is no match), its error, and 1 if it was matched, 0 if not and 2 if no
+            colour was available at all
+    calibOut : numpy array
+            One row for each standard with a colour: catalogue mag and error, instrumental mag and error, catalogue
+            minus instrumental mag, the same less the zero point, colour, RA and Dec
+    tempZP : float
+            Zero point of the frame, the median of catalogue minus instrumental mag over the standards
+    '''
+    photFile=np.c_[photFile,np.zeros((len(photFile[:,0]),3))]
+
+    # Get colour information into photFile
+    photCoords=SkyCoord(ra=photFile[:,0]*degree, dec=photFile[:,1]*degree)
+    idx,d2d,_=photCoords.match_to_catalog_sky(catCoords)
+    matched=d2d < max_sep
+    if colrev == 1:
+        colour=coords.colmatch[idx]-coords.mag[idx]
+    else:
+        colour=coords.mag[idx]-coords.colmatch[idx]
+    photFile[:,8]=np.where(matched, colour, np.nan)
+    photFile[:,9]=np.where(matched, np.power(np.power(coords.colerr[idx],2)+np.power(coords.emag[idx],2),0.5), np.nan)
+    photFile[:,10]=matched
+
+    #Replace undetected colours with average colour of the field
+    photFile[:,8]=np.nan_to_num(photFile[:,8],nan=np.nanmedian(photFile[:,8]))
+    photFile[:,9]=np.nan_to_num(photFile[:,9],nan=np.nanmedian(photFile[:,9]))
+
+    #Convert the phot file into instrumental magnitudes with colour correction
+    noColour=np.isnan(photFile[:,8])
+    photFile[:,5]=1.0857 * (photFile[:,5]/photFile[:,4])
+    photFile[:,4]=-2.5*log10(photFile[:,4]) - np.where(noColour, 0.0, colourTerm*photFile[:,8])
+    photFile[noColour,10]=2 # 2 means that there was no colour to use to embed the colour.
+
+    #Pull out the CalibStands out of each file
+    calibStands=np.atleast_2d(calibStands)
+    hasColour=photFile[calibRows,10] != 0
+    calibStands=calibStands[hasColour]
+    calibRows=calibRows[hasColour]
+    tempDiff=calibStands[:,3]-photFile[calibRows,4]
+    tempZP=(median(tempDiff))
+    calibOut=np.column_stack([calibStands[:,3],calibStands[:,4],photFile[calibRows,4],photFile[calibRows,5],tempDiff,tempDiff-tempZP,photFile[calibRows,8],photFile[calibRows,0],photFile[calibRows,1]])
+
+    #Shift the magnitudes in the phot file by the zeropoint
+    photFile[:,4]=photFile[:,4]+tempZP
+
+    return photFile, calibOut, tempZP
+
+
+def find_comparisons_calibrated(targets, paths, filterCode, nopanstarrs=False, nosdss=False, colourdetect=False, linearise=False, closerejectd=5.0, max_magerr=0.05, stdMultiplier=2, variabilityMultiplier=2, colourTerm=0.0, colourError=0.0, restrictmagbrightest=-99.9, restrictmagdimmest=99.9, catalogueCache=None, exportCsv=False, queryDeadline=None):
     sys.stdout.write("⭐️ Find comparison stars in catalogues for calibrated photometry\n")
 
     FILTERS = {
@@ -545,9 +577,7 @@ def find_comparisons_calibrated(targets, paths, filterCode, nopanstarrs=False, n
     #Vizier.ROW_LIMIT = -1
 
     # Get List of Files Used
-    fileList=[]
-    for line in (parentPath / "usedImages.txt").read_text().strip().split('\n'):
-        fileList.append(line.strip())
+    fileList = used_images(parentPath)
 
     logger.debug("Filter Set: " + filterCode)
 
@@ -598,6 +628,14 @@ def find_comparisons_calibrated(targets, paths, filterCode, nopanstarrs=False, n
         raise AstrosourceException(f"{filterCode} is not accepted at present")
 
     # Look up in online catalogues and make sure there are sufficient comparison stars
+    # All the catalogues for the filter are queried at once, then used in order until one gives a match, after which
+    # the queries of the others are given up
+
+    fetches=OrderedDict()
+    for cat_name in catalogues:
+        if not ((cat_name == 'PanSTARRS' and nopanstarrs==True) or (cat_name == 'SDSS' and nosdss==True)):
+            fetches[cat_name]=partial(catalogue_query, avgCoord, cat_name, cachePath=catalogueCache, deadline=queryDeadline)
+    queries=fetch_catalogues(fetches)
 
     coords=[]
     for cat_name, opt in catalogues.items():
@@ -609,8 +647,10 @@ def find_comparisons_calibrated(targets, paths, filterCode, nopanstarrs=False, n
                 elif cat_name == 'SDSS' and nosdss==True:
                     logger.info("Skipping SDSS")
                 else:
+                    if isinstance(queries[cat_name], AstrosourceException):
+                        raise queries[cat_name]
 
-                    coords = catalogue_call(avgCoord, opt, cat_name, targets=targets, closerejectd=closerejectd)
+                    coords = catalogue_call(avgCoord, opt, cat_name, targets=targets, closerejectd=closerejectd, query=queries[cat_name])
                     if coords.cat_name == 'PanSTARRS' or coords.cat_name == 'APASS':
                         max_sep=2.5 * arcsecond
                     else:
@@ -728,72 +768,32 @@ def find_comparisons_calibrated(targets, paths, filterCode, nopanstarrs=False, n
 
                     #Get calib mags for least variable IDENTIFIED stars.... not the actual stars in compUsed!! Brighter, less variable stars may be too bright for calibration!
                     #So the stars that will be used to calibrate the frames to get the OTHER stars.
-                    calibStands=[]
-
-                    if compFile.shape[0] ==13 and compFile.size ==13:
-                        lenloop=1
-                    else:
-                        lenloop=len(compFile[:,0])
-
-                    for q in range(lenloop):
-                        if compFile.shape[0] ==13 and compFile.size ==13:
-                            compCoord=SkyCoord(ra=compFile[0]*degree, dec=compFile[1]*degree)
-                        else:
-                            compCoord=SkyCoord(ra=compFile[q][0]*degree, dec=compFile[q][1]*degree)
-                        idxcomp,d2dcomp,d3dcomp=compCoord.match_to_catalog_sky(catCoords)
-                        if d2dcomp < max_sep:
-                            if not isnan(coords.mag[idxcomp]) and not isnan(coords.emag[idxcomp]):
-                                if compFile.shape[0] ==13 and compFile.size ==13:
-                                    calibStands.append([compFile[0],compFile[1],compFile[2],coords.mag[idxcomp],coords.emag[idxcomp],compFile[3],coords.colmatch[idxcomp],coords.colerr[idxcomp],compFile[4]])
-                                else:
-                                    calibStands.append([compFile[q][0],compFile[q][1],compFile[q][2],coords.mag[idxcomp],coords.emag[idxcomp],compFile[q][3],coords.colmatch[idxcomp],coords.colerr[idxcomp],compFile[q][4]])
-
+                    # Match every comparison against the catalogue at once
+                    compRows=np.atleast_2d(compFile)
+                    idxcomp,d2dcomp,d3dcomp=SkyCoord(ra=compRows[:,0]*degree, dec=compRows[:,1]*degree).match_to_catalog_sky(catCoords)
+                    matched=(d2dcomp < max_sep) & ~isnan(coords.mag[idxcomp]) & ~isnan(coords.emag[idxcomp])
+                    compRows=compRows[matched]
+                    idxcomp=idxcomp[matched]
+                    calibStands=np.column_stack([compRows[:,0],compRows[:,1],compRows[:,2],coords.mag[idxcomp],coords.emag[idxcomp],compRows[:,3],coords.colmatch[idxcomp],coords.colerr[idxcomp],compRows[:,4]])
 
                     ### remove stars that that brighter (--restrictmagbrighter) or dimmer (--restrictmagdimmer) than requested.
-                    calibStandsReject=[]
-                    if (asarray(calibStands).shape[0] != 9 and asarray(calibStands).size !=9) and calibStands != []:
-                        for q in range(len(asarray(calibStands)[:,0])):
-
-                            if (calibStands[q][3] > restrictmagdimmest) or (calibStands[q][3] < restrictmagbrightest):
-                                calibStandsReject.append(q)
-                                #logger.info(calibStands[q][3])
+                    # Nothing is removed if there is only one star or if every star would be removed
+                    calibStandsReject=np.zeros(len(calibStands), dtype=bool)
+                    if len(calibStands) > 1:
+                        calibStandsReject=(calibStands[:,3] > restrictmagdimmest) | (calibStands[:,3] < restrictmagbrightest)
+                        if not calibStandsReject.all():
+                            calibStands=calibStands[~calibStandsReject]
 
-                        if len(calibStandsReject) != len(asarray(calibStands)[:,0]):
-                            calibStands=delete(calibStands, calibStandsReject, axis=0)
-
-                    logger.info('Removed ' + str(len(calibStandsReject)) + ' Calibration Stars for being too bright or too dim')
+                    logger.info('Removed ' + str(calibStandsReject.sum()) + ' Calibration Stars for being too bright or too dim')
 
 
                     ### If looking for colour, remove those without matching colour information
-
-                    calibStandsReject=[]
-
-                    if (asarray(calibStands).shape[0] != 9 and asarray(calibStands).size !=9) and calibStands != []:
-                        for q in range(len(asarray(calibStands)[:,0])):
-                            reject=0
-                            if colourdetect == True:
-                                if np.isnan(calibStands[q][6]): # if no matching colour
-                                    reject=1
-                                elif calibStands[q][6] == 0:
-                                    reject=1
-                                elif np.isnan(calibStands[q][7]):
-                                    reject=1
-                                elif calibStands[q][7] == 0:
-                                    reject=1
-                            if np.isnan(calibStands[q][3]): # If no magnitude info
-                                reject=1
-                            elif calibStands[q][3] == 0:
-                                reject=1
-                            elif np.isnan(calibStands[q][4]):
-                                reject=1
-                            elif calibStands[q][4] == 0:
-                                reject=1
-
-                            if reject==1:
-                                calibStandsReject.append(q)
-
-                        if len(calibStandsReject) != len(asarray(calibStands)[:,0]):
-                            calibStands=delete(calibStands, calibStandsReject, axis=0)
+                    if len(calibStands) > 1:
+                        calibStandsReject=isnan(calibStands[:,3]) | (calibStands[:,3] == 0) | isnan(calibStands[:,4]) | (calibStands[:,4] == 0)
+                        if colourdetect == True:
+                            calibStandsReject|=isnan(calibStands[:,6]) | (calibStands[:,6] == 0) | isnan(calibStands[:,7]) | (calibStands[:,7] == 0)
+                        if not calibStandsReject.all():
+                            calibStands=calibStands[~calibStandsReject]
 
                     if asarray(calibStands).shape[0] != 0:
                         logger.info('Calibration Stars Identified below')
@@ -806,11 +806,12 @@ def find_comparisons_calibrated(targets, paths, filterCode, nopanstarrs=False, n
                         coords=[]
                         raise AstrosourceException("There is no adequate match between this catalogue and your comparisons.")
 
-                    if coords !=[] and calibStands !=[]:
+                    if coords !=[] and len(calibStands) != 0:
                         cat_used=cat_name
 
         except AstrosourceException as e:
             logger.debug(e)
+    queries.close()
 
     if not coords:
         raise AstrosourceException(f"Could not find coordinate match in any catalogues for {filterCode}")
@@ -828,7 +829,7 @@ def find_comparisons_calibrated(targets, paths, filterCode, nopanstarrs=False, n
     if colourdetect == True and colourTerm == 0.0:
 
         # use a temporary calibStands array for colour terms
-        arrayCalibStands=np.asarray(calibStands)
+        arrayCalibStands=np.atleast_2d(np.asarray(calibStands))
 
         # MAKE REFERENCE PRE-COLOUR PLOT AND COLOUR TERM ESTIMATE
         referenceFrame = genfromtxt(parentPath / 'referenceFrame.csv', dtype=float, delimiter=',')
@@ -836,38 +837,19 @@ def find_comparisons_calibrated(targets, paths, filterCode, nopanstarrs=False, n
         referenceFrame[:,4]=-2.5 * np.log10(referenceFrame[:,4])
 
         photCoords=SkyCoord(ra=referenceFrame[:,0]*degree, dec=referenceFrame[:,1]*degree)
-        colTemp=[]
-        for q in range(len(arrayCalibStands[:,0])):
-            if arrayCalibStands.size == 13 and arrayCalibStands.shape[0]== 13:
-                calibCoord=SkyCoord(ra=arrayCalibStands[0]*degree,dec=arrayCalibStands[1]*degree)
-                idx,d2d,_=calibCoord.match_to_catalog_sky(photCoords)
-                if colrev == 1:
-                    colTemp.append([arrayCalibStands[3],arrayCalibStands[4],referenceFrame[idx,4],referenceFrame[idx,5],arrayCalibStands[6]-arrayCalibStands[3],0])
-                else:
-                    colTemp.append([arrayCalibStands[3],arrayCalibStands[4],referenceFrame[idx,4],referenceFrame[idx,5],arrayCalibStands[3]-arrayCalibStands[6],0])
-            else:
-                calibCoord=SkyCoord(ra=arrayCalibStands[q][0]*degree,dec=arrayCalibStands[q][1]*degree)
-                idx,d2d,_=calibCoord.match_to_catalog_sky(photCoords)
-                if colrev == 1:
-                    colTemp.append([arrayCalibStands[q,3],arrayCalibStands[q,4],referenceFrame[idx,4],referenceFrame[idx,5],arrayCalibStands[q,6]-arrayCalibStands[q,3],0])
-                else:
-                    colTemp.append([arrayCalibStands[q,3],arrayCalibStands[q,4],referenceFrame[idx,4],referenceFrame[idx,5],arrayCalibStands[q,3]-arrayCalibStands[q,6],0])
-        colTemp=np.asarray(colTemp)
+        idx,d2d,_=SkyCoord(ra=arrayCalibStands[:,0]*degree,dec=arrayCalibStands[:,1]*degree).match_to_catalog_sky(photCoords)
+        colTemp=colour_table(arrayCalibStands, referenceFrame[idx], colrev)
 
 
         # Outlier reject, simple sigma
         while True:
-            calibStandsReject=[]
-            tempmed = (np.median(colTemp[:,2]-colTemp[:,0]))
-            tempstd = (np.std(colTemp[:,2]-colTemp[:,0]))
-            for q in range(len(asarray(colTemp)[:,0])):
-                if colTemp[q,2]-colTemp[q,0] > (tempmed + 2.5*tempstd):
-                    calibStandsReject.append(q)
-                if colTemp[q,2]-colTemp[q,0] < (tempmed - 2.5*tempstd):
-                    calibStandsReject.append(q)
-            if calibStandsReject == []:
+            tempDiff = colTemp[:,2]-colTemp[:,0]
+            tempmed = (np.median(tempDiff))
+            tempstd = (np.std(tempDiff))
+            calibStandsReject = (tempDiff > (tempmed + 2.5*tempstd)) | (tempDiff < (tempmed - 2.5*tempstd))
+            if not calibStandsReject.any():
                 break
-            colTemp=delete(colTemp, calibStandsReject, axis=0)
+            colTemp=colTemp[~calibStandsReject]
 
         # Pre-colour Reference plot
         plt.cla()
@@ -901,9 +883,7 @@ def find_comparisons_calibrated(targets, paths, filterCode, nopanstarrs=False, n
         logger.info('Estimating Colour Slope from all Frames...')
 
 
-        fileList=[]
-        for line in (parentPath / "usedImages.txt").read_text().strip().split('\n'):
-            fileList.append(line.strip())
+        fileList = used_images(parentPath)
 
         z=0
         slopeHolder=[]
@@ -912,7 +892,10 @@ def find_comparisons_calibrated(targets, paths, filterCode, nopanstarrs=False, n
         if not colourPath.exists():
             os.makedirs(colourPath)
 
-        for filen in fileList:
+        # Row of each calibration star in each frame
+        colourIdx, _ = frame_matches(parentPath, arrayCalibStands, fileList, (load(parentPath / filen) for filen in fileList))
+
+        for frameNo, filen in enumerate(fileList):
 
             z=z+1
             photFrame = load(parentPath / filen)
@@ -920,38 +903,17 @@ def find_comparisons_calibrated(targets, paths, filterCode, nopanstarrs=False, n
             photFrame[:,5] = 1.0857 * (photFrame[:,5]/photFrame[:,4])
             photFrame[:,4]=-2.5 * np.log10(photFrame[:,4])
 
-            photCoords=SkyCoord(ra=photFrame[:,0]*degree, dec=photFrame[:,1]*degree)
-            colTemp=[]
-            for q in range(len(arrayCalibStands[:,0])):
-                if arrayCalibStands.size == 13 and arrayCalibStands.shape[0]== 13:
-                    calibCoord=SkyCoord(ra=arrayCalibStands[0]*degree,dec=arrayCalibStands[1]*degree)
-                    idx,d2d,_=calibCoord.match_to_catalog_sky(photCoords)
-                    if colrev == 1:
-                        colTemp.append([arrayCalibStands[3],arrayCalibStands[4],photFrame[idx,4],photFrame[idx,5],arrayCalibStands[6]-arrayCalibStands[3],0])
-                    else:
-                        colTemp.append([arrayCalibStands[3],arrayCalibStands[4],photFrame[idx,4],photFrame[idx,5],arrayCalibStands[3]-arrayCalibStands[6],0])
-                else:
-                    calibCoord=SkyCoord(ra=arrayCalibStands[q][0]*degree,dec=arrayCalibStands[q][1]*degree)
-                    idx,d2d,_=calibCoord.match_to_catalog_sky(photCoords)
-                    if colrev == 1:
-                        colTemp.append([arrayCalibStands[q,3],arrayCalibStands[q,4],photFrame[idx,4],photFrame[idx,5],arrayCalibStands[q,6]-arrayCalibStands[q,3],0])
-                    else:
-                        colTemp.append([arrayCalibStands[q,3],arrayCalibStands[q,4],photFrame[idx,4],photFrame[idx,5],arrayCalibStands[q,3]-arrayCalibStands[q,6],0])
-            colTemp=np.asarray(colTemp)
+            colTemp=colour_table(arrayCalibStands, photFrame[colourIdx[frameNo]], colrev)
 
             # Outlier reject, simple sigma
             while True:
-                calibStandsReject=[]
-                tempmed = (np.median(colTemp[:,2]-colTemp[:,0]))
-                tempstd = (np.std(colTemp[:,2]-colTemp[:,0]))
-                for q in range(len(asarray(colTemp)[:,0])):
-                    if colTemp[q,2]-colTemp[q,0] > (tempmed + 2.5*tempstd):
-                        calibStandsReject.append(q)
-                    if colTemp[q,2]-colTemp[q,0] < (tempmed - 2.5*tempstd):
-                        calibStandsReject.append(q)
-                if calibStandsReject == []:
+                tempDiff = colTemp[:,2]-colTemp[:,0]
+                tempmed = (np.median(tempDiff))
+                tempstd = (np.std(tempDiff))
+                calibStandsReject = (tempDiff > (tempmed + 2.5*tempstd)) | (tempDiff < (tempmed - 2.5*tempstd))
+                if not calibStandsReject.any():
                     break
-                colTemp=delete(colTemp, calibStandsReject, axis=0)
+                colTemp=colTemp[~calibStandsReject]
 
 
             # Colour Term Reference plot
@@ -1062,136 +1024,60 @@ def find_comparisons_calibrated(targets, paths, filterCode, nopanstarrs=False, n
 
     calibStands=asarray(calibStands)
 
-    z=0
-    logger.debug("CALIBRATING EACH FILE")
-    slopeHolder=[]
-    for file in fileList:
-        logger.debug(file)
-
-        #Get the phot file into memory
-        photFile = load(parentPath / file)
-        photCoords=SkyCoord(ra=photFile[:,0]*degree, dec=photFile[:,1]*degree)
-
-        # Get colour information into photFile
-        # adding in colour columns to photfile
-        photFile=np.c_[photFile,np.zeros(len(photFile[:,0])),np.zeros(len(photFile[:,0])),np.zeros(len(photFile[:,0]))]
-
-        for q in range(len(photFile[:,0])):
-            photCoord=SkyCoord(ra=photFile[q][0]*degree, dec=photFile[q][1]*degree)
-            idx,d2d,_=photCoord.match_to_catalog_sky(catCoords)
-
-            if d2d < max_sep:
-                if colrev == 1:
-                    photFile[q,8]=coords.colmatch[idx]-coords.mag[idx]
-                else:
-                    photFile[q,8]=coords.mag[idx]-coords.colmatch[idx]
-                photFile[q,9]=pow(pow(coords.colerr[idx],2)+pow(coords.emag[idx],2),0.5)
-                photFile[q,10]=1
-            else:
-                photFile[q,8]=np.nan
-                photFile[q,9]=np.nan
-                photFile[q,10]=0
-
-        #Replace undetected colours with average colour of the field
-        photFile[:,8]=np.nan_to_num(photFile[:,8],nan=np.nanmedian(photFile[:,8]))
-        photFile[:,9]=np.nan_to_num(photFile[:,9],nan=np.nanmedian(photFile[:,9]))
-
-
-        #Convert the phot file into instrumental magnitudes with colour correction
-        for r in range(len(photFile[:,0])):
-            photFile[r,5]=1.0857 * (photFile[r,5]/photFile[r,4])
-            if not np.isnan(photFile[r,8]):
-                photFile[r,4]=-2.5*log10(photFile[r,4]) -(colourTerm*photFile[r,8])
-            else:
-                photFile[r,4]=-2.5*log10(photFile[r,4])
-                photFile[r,10]=2 # 2 means that there was no colour to use to embed the colour.
-
-        #Pull out the CalibStands out of each file
-
-        tempDiff=[]
-        calibOut=[]
-        for q in range(len(calibStands[:,0])):
-            if calibStands.size == 13 and calibStands.shape[0]== 13:
-                calibCoord=SkyCoord(ra=calibStands[0]*degree,dec=calibStands[1]*degree)
-                idx,d2d,_=calibCoord.match_to_catalog_sky(photCoords)
-                if photFile[idx,10] != 0:
-                    tempDiff.append(calibStands[3]-(photFile[idx,4]))
-                    calibOut.append([calibStands[3],calibStands[4],photFile[idx,4],photFile[idx,5],calibStands[3]-(photFile[idx,4]),0,photFile[idx,8],photFile[idx,0],photFile[idx,1]])
-            else:
-                calibCoord=SkyCoord(ra=calibStands[q][0]*degree,dec=calibStands[q][1]*degree)
-                idx,d2d,_=calibCoord.match_to_catalog_sky(photCoords)
-                if photFile[idx,10] != 0:
-                    tempDiff.append(calibStands[q,3]-(photFile[idx,4]))
-                    calibOut.append([calibStands[q,3],calibStands[q,4],photFile[idx,4],photFile[idx,5],calibStands[q,3]-(photFile[idx,4]),0,photFile[idx,8],photFile[idx,0],photFile[idx,1]])
-        tempZP= (median(tempDiff))
-
-        #Shift the magnitudes in the phot file by the zeropoint
-        for r in range(len(photFile[:,0])):
-            photFile[r,4]=photFile[r,4]+tempZP
-
-        calibOut=asarray(calibOut)
-
-        #Shift the magnitudes in the phot file by the zeropoint
-
-        for r in range(len(calibOut[:,0])):
-            calibOut[r,5]=calibOut[r,4]-tempZP
-            calibOverlord.append([calibOut[r,0],calibOut[r,1],calibOut[r,2],calibOut[r,3],calibOut[r,4],calibOut[r,5],float(file.split("_")[2].replace("d",".")),tempZP,calibOut[r,6],calibOut[r,7],calibOut[r,8]])
-
-        file = Path(file)
-        #Save the calibrated photfiles to the calib directory
-        savetxt(calibPath / "{}.calibrated.{}".format(file.stem, 'csv'), photFile, delimiter=",", fmt='%0.8f')
-        savetxt(calibPath / "{}.compared.{}".format(file.stem, 'csv'), calibOut, delimiter=",", fmt='%0.8f')
-
-
-        #PRINT POSTCOLOUR CORRECTION PLOTS
-        if colourdetect == True and (not np.all(np.isnan(photFile[:,8]))):
-            # Colour Term Reference plot
-            plt.cla()
-            fig = plt.gcf()
-            outplotx=calibOut[:,6]
-            outploty=calibOut[:,2]-calibOut[:,0]
-            #Weighted fit, weighted by error in this dataset
-            weights=1/(calibOut[:,1])
-            linA = np.vstack([outplotx,np.ones(len(outplotx))]).T * np.sqrt(weights[:,np.newaxis])
-            linB = outploty * np.sqrt(weights)
-            sqsol = np.linalg.lstsq(linA,linB, rcond=None)
-            m, c = sqsol[0]
-            x, residuals, rank, s = sqsol
-
-            plt.xlabel(colname + ' Catalogue Colour')
-            plt.ylabel('Instrumental - Calibrated ' + str(filterCode) + ' Mag')
-            plt.plot(outplotx,outploty,'bo')
-            plt.plot(outplotx,m*outplotx+c,'r')
-            plt.ylim(max(outploty)+0.05,min(outploty)-0.05,'k-')
-            plt.xlim(min(outplotx)-0.05,max(outplotx)+0.05)
-            plt.errorbar(outplotx, outploty, yerr=calibOut[:,1], fmt='-o', linestyle='None')
-            plt.grid(True)
-            plt.subplots_adjust(left=0.15, right=0.98, top=0.98, bottom=0.17, wspace=0.3, hspace=0.4)
-            fig.set_size_inches(6,3)
-            plt.savefig(colourPath / str("CalibrationSanityPlot_Colour_" + str(z) + "_Post.png"))
-            plt.savefig(colourPath  / str("CalibrationSanityPlot_Colour_" + str(z) + "_Post.eps"))
-            z=z+1
-            slopeHolder.append(m)
-
-        #Look within photfile for ACTUAL usedcomps.csv and pull them out
-        lineCompUsed=[]
-        if compUsedFile.shape[0] ==3 and compUsedFile.size == 3:
-            lenloop=1
-        else:
-            lenloop=len(compUsedFile[:,0])
-
-        for r in range(lenloop):
-            if compUsedFile.shape[0] ==3 and compUsedFile.size ==3:
-                compUsedCoord=SkyCoord(ra=compUsedFile[0]*degree,dec=compUsedFile[1]*degree)
-            else:
-                compUsedCoord=SkyCoord(ra=compUsedFile[r][0]*degree,dec=compUsedFile[r][1]*degree)
-            idx,d2d,_=compUsedCoord.match_to_catalog_sky(photCoords)
-            lineCompUsed.append(photFile[idx,4])
+    # Row of each calibration standard and each used comparison in each frame
+    calibIdx, _ = frame_matches(parentPath, calibStands, fileList, (load(parentPath / file) for file in fileList))
+    compUsedIdx, _ = frame_matches(parentPath, compUsedFile, fileList, (load(parentPath / file) for file in fileList))
 
-        calibCompUsed.append(lineCompUsed)
-        sys.stdout.write('.')
-        sys.stdout.flush()
+    # The store is discarded if a frame fails, rather than left half written without its index
+    with CalibratedStore.create(calibPath) as calibStore:
+        z=0
+        logger.debug("CALIBRATING EACH FILE")
+        slopeHolder=[]
+        for frameNo, file in enumerate(fileList):
+            logger.debug(file)
 
+            photFile, calibOut, tempZP = calibrate_frame(load(parentPath / file), catCoords, coords, max_sep, colrev, colourTerm, calibStands, calibIdx[frameNo])
+            frameTime = float(Path(file).name.split("_")[2].replace("d","."))
+            calibOverlord.append(np.c_[calibOut[:,0:6], np.full(len(calibOut), frameTime), np.full(len(calibOut), tempZP), calibOut[:,6:9]])
+
+            #Save the calibrated photfiles to the calib store
+            calibStore.append(file, photFile, calibOut)
+
+
+            #PRINT POSTCOLOUR CORRECTION PLOTS
+            if colourdetect == True and (not np.all(np.isnan(photFile[:,8]))):
+                # Colour Term Reference plot
+                plt.cla()
+                fig = plt.gcf()
+                outplotx=calibOut[:,6]
+                outploty=calibOut[:,2]-calibOut[:,0]
+                #Weighted fit, weighted by error in this dataset
+                weights=1/(calibOut[:,1])
+                linA = np.vstack([outplotx,np.ones(len(outplotx))]).T * np.sqrt(weights[:,np.newaxis])
+                linB = outploty * np.sqrt(weights)
+                sqsol = np.linalg.lstsq(linA,linB, rcond=None)
+                m, c = sqsol[0]
+                x, residuals, rank, s = sqsol
+
+                plt.xlabel(colname + ' Catalogue Colour')
+                plt.ylabel('Instrumental - Calibrated ' + str(filterCode) + ' Mag')
+                plt.plot(outplotx,outploty,'bo')
+                plt.plot(outplotx,m*outplotx+c,'r')
+                plt.ylim(max(outploty)+0.05,min(outploty)-0.05,'k-')
+                plt.xlim(min(outplotx)-0.05,max(outplotx)+0.05)
+                plt.errorbar(outplotx, outploty, yerr=calibOut[:,1], fmt='-o', linestyle='None')
+                plt.grid(True)
+                plt.subplots_adjust(left=0.15, right=0.98, top=0.98, bottom=0.17, wspace=0.3, hspace=0.4)
+                fig.set_size_inches(6,3)
+                plt.savefig(colourPath / str("CalibrationSanityPlot_Colour_" + str(z) + "_Post.png"))
+                plt.savefig(colourPath  / str("CalibrationSanityPlot_Colour_" + str(z) + "_Post.eps"))
+                z=z+1
+                slopeHolder.append(m)
+
+            #Look within photfile for ACTUAL usedcomps.csv and pull them out
+            calibCompUsed.append(photFile[compUsedIdx[frameNo],4])
+            sys.stdout.write('.')
+            sys.stdout.flush()
 
     # Reject outliers in colour slope
     if colourdetect == True:
@@ -1234,7 +1120,7 @@ def find_comparisons_calibrated(targets, paths, filterCode, nopanstarrs=False, n
         plt.savefig(parentPath / str("CalibrationSanityPlot_CORRECTEDColourTermHistogram.png"))
         plt.savefig(parentPath / str("CalibrationSanityPlot_CORRECTEDColourTermHistogram.eps"))
 
-    calibOverlord=asarray(calibOverlord)
+    calibOverlord=np.vstack(calibOverlord)
     savetxt(parentPath / "CalibAll.csv", calibOverlord, delimiter=",", fmt='%0.8f')
 
 
@@ -1354,20 +1240,15 @@ def find_comparisons_calibrated(targets, paths, filterCode, nopanstarrs=False, n
         plt.savefig(parentPath / str("CalibrationSanityPlotLinearityCorrected_Magnitude.eps"))
 
         # Add correction into calibrated files
-        z=0
+        # NEED TO FIX UP COMPARED!
         logger.debug("CORRECTING EACH FILE FOR NONLINEARITY")
-        correctFileList = calibPath.glob("*.calibrated.csv")
-        for file in correctFileList:
-            logger.debug(file)
-
-            # NEED TO FIX UP COMPARED!
-
-            photFile = genfromtxt(file, dtype=float, delimiter=',')
-
-            for q in range(len(photFile[:,0])):
-                photFile[q,4]=photFile[q,4] - nonlinearSlope*photFile[q,4]+nonlinearZero
+        calibratedTable=calibStore.calibrated_table(mode='r+')
+        calibratedTable[:,4]=calibratedTable[:,4] - nonlinearSlope*calibratedTable[:,4]+nonlinearZero
+        calibratedTable.flush()
+        del calibratedTable
 
-            savetxt(file, photFile, delimiter=",", fmt='%0.8f')
+    if exportCsv:
+        calibStore.export_csv()
 
     # Difference vs time calibration plot
     try:
@@ -0,0 +1,190 @@
+from collections import namedtuple
+from pathlib import Path
+
+from numpy import asarray, atleast_2d, vstack, zeros, full, nan, ix_, load, savez
+from astropy.units import degree
+from astropy.coordinates import SkyCoord
+
+import logging
+
+logger = logging.getLogger('astrosource')
+
+# Cross-matching of a list of stars against photometry frames.
+#
+# Each frame is turned into a single SkyCoord catalogue (astropy builds and caches a KD-tree for it on the first
+# match) and every requested star is matched against it in one call, rather than building a new catalogue and
+# matching one star at a time.
+
+# The match index (matchIndex.npz, written next to usedImages.txt by find_stars) stores the row of every
+# catalogued star in every used frame, so later stages only need to index into it.
+MATCH_INDEX_FILE = "matchIndex.npz"
+
+MatchIndex = namedtuple('MatchIndex', ['stars', 'files', 'idx', 'sep'])
+
+
+def star_coords(stars):
+    '''
+    Turn an array of stars (RA and Dec in the first two columns, decimal degrees) into a SkyCoord.
+    A single star given as a 1D row is accepted as well.
+    '''
+    stars = atleast_2d(asarray(stars, dtype=float))
+    return SkyCoord(ra=stars[:,0]*degree, dec=stars[:,1]*degree)
+
+
+def match_frame(starCoords, photFile):
+    '''
+    Match every star in starCoords against a single photometry frame
+
+    Parameters
+    ----------
+    starCoords : SkyCoord
+            Stars to look for, as returned by star_coords
+    photFile : numpy array
+            Photometry frame with RA and Dec in the first two columns
+
+    Returns
+    -------
+    idx : numpy array
+            Row in photFile of the nearest source to each star
+    d2d : numpy array
+            Separation to that source in arcseconds
+    '''
+    fileRaDec = SkyCoord(ra=photFile[:,0]*degree, dec=photFile[:,1]*degree)
+    idx, d2d, _ = starCoords.match_to_catalog_sky(fileRaDec)
+    return idx, d2d.arcsecond
+
+
+def presence_matrix(stars, photFileArray, acceptDistance=1.0):
+    '''
+    Find which stars are detected in which frames
+
+    Parameters
+    ----------
+    stars : numpy array
+            Stars to look for with RA and Dec in the first two columns
+    photFileArray : iterable
+            Photometry frames. Any iterable works, so frames can be loaded lazily one at a time. A frame of None
+            is one that cannot be matched, and no star is present in it.
+    acceptDistance : float
+            Furthest distance in arcseconds for a match
+
+    Returns
+    -------
+    present : numpy array
+            Boolean array of shape (frames, stars). True where the star has a source within acceptDistance.
+    '''
+    starCoords = star_coords(stars)
+    rows = []
+    for photFile in photFileArray:
+        if photFile is None:
+            rows.append(zeros(len(starCoords), dtype=bool))
+            continue
+        _, d2d = match_frame(starCoords, photFile)
+        rows.append(d2d <= acceptDistance)
+    if not rows:
+        return zeros((0, len(starCoords)), dtype=bool)
+    return vstack(rows)
+
+
+def build_match_index(stars, photFileArray):
+    '''
+    Find the row of every star in every frame
+
+    Parameters
+    ----------
+    stars : numpy array
+            Stars to look for with RA and Dec in the first two columns
+    photFileArray : iterable
+            Photometry frames
+
+    Returns
+    -------
+    idx : numpy array
+            Integer array of shape (frames, stars) holding the row of the nearest source in each frame
+    sep : numpy array
+            Separation in arcseconds to that source, same shape as idx
+    '''
+    starCoords = star_coords(stars)
+    idxRows = []
+    sepRows = []
+    for photFile in photFileArray:
+        idx, d2d = match_frame(starCoords, photFile)
+        idxRows.append(idx)
+        sepRows.append(d2d)
+    if not idxRows:
+        return zeros((0, len(starCoords)), dtype=int), zeros((0, len(starCoords)))
+    return vstack(idxRows), vstack(sepRows)
+
+
+def save_match_index(parentPath, stars, fileList, photFileArray):
+    '''
+    Build the match index for stars over the frames in fileList and save it to matchIndex.npz in parentPath
+    '''
+    stars = atleast_2d(asarray(stars, dtype=float))[:,0:2]
+    files = asarray([Path(f).name for f in fileList])
+    idx, sep = build_match_index(stars, photFileArray)
+    savez(parentPath / MATCH_INDEX_FILE, stars=stars, files=files, idx=idx, sep=sep)
+    logger.info("Match index of {} stars over {} frames saved to {}".format(stars.shape[0], files.shape[0], MATCH_INDEX_FILE))
+    return MatchIndex(stars, files, idx, sep)
+
+
+def load_match_index(parentPath):
+    '''
+    Load matchIndex.npz from parentPath. Returns None if there is no index.
+    '''
+    if not parentPath or not (Path(parentPath) / MATCH_INDEX_FILE).exists():
+        return None
+    with load(Path(parentPath) / MATCH_INDEX_FILE) as data:
+        return MatchIndex(data['stars'], data['files'], data['idx'], data['sep'])
+
+
+def frame_matches(parentPath, stars, fileList, photFileArray, tolerance=0.01):
+    '''
+    Row and separation of each star in each frame
+
+    Stars and frames that are in the saved match index are looked up from it. A star counts as being in the
+    index when it is within tolerance arcseconds of an indexed star. Anything else is matched directly.
+
+    Parameters
+    ----------
+    parentPath : Path or None
+            Directory holding matchIndex.npz
+    stars : numpy array
+            Stars to look for with RA and Dec in the first two columns
+    fileList : list
+            Names of the frames in photFileArray, in the same order
+    photFileArray : list
+            Photometry frames
+
+    Returns
+    -------
+    idx, sep : numpy array
+            Arrays of shape (frames, stars) as for build_match_index
+    '''
+    stars = atleast_2d(asarray(stars, dtype=float))
+    fileNames = [Path(f).name for f in fileList]
+    idx = zeros((len(fileNames), stars.shape[0]), dtype=int)
+    sep = full((len(fileNames), stars.shape[0]), nan)
+    found = zeros(stars.shape[0], dtype=bool)
+    frameFound = zeros(len(fileNames), dtype=bool)
+
+    matchIndex = load_match_index(parentPath)
+    if matchIndex is not None and matchIndex.stars.shape[0] > 0 and stars.shape[0] > 0:
+        indexRow = {name: row for row, name in enumerate(matchIndex.files)}
+        frameRows = asarray([indexRow.get(name, -1) for name in fileNames], dtype=int)
+        frameFound = frameRows >= 0
+        col, d2d = match_frame(star_coords(stars), matchIndex.stars)
+        found = d2d < tolerance
+        idx[ix_(frameFound, found)] = matchIndex.idx[ix_(frameRows[frameFound], col[found])]
+        sep[ix_(frameFound, found)] = matchIndex.sep[ix_(frameRows[frameFound], col[found])]
+
+    if stars.shape[0] > 0 and not (found.all() and frameFound.all()):
+        logger.debug("Matching {} stars not in the match index".format((~found).sum()))
+        allCoords = star_coords(stars)
+        missingCoords = star_coords(stars[~found]) if (~found).any() else None
+        for q, photFile in enumerate(photFileArray):
+            if not frameFound[q]:
+                idx[q], sep[q] = match_frame(allCoords, photFile)
+            elif missingCoords is not None:
+                idx[q, ~found], sep[q, ~found] = match_frame(missingCoords, photFile)
+    return idx, sep
@@ -0,0 +1,149 @@
+from collections import namedtuple
+from pathlib import Path
+
+from numpy import asarray, atleast_2d, zeros, full, nan, argmax, load, save, savez
+
+from astrosource.crossmatch import frame_matches, star_coords, match_frame
+from astrosource.utils import AstrosourceException
+
+import logging
+
+logger = logging.getLogger('astrosource')
+
+# The photometry cube holds the measurements of a fixed list of stars in every used frame as one dense array of
+# shape (frames, stars, fields), so stages can work on whole columns rather than reopening every .npy frame and
+# matching star by star. The fields are the first six columns of a photometry frame, in the same order, so
+# cube.data[frame, star, 4] is the same number as photFile[idx][4].
+#
+# The measurement array is saved in .npy format to photometryCube.dat (not .npy, so it is never mistaken for a
+# photometry frame) and can be memory-mapped. Everything else is saved to photometryCube.npz.
+
+CUBE_FIELDS = ('ra', 'dec', 'x', 'y', 'counts', 'countserr')
+CUBE_FILE = "photometryCube.dat"
+CUBE_META_FILE = "photometryCube.npz"
+
+PhotometryCube = namedtuple('PhotometryCube', ['stars', 'files', 'data', 'sep', 'time', 'airmass', 'exptime', 'sources'])
+
+
+def frame_metadata(fileList):
+    '''
+    Read the time, airmass and exposure time of each frame from its filename (see identify.rename_data_file).
+    Anything that cannot be read is set to nan.
+    '''
+    time = full(len(fileList), nan)
+    airmass = full(len(fileList), nan)
+    exptime = full(len(fileList), nan)
+    for q, filen in enumerate(fileList):
+        parts = Path(filen).name.split("_")
+        try:
+            time[q] = float(parts[2].replace("d","."))
+            airmass[q] = float(parts[4].replace("a","."))
+            exptime[q] = float(parts[5].replace("d","."))
+        except (IndexError, ValueError):
+            logger.debug("Could not read frame metadata from {}".format(filen))
+    return time, airmass, exptime
+
+
+def build_cube(parentPath, stars, fileList, photFileArray=None):
+    '''
+    Extract every star in stars from every frame into a photometry cube
+
+    Parameters
+    ----------
+    parentPath : Path
+            Path to the data files and the match index
+    stars : numpy array
+            Stars to extract with RA and Dec in the first two columns
+    fileList : list
+            Frames to use, in order
+    photFileArray : list
+            Already loaded frames matching fileList. The frames are loaded one at a time from parentPath if not given.
+
+    Returns
+    -------
+    cube : PhotometryCube
+            The measurements of the nearest source to each star in each frame, with its separation in arcseconds
+            in cube.sep. No distance cut is made, that is up to the stage using the cube.
+    '''
+    fileList = [str(f) for f in fileList]
+    if not fileList:
+        raise AstrosourceException("No input files")
+    stars = atleast_2d(asarray(stars, dtype=float))[:,0:2]
+    if photFileArray is None:
+        photFileArray = [load(parentPath / filen) for filen in fileList]
+
+    idx, sep = frame_matches(parentPath, stars, fileList, photFileArray)
+    data = zeros((len(fileList), stars.shape[0], len(CUBE_FIELDS)))
+    sources = zeros(len(fileList), dtype=int)
+    for q, photFile in enumerate(photFileArray):
+        data[q] = photFile[idx[q], 0:len(CUBE_FIELDS)]
+        sources[q] = photFile.shape[0]
+    time, airmass, exptime = frame_metadata(fileList)
+    logger.debug("Photometry cube of {} stars over {} frames".format(stars.shape[0], len(fileList)))
+    return PhotometryCube(stars, asarray(fileList), data, sep, time, airmass, exptime, sources)
+
+
+def save_cube(parentPath, cube):
+    '''
+    Save a photometry cube to parentPath
+    '''
+    with open(parentPath / CUBE_FILE, 'wb') as f:
+        save(f, cube.data)
+    savez(parentPath / CUBE_META_FILE, stars=cube.stars, files=cube.files, sep=cube.sep, time=cube.time,
+          airmass=cube.airmass, exptime=cube.exptime, sources=cube.sources)
+    logger.info("Photometry cube saved to {}".format(CUBE_FILE))
+
+
+def load_cube(parentPath, mmap_mode='r'):
+    '''
+    Load the photometry cube saved in parentPath, memory-mapping the measurements by default.
+    Returns None if there is no cube.
+    '''
+    if not (Path(parentPath) / CUBE_FILE).exists() or not (Path(parentPath) / CUBE_META_FILE).exists():
+        return None
+    data = load(Path(parentPath) / CUBE_FILE, mmap_mode=mmap_mode)
+    with load(Path(parentPath) / CUBE_META_FILE) as meta:
+        return PhotometryCube(meta['stars'], meta['files'], data, meta['sep'], meta['time'], meta['airmass'],
+                              meta['exptime'], meta['sources'])
+
+
+def reference_row(cube):
+    '''
+    Row of the frame with the most sources, the first one if there is a tie
+    '''
+    return int(argmax(cube.sources))
+
+
+def cube_stars(cube, stars, parentPath=None, tolerance=0.01):
+    '''
+    Measurements of a list of stars, taken from the cube
+
+    Stars that are not in the cube (further than tolerance arcseconds from every star in it) are matched directly
+    against the frames, loaded one at a time from parentPath.
+
+    Returns
+    -------
+    data : numpy array
+            Array of shape (frames, stars, fields)
+    sep : numpy array
+            Array of shape (frames, stars) with the separation of each match in arcseconds
+    '''
+    stars = atleast_2d(asarray(stars, dtype=float))
+    data = zeros((cube.data.shape[0], stars.shape[0], len(CUBE_FIELDS)))
+    sep = full((cube.data.shape[0], stars.shape[0]), nan)
+    if stars.shape[0] == 0:
+        return data, sep
+    col = zeros(stars.shape[0], dtype=int)
+    found = zeros(stars.shape[0], dtype=bool)
+    if cube.stars.shape[0] > 0:
+        col, d2d = match_frame(star_coords(stars), cube.stars)
+        found = d2d < tolerance
+    data[:, found] = cube.data[:, col[found]]
+    sep[:, found] = cube.sep[:, col[found]]
+    if not found.all():
+        if parentPath is None:
+            raise AstrosourceException("{} stars are not in the photometry cube".format((~found).sum()))
+        missing = build_cube(parentPath, stars[~found], cube.files)
+        data[:, ~found] = missing.data
+        sep[:, ~found] = missing.sep
+    return data, sep
@@ -3,16 +3,17 @@ import os
 import logging
 import matplotlib.pyplot as plt
 from numpy import median, zeros, nan, nanmedian, sqrt, mean, std, loadtxt, linspace, \
-    zeros_like, divide, asarray
+    zeros_like, divide, asarray, full
 from astropy.constants import G, R_sun, M_sun, R_jup, M_jup, R_earth, M_earth
 from astropy.coordinates import SkyCoord
 from pathlib import Path
 
 from astrosource.utils import AstrosourceException
+from astrosource.periodic import trial_grid
 
 logger = logging.getLogger('astrosource')
 
-def bls(t, x, qmi, qma, fmin, df, nf, nb, startPeriod, dp):
+def bls(t, x, qmi, qma, fmin, df, nf, nb, startPeriod, dp, periods=None):
     """First trial, BLS algorithm, only minor modification from author's code
      Output parameters:
      ~~~~~~~~~~~~~~~~~~
@@ -28,6 +29,8 @@ def bls(t, x, qmi, qma, fmin, df, nf, nb, startPeriod, dp):
      Remarks:
      ~~~~~~~~
      -- *fmin* MUST be greater than  *1/total time span*
+     -- If *periods* is given, those trial periods are used in place of
+        *startPeriod* + (i-1)*dp, and *nf* is its length
      -- *nb*   MUST be lower than  *nbmax*
      -- Dimensions of arrays {y(i)} and {ibi(i)} MUST be greater than
         or equal to  *nbmax*.
@@ -67,6 +70,8 @@ def bls(t, x, qmi, qma, fmin, df, nf, nb, startPeriod, dp):
     s = median(x) # ! Modified
     v = x - s
     bpow = 0.0
+    if periods is not None:
+        nf = len(periods)
     p = zeros(nf)
     # setup array for power vs period plot
     powerPeriod=[]
@@ -75,14 +80,14 @@ def bls(t, x, qmi, qma, fmin, df, nf, nb, startPeriod, dp):
         #f0 = fmin + df*jf # iteration in frequency not period
         #p0 = 1.0/f0
         # Actually iterate in period
-        p0 = startPeriod + dp*jf
+        p0 = startPeriod + dp*jf if periods is None else periods[jf]
         f0 = 1.0/p0
         # Compute folded time series with p0 period
         ibi = zeros(nbkma)
         y = zeros(nbkma)
         # Median version
-        yMedian = zeros(shape=(nf,n))
-        yMedian.fill(nan)
+        # Times before t[0] give negative bins, which land in the last nb rows and are left out of the medians
+        yMedian = full((nb1 + nb,n), nan)
         for i in range(n):
             ph = u[i]*f0 # instead of t mod P, he use t*f then calculate the phase (less computation)
             ph = ph - int(ph)
@@ -142,7 +147,7 @@ def bls(t, x, qmi, qma, fmin, df, nf, nb, startPeriod, dp):
     sde = (bpow - mean(p))/std(p) # signal detection efficiency
     return bpow, in1, in2, qtran, depth, bper, sde, p, high, low, powerPeriod
 
-def plot_bls(paths, startPeriod=0.1, endPeriod=3.0, nf=1000, nb=200, qmi=0.01, qma=0.1):
+def plot_bls(paths, startPeriod=0.1, endPeriod=3.0, nf=1000, nb=200, qmi=0.01, qma=0.1, oversampling=None):
     '''
      Input parameters:
      ~~~~~~~~~~~~~~~~~
@@ -159,6 +164,9 @@ def plot_bls(paths, startPeriod=0.1, endPeriod=3.0, nf=1000, nb=200, qmi=0.01, q
      qmi  = minimum fractional transit length to be tested
      qma  = maximum fractional transit length to be tested
      paths = dict of Path objects
+     oversampling = if given, the trial periods are those of trial_grid with
+            this oversampling, evenly spaced in frequency, in place of nf
+            evenly spaced periods
     '''
     # Get list of phot files
     trimPath = paths['parent'] / "trimcats"
@@ -181,7 +189,10 @@ def plot_bls(paths, startPeriod=0.1, endPeriod=3.0, nf=1000, nb=200, qmi=0.01, q
         logger.debug(f'Testing: {filename}')
         t = photFile[:,0]
         f = photFile[:,1]
-        res = bls(t, f, qmi, qma, fmin, df, nf, nb, startPeriod, dp)
+        periods = None
+        if oversampling:
+            periods = 1.0 / trial_grid(t, startPeriod, endPeriod, oversampling).frequencies[::-1]
+        res = bls(t, f, qmi, qma, fmin, df, nf, nb, startPeriod, dp, periods=periods)
         if not res:
             raise AstrosourceException("BLS fit failed")
         else: # If it did not fail, then do the rest.
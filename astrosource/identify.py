@@ -1,22 +1,29 @@
 import glob
+from itertools import islice
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import sys
 import os
 import logging
 
-from numpy import genfromtxt, delete, asarray, save, savetxt, load, transpose, isnan, zeros
+from numpy import genfromtxt, loadtxt, fmax, delete, asarray, save, savetxt, load, transpose, isnan, zeros, arange, where, vstack, atleast_2d
 from astropy import units as u
 from astropy import wcs
 from astropy.coordinates import SkyCoord, EarthLocation
 from astropy.io import fits
 from astropy.time import Time
+from astropy.utils import iers
 from barycorrpy import utc_tdb
 
-from astrosource.utils import AstrosourceException
+from astrosource.crossmatch import presence_matrix, save_match_index
+from astrosource.utils import AstrosourceException, load_manifest, save_manifest, manifest_entry, update_manifest
 
 logger = logging.getLogger('astrosource')
 
-def rename_data_file(prihdr, bjd=False):
+# Rows of a csv photometry file read and filtered at a time
+PHOTOMETRY_CHUNK_ROWS = 100000
+
+def rename_data_file(prihdr, bjd=False, bjdTime=None):
 
     prihdrkeys = prihdr.keys()
 
@@ -45,6 +52,8 @@ def rename_data_file(prihdr, bjd=False):
 
     if (prihdr['MJD-OBS'] == 'UNKNOWN'):
         timeobs = 'UNKNOWN'
+    elif bjd and bjdTime is not None:
+        timeobs = bjdTime
     elif bjd:
         timeobs = convert_mjd_bjd(prihdr)
     else:
@@ -53,34 +62,101 @@ def rename_data_file(prihdr, bjd=False):
 
     return newName
 
-def export_photometry_files(filelist, indir, filetype='csv', bjd=False):
+def export_photometry_files(filelist, indir, filetype='csv', bjd=False, workers=1):
+    '''
+    Extract the photometry of each image into a .npy file in indir
+
+    Parameters
+    ----------
+    filelist : list
+            Image files, either paths or open-able objects (e.g. files from S3)
+    indir : Path
+            Directory to write the photometry files to
+    bjd : bool
+            Convert the MJD time into BJD time. The conversion is done for all the images in one batch before they
+            are extracted (see batch_mjd_bjd).
+    workers : int
+            Number of processes to extract the images with. Images that are not plain paths are always extracted
+            in this process.
+
+    Returns
+    -------
+    phot_dict : dict
+            Photometry filename for each image, in the same order as filelist. Images that are unchanged since
+            they were last extracted (see utils.manifest_entry) are not extracted again. An image that cannot be
+            extracted is logged and skipped.
+    '''
     phot_dict = {}
+    files = []
     for f in filelist:
-        s3 = False
         try:
-            fitsobj = Path(f)
+            files.append(Path(f))
         except TypeError:
-            fitsobj = f.open()
-            s3 = True
-
-        filepath = extract_photometry(fitsobj, indir, bjd=bjd)
-        if s3:
-            f.close()
+            files.append(f)
+
+    manifest = load_manifest(indir)
+    pathResults = {}
+    for f in files:
+        if isinstance(f, Path):
+            entry = manifest_entry(manifest, f, indir, bjd=bjd)
+            if entry is not None:
+                pathResults[f] = indir / entry['output']
+    if pathResults:
+        logger.info("{} images are unchanged since they were extracted".format(len(pathResults)))
+    paths = [f for f in files if isinstance(f, Path) and f not in pathResults]
+
+    bjdTimes = {}
+    if bjd and paths:
+        bjdTimes = image_bjd_times(paths)
+
+    if workers > 1 and len(paths) > 1:
+        logger.info("Extracting photometry from {} images with {} workers".format(len(paths), workers))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(_extract_or_error, paths, [indir]*len(paths), [bjd]*len(paths), [bjdTimes.get(f) for f in paths])
+            for f, result in zip(paths, results):
+                pathResults[f] = result
+
+    extracted = set(paths)
+    failed = 0
+    for f in files:
+        if f in pathResults:
+            filepath = pathResults[f]
             filename = f.name
         else:
-            filename = fitsobj.name
+            s3 = not isinstance(f, Path)
+            fitsobj = f.open() if s3 else f
+            filepath = _extract_or_error(fitsobj, indir, bjd, bjdTimes.get(f))
+            if s3:
+                fitsobj.close()
+            filename = f.name
+        if isinstance(filepath, Exception):
+            logger.error("Could not extract photometry from {}: {}".format(filename, filepath))
+            failed += 1
+            continue
+        if isinstance(f, Path) and f in extracted:
+            update_manifest(manifest, f, Path(filepath).name, bjd=bjd)
         phot_dict[Path(filepath).name] = filename
 
-
+    if any(isinstance(f, Path) for f in files):
+        save_manifest(indir, manifest)
+    if failed:
+        sys.stdout.write("⚠️ Photometry could not be extracted from {} of {} images\n".format(failed, len(files)))
 
     return phot_dict
 
-def extract_photometry(infile, parentPath, outfile=None, bjd=False):
+def _extract_or_error(infile, parentPath, bjd, bjdTime=None):
+    # Run extract_photometry, returning the exception instead of raising it so one bad image does not stop a batch
+    try:
+        return extract_photometry(infile, parentPath, bjd=bjd, bjdTime=bjdTime)
+    except Exception as e:
+        return e
+
+def extract_photometry(infile, parentPath, outfile=None, bjd=False, bjdTime=None):
 
     with fits.open(infile) as hdulist:
 
         if not outfile:
-            outfile = rename_data_file(hdulist[1].header, bjd=bjd)
+            outfile = rename_data_file(hdulist[1].header, bjd=bjd, bjdTime=bjdTime)
         outfile = parentPath / outfile
         w = wcs.WCS(hdulist[1].header)
         data = hdulist[2].data
@@ -96,30 +172,148 @@ def extract_photometry(infile, parentPath, outfile=None, bjd=False):
 
     return outfile
 
-def convert_photometry_files(filelist):
+def convert_photometry_files(filelist, cachePath=None):
+    '''
+    Convert csv photometry files (ra, dec, x, y, counts, countserr, ...) into .npy photometry files
+
+    Parameters
+    ----------
+    filelist : list
+            Photometry files to convert. They are read one at a time, PHOTOMETRY_CHUNK_ROWS rows at a time.
+    cachePath : Path
+            Directory to write the .npy files to. By default each one is written next to its input.
+
+    Returns
+    -------
+    new_files : list
+            Names of the .npy files, or their full paths if they were written to cachePath
+    '''
     new_files = []
+    if cachePath:
+        # Cached files are listed by absolute path, so they load whatever directory the pipeline is run from
+        cachePath = Path(cachePath).resolve()
+        cachePath.mkdir(parents=True, exist_ok=True)
+    # Each photometry file is recorded in the manifest of the directory it is written to
+    manifests = {}
     for fn in filelist:
-        photFile = genfromtxt(fn, dtype=float, delimiter=',')
-        # reject nan entries in file
-        if photFile.size > 16: #ignore zero sized files and files with only one or two entries
-            if max(photFile[:,0]) < 360 and max(photFile[:,1]) < 90:
-                photFile=photFile[~isnan(photFile).any(axis=1)]
-                filepath = Path(fn).with_suffix('.npy')
+        outPath = Path(cachePath) if cachePath else Path(fn).parent
+        if outPath not in manifests:
+            manifests[outPath] = load_manifest(outPath)
+        entry = manifest_entry(manifests[outPath], fn, outPath)
+        if entry is not None:
+            if entry['output']:
+                new_files.append(str(outPath / entry['output']) if cachePath else entry['output'])
+            continue
+        output = None
+        # Largest RA and Dec of the whole file, nan if it starts with nan, and the rows of each chunk without nan
+        size = 0
+        radecMax = None
+        photChunks = []
+        for photChunk in read_photometry_csv(fn, PHOTOMETRY_CHUNK_ROWS):
+            if size == 0:
+                firstRaDec = photChunk[0, 0:2]
+            size += photChunk.size
+            chunkMax = fmax.reduce(photChunk[:, 0:2], axis=0)
+            radecMax = chunkMax if radecMax is None else fmax(radecMax, chunkMax)
+            # reject nan entries in file
+            photChunks.append(photChunk[~isnan(photChunk).any(axis=1)])
+        if size > 16: #ignore zero sized files and files with only one or two entries
+            radecMax = where(isnan(firstRaDec), firstRaDec, radecMax)
+            if radecMax[0] < 360 and radecMax[1] < 90:
+                photFile = vstack(photChunks)
+                filepath = outPath / Path(fn).with_suffix('.npy').name
                 save(filepath, photFile)
-                new_files.append(filepath.name)
+                new_files.append(str(filepath) if cachePath else filepath.name)
+                output = filepath.name
+        update_manifest(manifests[outPath], fn, output)
+    for outPath, manifest in manifests.items():
+        save_manifest(outPath, manifest)
     return new_files
 
+def read_photometry_csv(fn, chunkRows=PHOTOMETRY_CHUNK_ROWS):
+    '''
+    Read a csv photometry file chunkRows lines at a time, yielding each chunk as a 2D float array read with the fast
+    loadtxt parser. Chunks with empty or unreadable fields are read with genfromtxt instead, which turns those fields
+    into nan. Blank lines are skipped, so an empty file yields nothing.
+    '''
+    with open(fn, 'r') as f:
+        while True:
+            lines = list(islice(f, chunkRows))
+            if not lines:
+                return
+            lines = [line for line in lines if line.strip()]
+            if not lines:
+                continue
+            try:
+                yield loadtxt(lines, dtype=float, delimiter=',', ndmin=2)
+            except ValueError:
+                photChunk = genfromtxt(lines, dtype=float, delimiter=',')
+                yield photChunk.reshape(1, -1) if photChunk.ndim == 1 else photChunk
+
 def convert_mjd_bjd(hdr):
-    pointing = SkyCoord(hdr['RA'], hdr['DEC'], unit=(u.degree, u.degree), frame='icrs')
-    location = EarthLocation.from_geodetic(hdr['LONGITUD'], hdr['LATITUDE'], hdr['HEIGHT'])
-    t = Time(hdr['MJD-OBS'], format='mjd',scale='utc', location=location)
+    return batch_mjd_bjd([hdr])[0]
 
-    tdbholder= (utc_tdb.JDUTC_to_BJDTDB(t, ra=float(pointing.ra.degree), dec=float(pointing.dec.degree), lat=hdr['LATITUDE'], longi=hdr['LONGITUD'], alt=hdr['HEIGHT'], leap_update=True))
+def batch_mjd_bjd(headers):
+    '''
+    Convert the MJD-OBS of each header into BJD
+
+    Headers from the same site and pointing are converted in a single barycorrpy call. The earth orientation table
+    is opened once for the whole batch, rather than once per time, and only the first call is allowed to update the
+    leap second table. If they cannot be updated (e.g. offline) the tables already available are used.
+
+    Parameters
+    ----------
+    headers : list
+            FITS headers with MJD-OBS, RA, DEC, LONGITUD, LATITUDE and HEIGHT
 
-    return tdbholder[0][0]
+    Returns
+    -------
+    bjd : numpy array
+            BJD of each header, in the same order
+    '''
+    groups = {}
+    for q, hdr in enumerate(headers):
+        groups.setdefault((hdr['RA'], hdr['DEC'], hdr['LONGITUD'], hdr['LATITUDE'], hdr['HEIGHT']), []).append(q)
+
+    bjd = zeros(len(headers))
+    leapUpdate = True
+    with iers.earth_orientation_table.set(iers.earth_orientation_table.get()):
+        for (ra, dec, longi, lat, height), rows in groups.items():
+            pointing = SkyCoord(ra, dec, unit=(u.degree, u.degree), frame='icrs')
+            location = EarthLocation.from_geodetic(longi, lat, height)
+            t = Time([headers[q]['MJD-OBS'] for q in rows], format='mjd',scale='utc', location=location)
+
+            try:
+                tdbholder= (utc_tdb.JDUTC_to_BJDTDB(t, ra=float(pointing.ra.degree), dec=float(pointing.dec.degree), lat=lat, longi=longi, alt=height, leap_update=leapUpdate))
+            except OSError as e:
+                if not leapUpdate:
+                    raise
+                logger.warning("Could not update the leap second table, using the local one: {}".format(e))
+                tdbholder= (utc_tdb.JDUTC_to_BJDTDB(t, ra=float(pointing.ra.degree), dec=float(pointing.dec.degree), lat=lat, longi=longi, alt=height, leap_update=False))
+            bjd[rows] = tdbholder[0]
+            leapUpdate = False
+    logger.debug("Converted {} times to BJD in {} batches".format(len(headers), len(groups)))
+    return bjd
+
+def image_bjd_times(fileList):
+    '''
+    BJD of each image in fileList, converted in one batch. Images whose header cannot be read or has no usable
+    time are left out, so they are converted (or fail) on their own when extracted.
+    '''
+    headers = {}
+    for f in fileList:
+        try:
+            hdr = fits.getheader(f, 1)
+            if hdr['MJD-OBS'] != 'UNKNOWN' and all(k in hdr for k in ['RA', 'DEC', 'LONGITUD', 'LATITUDE', 'HEIGHT']):
+                headers[f] = hdr
+        except Exception as e:
+            logger.debug("Could not read the header of {}: {}".format(f, e))
+    if not headers:
+        return {}
+    return dict(zip(headers.keys(), batch_mjd_bjd(list(headers.values()))))
 
 
-def gather_files(paths, filelist=None, filetype="fz", bjd=False):
+def gather_files(paths, filelist=None, filetype="fz", bjd=False, workers=1, cachePath=None):
     # Get list of files
     sys.stdout.write('💾 Inspecting input files\n')
 
@@ -130,10 +324,10 @@ def gather_files(paths, filelist=None, filetype="fz", bjd=False):
             filelist = paths['parent'].glob("*e91*.{}".format(filetype)) # Make sure only fully reduced LCO files are used.
     if filetype not in ['fits', 'fit', 'fz']:
         # Assume we are not dealing with image files but photometry files
-        phot_list = convert_photometry_files(filelist)
+        phot_list = convert_photometry_files(filelist, cachePath=cachePath)
     else:
 
-        phot_list_temp = export_photometry_files(filelist, paths['parent'], bjd=bjd)
+        phot_list_temp = export_photometry_files(filelist, paths['parent'], bjd=bjd, workers=workers)
         #Convert phot_list from dict to list
         phot_list_temp = phot_list_temp.keys()
         phot_list = []
@@ -190,7 +384,7 @@ def find_stars(targets, paths, fileList, mincompstars=0.1, starreject=0.1 , acce
     logger.info("Finding image with most stars detected and reject ones with bad WCS")
     referenceFrame = None
 
-    for file in fileList:
+    for file in list(fileList):
         photFile = load(paths['parent'] / file)
         if (photFile.size < 50):
             logger.debug("REJECT")
@@ -236,6 +430,26 @@ def find_stars(targets, paths, fileList, mincompstars=0.1, starreject=0.1 , acce
     originalfileList=fileList
     compchecker=0
 
+    # Cross-match every candidate star against every frame once. The retry loop below only looks up this matrix.
+    logger.debug("Cross-matching reference stars against all frames")
+    frameRow = {}
+    frameSize = []
+    frameValid = []
+    def frame_loader():
+        for row, file in enumerate(fileList):
+            photFile = load(paths['parent'] / file)
+            frameRow[file] = row
+            frameSize.append(photFile.size)
+            # Frames too small to be used are never matched, so no star is present in them
+            if photFile.size <= 7:
+                frameValid.append(False)
+                yield None
+                continue
+            frameValid.append(((photFile[:,0] > 360).sum() == 0) and (photFile[0][0] != 'null') and (photFile[0][0] != 0.0))
+            yield photFile
+    starPresent = presence_matrix(originalReferenceFrame, frame_loader(), acceptDistance=acceptDistance)
+    referenceRows = arange(originalReferenceFrame.shape[0])
+
     mincompstars=int(referenceFrame.shape[0]*mincompstars) # Transform mincompstars variable from fraction of stars into number of stars.
     if mincompstars < 1: # Always try to get at least ten comp candidates initially -- just because having a bunch is better than having 1.
         mincompstars=1
@@ -252,34 +466,24 @@ def find_stars(targets, paths, fileList, mincompstars=0.1, starreject=0.1 , acce
         for file in fileList:
             if ( not referenceFrame.shape[0] < mincompstars):
                 rejStartCounter = rejStartCounter +1
-                photFile = load(paths['parent'] / file)
+                row = frameRow[file]
+                photFileSize = frameSize[row]
                 logger.debug('Image Number: ' + str(rejStartCounter))
                 logger.debug(file)
                 logger.debug("Image threshold size: "+str(imgsize))
-                logger.debug("Image catalogue size: "+str(photFile.size))
-                if photFile.size > imgsize and photFile.size > 7 :
-                    phottmparr = asarray(photFile)
-                    if (( phottmparr[:,0] > 360).sum() == 0) and ( phottmparr[0][0] != 'null') and ( phottmparr[0][0] != 0.0) :
-
-                        # Checking existance of stars in all photometry files
-                        rejectStars=[] # A list to hold what stars are to be rejected
+                logger.debug("Image catalogue size: "+str(photFileSize))
+                if photFileSize > imgsize and photFileSize > 7 :
+                    if frameValid[row]:
 
                         # Find whether star in reference list is in this phot file, if not, reject star.
-                        for j in range(referenceFrame.shape[0]):
-                            photRAandDec = SkyCoord(ra = photFile[:,0]*u.degree, dec = photFile[:,1]*u.degree)
-                            testStar = SkyCoord(ra = referenceFrame[j][0]*u.degree, dec = referenceFrame[j][1]*u.degree)
-                            # This is the function in the whole package which requires scipy
-                            idx, d2d, d3d = testStar.match_to_catalog_sky(photRAandDec)
-                            if (d2d.arcsecond > acceptDistance):
-                                #"No Match! Nothing within range."
-                                rejectStars.append(int(j))
-
+                        rejectStars = [int(j) for j in where(~starPresent[row, referenceRows])[0]]
 
                     # if the rejectstar list is not empty, remove the stars from the reference List
                     if rejectStars != []:
 
                         if not (((len(rejectStars) / referenceFrame.shape[0]) > starreject) and rejStartCounter > rejectStart):
                             referenceFrame = delete(referenceFrame, rejectStars, axis=0)
+                            referenceRows = delete(referenceRows, rejectStars)
                             logger.debug('**********************')
                             logger.debug('Stars Removed  : ' +str(len(rejectStars)))
                             logger.debug('Remaining Stars: ' +str(referenceFrame.shape[0]))
@@ -303,7 +507,7 @@ def find_stars(targets, paths, fileList, mincompstars=0.1, starreject=0.1 , acce
                         logger.error("Problem file - {}".format(file))
                         logger.error("Running Loop again")
 
-                elif photFile.size < 7:
+                elif photFileSize < 7:
                     logger.error('**********************')
                     logger.error("WCS Coordinates broken")
                     logger.error('**********************')
@@ -342,6 +546,7 @@ def find_stars(targets, paths, fileList, mincompstars=0.1, starreject=0.1 , acce
             starreject=0.3
             imageFracReject=0.05
             referenceFrame=originalReferenceFrame
+            referenceRows=arange(originalReferenceFrame.shape[0])
             fileList=originalfileList
 
         elif (compchecker < mincompstars):
@@ -349,6 +554,7 @@ def find_stars(targets, paths, fileList, mincompstars=0.1, starreject=0.1 , acce
             logger.error("Failed to find sufficient comparison candidates, adjusting starreject and imgreject and trying again.")
             logger.error("Now trying starreject " +str(starreject) + " and imgreject " +str(imageFracReject))
             referenceFrame=originalReferenceFrame
+            referenceRows=arange(originalReferenceFrame.shape[0])
 
     # Construct the output file containing candidate comparison stars
     outputComps=[]
@@ -402,8 +608,15 @@ def find_stars(targets, paths, fileList, mincompstars=0.1, starreject=0.1 , acce
     used_file = paths['parent'] / "usedImages.txt"
     with open(used_file, "w") as f:
         for s in usedImages:
-            filename = Path(s).name
-            f.write(str(filename) +"\n")
+            f.write(str(s) +"\n")
+
+    # Match the candidates, the targets and every star in the largest used frame against all used frames once,
+    # so the later stages can look up rows rather than cross-matching again.
+    if usedImages:
+        usedSizes = [frameSize[frameRow[file]] for file in usedImages]
+        referenceUsed = load(paths['parent'] / usedImages[usedSizes.index(max(usedSizes))])
+        indexStars = vstack([atleast_2d(outputComps)[:,0:2], atleast_2d(targets)[:,0:2], referenceUsed[:,0:2]])
+        save_match_index(paths['parent'], indexStars, usedImages, (load(paths['parent'] / file) for file in usedImages))
 
     sys.stdout.write('\n')
 
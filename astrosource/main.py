@@ -29,12 +29,21 @@ logger = logging.getLogger('astrosource')
 @click.option('--format', default='fz', type=str, help='Input file format. If not `fz`, `fits`, or `fit` assumes the input files are photometry files with correct headers. If image files given, code looks for photometry in FITS Table extension.')
 @click.option('--imgreject', '-ir', type=float, default=0.05, help=' Image fraction rejection allowance based on image size starting value.')
 @click.option('--bjd', is_flag=True, help='Convert the MJD time into BJD time for LCO images')
+@click.option('--workers', '-w', type=int, default=1, help='Number of processes to extract photometry from image files with')
+@click.option('--cachedir', default=None, type=str, help='Directory to write the converted photometry files to, if not `indir`. Only used when the input files are photometry files.')
+@click.option('--catalogue-cache', default=None, type=str, help='Directory to keep catalogue (VSX, APASS, SDSS, PanSTARRS, SkyMapper) queries in, so later runs on the same field do not need the network')
+@click.option('--query-deadline', default=None, type=float, help='Seconds to keep retrying a catalogue that cannot be reached before giving up on it. Default is 120.')
+@click.option('--calib-csv', is_flag=True, help='Also write the calibrated photometry of each frame to csv files in calibcats')
 @click.option('--clean', is_flag=True, help='Remove all generated files. Reset `indir` to initial state')
 @click.option('--verbose', '-v', is_flag=True, help='Show all system messages for AstroSource')
 @click.option('--period', is_flag=True, type=float, help='Search for periodicity in the data, currently with PDM and String methods. This will autoselect a reasonable search range if not provided a range.')
 @click.option('--periodlower', '-pl', type=float, default=0.05, help='Shortest period to trial in days.')
 @click.option('--periodupper', '-pu', type=float, help='Longest period to trial in days. Default is one-third the observational baseline of your dataset.')
 @click.option('--periodtests', '-pt', type=int, default=10000, help='Number of different trial periods to run')
+@click.option('--period-workers', type=int, default=1, help='Number of processes to split the trial periods of the period search across')
+@click.option('--adaptive-period-search', is_flag=True, help='Search a coarse grid of trial periods sized to the observational baseline, then refine only its best peaks at the resolution set by --periodtests')
+@click.option('--period-oversampling', type=float, help='Space the trial periods of the period and transit searches evenly in frequency, with this many trials across the width of a periodogram peak, in place of --periodtests evenly spaced periods')
+@click.option('--defer-period-plots', is_flag=True, help='Save the Lomb-Scargle periodograms of the period search without making their figures, which plot_lomb_scargle can make later')
 @click.option('--rejectbrighter', '-rb', type=float, default=99, help='')
 @click.option('--rejectdimmer', '-rd', type=float, default=99, help='')
 @click.option('--thresholdcounts', '-tc', type=int, default=1000000, help='number of counts at which to stop adding identified comparison stars to the ensemble')
@@ -53,7 +62,7 @@ logger = logging.getLogger('astrosource')
 @click.option('--targetcolour', '-tc', type=float, default=-99.0)
 @click.option('--restrictmagbrightest', type=float, default=-99.0)
 @click.option('--restrictmagdimmest', type=float, default=99.0)
-def main(full, stars, comparison, calc, calib, phot, plot, detrend, eebls, period, indir, ra, dec, target_file, format, imgreject, mincompstars, closerejectd, bjd, clean, verbose, periodlower, periodupper, periodtests, rejectbrighter, rejectdimmer, thresholdcounts, nopanstarrs, nosdss, skipvarsearch, starreject, hicounts, lowcounts, colourdetect, linearise, colourterm, colourerror, targetcolour, restrictmagbrightest, restrictmagdimmest):
+def main(full, stars, comparison, calc, calib, phot, plot, detrend, eebls, period, indir, ra, dec, target_file, format, imgreject, mincompstars, closerejectd, bjd, workers, cachedir, catalogue_cache, query_deadline, calib_csv, clean, verbose, periodlower, periodupper, periodtests, period_workers, adaptive_period_search, period_oversampling, defer_period_plots, rejectbrighter, rejectdimmer, thresholdcounts, nopanstarrs, nosdss, skipvarsearch, starreject, hicounts, lowcounts, colourdetect, linearise, colourterm, colourerror, targetcolour, restrictmagbrightest, restrictmagdimmest):
 
     try:
         parentPath = Path(indir)
@@ -79,6 +88,10 @@ def main(full, stars, comparison, calc, calib, phot, plot, detrend, eebls, perio
                         periodupper=periodupper,
                         periodlower=periodlower,
                         periodtests=periodtests,
+                        periodworkers=period_workers,
+                        adaptiveperiods=adaptive_period_search,
+                        periodoversampling=period_oversampling,
+                        deferperiodplots=defer_period_plots,
                         rejectbrighter=rejectbrighter,
                         rejectdimmer=rejectdimmer,
                         thresholdcounts=thresholdcounts,
@@ -90,6 +103,11 @@ def main(full, stars, comparison, calc, calib, phot, plot, detrend, eebls, perio
                         closerejectd=closerejectd,
                         verbose=verbose,
                         bjd=bjd,
+                        workers=workers,
+                        cachedir=Path(cachedir) if cachedir else None,
+                        catalogue_cache=Path(catalogue_cache) if catalogue_cache else None,
+                        query_deadline=query_deadline,
+                        calibcsv=calib_csv,
                         mincompstars=mincompstars,
                         colourdetect=colourdetect,
                         linearise=linearise,
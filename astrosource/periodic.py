@@ -4,6 +4,10 @@ from numpy import (asarray, savetxt, std, max, min, genfromtxt, load, nan as npn
 import numpy as np
 import sys
 import os
+from pathlib import Path
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 import matplotlib
 matplotlib.use('Agg')
@@ -11,11 +15,149 @@ import matplotlib.pyplot as plt
 
 import logging
 
-from astrosource.utils import photometry_files_to_array, AstrosourceException
+from astrosource.utils import photometry_files_to_array, used_images, AstrosourceException
 from astropy.timeseries import LombScargle
+try:
+    from astropy.timeseries.periodograms.lombscargle.implementations.utils import trig_sum
+except ImportError:
+    # trig_sum is not part of the public astropy API. Without it lomb_scargle_multiterm leaves each model to astropy.
+    trig_sum = None
 
 logger = logging.getLogger('astrosource')
-NCPUS = 1
+NCPUS = os.cpu_count() or 1
+
+# Memory, in bytes, for the arrays of one block of trial periods or frequencies in the PDM and AoV searches, which
+# are about PERIOD_BLOCK_ARRAYS arrays of (trials, datapoints) float64
+PERIOD_BLOCK_MEMORY = 64 * 1024 * 1024
+PERIOD_BLOCK_ARRAYS = 8
+
+
+# The harmonic AoV goes over its arrays many times for each block, so its blocks are kept small enough to stay in cache
+AOVHM_BLOCK_MEMORY = 2 * 1024 * 1024
+
+
+def trial_blocks(ntrials, npoints, memory=None):
+    '''
+    Slices cutting ntrials trial periods or frequencies into blocks small enough for memory bytes,
+    PERIOD_BLOCK_MEMORY by default
+    '''
+    memory = PERIOD_BLOCK_MEMORY if memory is None else memory
+    blockSize = int(memory // (PERIOD_BLOCK_ARRAYS * 8 * (npoints + 1))) + 1
+    return [slice(r, r + blockSize) for r in range(0, ntrials, blockSize)]
+
+
+def parallel_periodogram(search, trials, nworkers=1):
+    '''
+    Run a period search over a grid of trial frequencies or periods, split across a pool of processes
+
+    Parameters
+    ----------
+    search : function
+            Called as search(trials) with part of the grid, returning an array whose last axis runs over those trials.
+            It must be picklable, so a module level function or a partial of one.
+    trials : numpy array
+            Trial frequencies or periods
+    nworkers : int
+            Number of processes. The grid is split into this many contiguous chunks, and the results joined back
+            together in order. The search is run in this process if nworkers is 1 or None.
+
+    Returns
+    -------
+    results : numpy array
+            The results of search over the whole grid
+    '''
+    nworkers = int(np.clip(nworkers or 1, 1, np.minimum(NCPUS, len(trials))))
+    if nworkers <= 1:
+        return asarray(search(trials))
+    chunks = np.array_split(trials, nworkers)
+    logger.debug("Period search over {} trials split across {} processes".format(len(trials), len(chunks)))
+    with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+        return np.concatenate(list(executor.map(search, chunks)), axis=-1)
+
+
+# Adaptive period searches first run over a coarse part of the grid of trials, spaced as get_frequency_grid would with
+# COARSE_SAMPLES_PER_PEAK samples across 1/baseline in frequency, then over every trial around each of the COARSE_PEAKS
+# best peaks of that coarse search
+COARSE_SAMPLES_PER_PEAK = 10
+COARSE_PEAKS = 10
+
+
+def coarse_to_fine(search, trials, times, periods=False, minimum=False, nworkers=1, samplesperpeak=None, npeaks=None):
+    '''
+    Run a period search over the parts of a fine grid of trials around the best peaks of a coarse search
+
+    Parameters
+    ----------
+    search : function
+            Called as search(trials), as for parallel_periodogram
+    trials : numpy array
+            The fine grid of trial frequencies or periods, in ascending order
+    times : numpy array
+            Times of the observations, whose baseline sets the spacing of the coarse search
+    periods : bool
+            True if the trials are periods rather than frequencies
+    minimum : bool
+            True if the best trials are those with the smallest results, as for PDM, rather than the largest
+    nworkers : int
+            Number of processes, as for parallel_periodogram
+    samplesperpeak : int
+            Samples per peak of the coarse search, COARSE_SAMPLES_PER_PEAK by default
+    npeaks : int
+            Number of peaks of the coarse search to refine, COARSE_PEAKS by default. If the search gives several rows
+            of results, the peaks of each row are refined.
+
+    Returns
+    -------
+    trials : numpy array
+            The trials searched, part of the fine grid and in the same order
+    results : numpy array
+            The results of search over those trials
+    '''
+    samplesperpeak = samplesperpeak or COARSE_SAMPLES_PER_PEAK
+    npeaks = npeaks or COARSE_PEAKS
+    if periods:
+        coarse = 1.0 / get_frequency_grid(times, samplesperpeak, minfreq=1.0/trials[-1], maxfreq=1.0/trials[0])
+    else:
+        coarse = get_frequency_grid(times, samplesperpeak, minfreq=trials[0], maxfreq=trials[-1])
+
+    # The coarse search is over the trials nearest to the coarse grid, so its results are those of the fine grid
+    index = np.clip(np.searchsorted(trials, coarse), 1, len(trials) - 1)
+    index = index - ((coarse - trials[index - 1]) < (trials[index] - coarse))
+    index = np.unique(np.r_[0, index, len(trials) - 1])
+    coarseResults = parallel_periodogram(search, trials[index], nworkers)
+
+    score = np.atleast_2d(-coarseResults if minimum else coarseResults)
+    score = np.where(np.isfinite(score), score, -np.inf)
+    padded = np.pad(score, ((0, 0), (1, 1)), constant_values=-np.inf)
+    peaks = (score >= padded[:, :-2]) & (score >= padded[:, 2:]) & np.isfinite(score)
+
+    # Every fine trial within half of 1/baseline in frequency of each peak is searched, so the whole of a jagged peak is,
+    # and peaks inside the window of a better one are passed over
+    refine = np.zeros(len(trials), dtype=bool)
+    halfWidth = samplesperpeak // 2 + 1
+    for rowScore, rowPeaks in zip(score, peaks):
+        peakIndex = np.flatnonzero(rowPeaks)
+        rowRefine = np.zeros(len(trials), dtype=bool)
+        refined = 0
+        for j in peakIndex[np.argsort(rowScore[peakIndex], kind='stable')[::-1]]:
+            if refined == npeaks:
+                break
+            if rowRefine[index[j]]:
+                continue
+            rowRefine[index[np.maximum(j - halfWidth, 0)]:index[np.minimum(j + halfWidth, len(index) - 1)] + 1] = True
+            refined = refined + 1
+        refine |= rowRefine
+
+    searched = np.zeros(len(trials), dtype=bool)
+    searched[index] = True
+    refine &= ~searched
+    results = np.zeros(coarseResults.shape[:-1] + (len(trials),))
+    results[..., index] = coarseResults
+    if refine.any():
+        results[..., refine] = parallel_periodogram(search, trials[refine], nworkers)
+    searched |= refine
+    logger.debug("Coarse to fine period search over {} of {} trials".format(searched.sum(), len(trials)))
+    return trials[searched], results[..., searched]
 
 # Note that the functions that calculate the ANOVA periodograms have been adapted from the astrobase codeset
 # These are aov_theta, resort_by_time, get_frequency_grid, sigclip_magseries, phase_magseries, aov_periodfind, phase_magseries_with_errs, aovhm_theta, aovhm_periodfind
@@ -34,8 +176,12 @@ NCPUS = 1
 # SOFTWARE.
 
 def aov_theta(times, mags, errs, frequency,
-              binsize=0.05, minbin=9):
-    '''Calculates the Schwarzenberg-Czerny AoV statistic at a test frequency.
+              binsize=0.05, minbin=9, binstat='median'):
+    '''Calculates the Schwarzenberg-Czerny AoV statistic at a test frequency,
+    or at each of a block of test frequencies at once.
+
+    The time-series is phased with every frequency in one step, and the phase
+    bin occupancies and sums are made for all of them with `np.bincount`.
 
     Parameters
     ----------
@@ -43,8 +189,9 @@ def aov_theta(times, mags, errs, frequency,
     times,mags,errs : np.array
         The input time-series and associated errors.
 
-    frequency : float
-        The test frequency to calculate the theta statistic at.
+    frequency : float or np.array
+        The test frequency, or frequencies, to calculate the theta statistic
+        at.
 
     binsize : float
         The phase bin size to use.
@@ -53,79 +200,96 @@ def aov_theta(times, mags, errs, frequency,
         The minimum number of items in a phase bin to consider in the
         calculation of the statistic.
 
+    binstat : {'median', 'mean'}
+        The average to use for each phase bin. 'median' sorts the magnitudes
+        in each bin to find it. 'mean' is faster as it needs no sorting.
+
     Returns
     -------
 
-    theta_aov : float
-        The value of the AoV statistic at the specified `frequency`.
+    theta_aov : float or np.array
+        The value of the AoV statistic at the specified `frequency`, or an
+        array of values if an array of frequencies was given.
 
     '''
 
-    period = 1.0/frequency
+    frequencies = np.atleast_1d(frequency)
+    period = 1.0/frequencies
     fold_time = times[0]
 
-    phased = phase_magseries(times,
-                             mags,
-                             period,
-                             fold_time,
-                             wrap=False,
-                             sort=True)
+    # find all the finite values of the magnitudes and times
+    finiteind = npisfinite(mags) & npisfinite(times)
+    finite_times = times[finiteind]
+    pmags = mags[finiteind]
+    ndets = pmags.size
 
-    phases = phased['phase']
-    pmags = phased['mags']
+    # phases have shape (frequencies, ndets)
+    folded = (finite_times[None,:] - fold_time)/period[:,None]
+    phases = folded - np.floor(folded)
     bins = nparange(0.0, 1.0, binsize)
-    ndets = phases.size
+    nbins = bins.size + 1
 
     binnedphaseinds = npdigitize(phases, bins)
 
-    bin_s1_tops = []
-    bin_s2_tops = []
-    binndets = []
-    goodbins = 0
+    # label every point with its frequency and bin
+    binlabels = (nparange(frequencies.size)[:,None]*nbins + binnedphaseinds).ravel()
+    nlabels = frequencies.size*nbins
 
     all_xbar = npmedian(pmags)
 
-    for x in npunique(binnedphaseinds):
-
-        thisbin_inds = binnedphaseinds == x
-        thisbin_mags = pmags[thisbin_inds]
-
-        if thisbin_mags.size > minbin:
+    binndets = np.bincount(binlabels, minlength=nlabels)
+    bin_s2_tops = np.bincount(binlabels,
+                              weights=np.tile((pmags - all_xbar)*(pmags - all_xbar), frequencies.size),
+                              minlength=nlabels)
 
-            thisbin_ndet = thisbin_mags.size
-            thisbin_xbar = npmedian(thisbin_mags)
+    if binstat == 'mean':
+        bin_xbar = np.bincount(binlabels, weights=np.tile(pmags, frequencies.size),
+                               minlength=nlabels)/np.maximum(binndets, 1)
+    else:
+        # sort the points by bin then magnitude, and take the middle of each bin
+        magorder = npargsort(pmags, kind='stable')
+        magrank = np.empty(ndets, dtype=int)
+        magrank[magorder] = nparange(ndets)
+        sortedmags = pmags[magorder][np.sort(binlabels*ndets + np.tile(magrank, frequencies.size)) % ndets]
+        binstarts = np.cumsum(binndets) - binndets
+        lower = np.minimum(binstarts + (binndets - 1)//2, sortedmags.size - 1)
+        upper = np.minimum(binstarts + binndets//2, sortedmags.size - 1)
+        bin_xbar = (sortedmags[lower] + sortedmags[upper])/2
 
-            # get s1
-            thisbin_s1_top = (
-                thisbin_ndet *
-                (thisbin_xbar - all_xbar) *
-                (thisbin_xbar - all_xbar)
-            )
+    binndets = binndets.reshape(frequencies.size, nbins)
+    bin_s2_tops = bin_s2_tops.reshape(frequencies.size, nbins)
+    bin_xbar = bin_xbar.reshape(frequencies.size, nbins)
 
-            # get s2
-            thisbin_s2_top = npsum((thisbin_mags - all_xbar) *
-                                   (thisbin_mags - all_xbar))
+    goodbin = binndets > minbin
+    goodbins = goodbin.sum(axis=1)
 
-            bin_s1_tops.append(thisbin_s1_top)
-            bin_s2_tops.append(thisbin_s2_top)
-            binndets.append(thisbin_ndet)
-            goodbins = goodbins + 1
+    with np.errstate(divide='ignore', invalid='ignore'):
 
-    # turn the quantities into arrays
-    bin_s1_tops = nparray(bin_s1_tops)
-    bin_s2_tops = nparray(bin_s2_tops)
-    binndets = nparray(binndets)
+        # calculate s1 first
+        s1 = npsum(np.where(goodbin,
+                            binndets *
+                            (bin_xbar - all_xbar) *
+                            (bin_xbar - all_xbar), 0.0), axis=1)/(goodbins - 1.0)
 
-    # calculate s1 first
-    s1 = npsum(bin_s1_tops)/(goodbins - 1.0)
+        # then calculate s2
+        s2 = npsum(np.where(goodbin, bin_s2_tops, 0.0), axis=1)/(ndets - goodbins)
 
-    # then calculate s2
-    s2 = npsum(bin_s2_tops)/(ndets - goodbins)
+        theta_aov = s1/s2
 
-    theta_aov = s1/s2
+    if np.ndim(frequency) == 0:
+        return theta_aov[0]
 
     return theta_aov
 
+def aov_periodogram(times, mags, errs, frequencies, binsize=0.05, minbin=9, binstat='median'):
+    '''
+    AoV statistic at each of the test frequencies, worked out in blocks of frequencies, see aov_theta
+    '''
+    lsp = np.zeros(len(frequencies))
+    for block in trial_blocks(len(frequencies), len(times)):
+        lsp[block] = aov_theta(times, mags, errs, frequencies[block], binsize=binsize, minbin=minbin, binstat=binstat)
+    return lsp
+
 def resort_by_time(times, mags, errs):
     '''
     Resorts the input arrays so they're in time order.
@@ -195,6 +359,42 @@ def get_frequency_grid(times,
     else:
         return f0 + df * np.arange(Nf)
 
+
+# A grid of trial frequencies evenly spaced in frequency, shared by the PDM, string length, AoV and BLS searches.
+# step is the spacing in frequency and resolution the matching spacing in period, step * period**2, at the shortest
+# and the longest period of the grid.
+TrialGrid = namedtuple('TrialGrid', ['frequencies', 'step', 'resolution'])
+
+
+def trial_grid(times, minperiod, maxperiod, oversampling=5):
+    '''
+    Trial frequencies from 1/maxperiod to 1/minperiod, with oversampling trials across the width, 1/baseline, of a
+    periodogram peak
+
+    A grid evenly spaced in period is finer than it needs to be at long periods and coarser at short ones, so evenly
+    spaced frequencies give the same precision at the shortest period with far fewer trials.
+
+    Parameters
+    ----------
+    times : numpy array
+            Times of the observations
+    minperiod, maxperiod : float
+            Shortest and longest periods to trial
+    oversampling : float
+            Trials per 1/baseline in frequency
+
+    Returns
+    -------
+    grid : TrialGrid
+            The trial frequencies in ascending order, with their step and the period resolution this gives
+    '''
+    (f0, step, nf, frequencies) = get_frequency_grid(np.asarray(times), oversampling, minfreq=1.0/maxperiod,
+                                                     maxfreq=1.0/minperiod, returnf0dfnf=True)
+    grid = TrialGrid(frequencies, step, (step * minperiod**2, step * maxperiod**2))
+    logger.debug("{} trial frequencies {:.6g} apart, period resolution {:.3g} d at {} d to {:.3g} d at {} d".format(
+        len(frequencies), step, grid.resolution[0], minperiod, grid.resolution[1], maxperiod))
+    return grid
+
 def sigclip_magseries(times, mags, errs,
                       sigclip=None,
                       iterative=False,
@@ -604,13 +804,16 @@ def aov_periodfind(times,
                    endp=None,
                    stepsize=1.0e-4,
                    autofreq=True,
+                   samplesperpeak=5,
                    normalize=True,
                    phasebinsize=0.05,
                    mindetperbin=9,
+                   binstat='median',
                    nbestpeaks=5,
                    periodepsilon=0.1,
                    sigclip=10.0,
                    nworkers=None,
+                   adaptive=False,
                    verbose=True,
                    periodPath=None, variableName="NoName"):
     '''This runs a parallelized Analysis-of-Variance (AoV) period search.
@@ -638,10 +841,13 @@ def aov_periodfind(times,
 
     autofreq : bool
         If this is True, the value of `stepsize` will be ignored and the
-        :py:func:`astrobase.periodbase.get_frequency_grid` function will be used
-        to generate a frequency grid based on `startp`, and `endp`. If these are
-        None as well, `startp` will be set to 0.1 and `endp` will be set to
-        `times.max() - times.min()`.
+        :py:func:`trial_grid` function will be used to generate a frequency
+        grid based on `startp`, and `endp`. If these are None as well, `startp`
+        will be set to 0.1 and `endp` will be set to `times.max() - times.min()`.
+
+    samplesperpeak : float
+        The number of frequencies across the width of a periodogram peak in the
+        grid generated when `autofreq` is True.
 
     normalize : bool
         This sets if the input time-series is normalized to 0.0 and rescaled
@@ -656,6 +862,10 @@ def aov_periodfind(times,
         The minimum number of elements in a phase bin to consider it valid when
         calculating the AoV theta statistic at a test frequency.
 
+    binstat : {'median', 'mean'}
+        The average to use for each phase bin when calculating the AoV theta
+        statistic. 'mean' is faster, 'median' is less affected by outliers.
+
     nbestpeaks : int
         The number of 'best' peaks to return from the periodogram results,
         starting from the global maximum of the periodogram peak values.
@@ -688,6 +898,11 @@ def aov_periodfind(times,
     nworkers : int
         The number of parallel workers to use when calculating the periodogram.
 
+    adaptive : bool
+        If this is True, the periodogram is only calculated at the frequencies
+        :py:func:`coarse_to_fine` picks out around its best peaks, and `lspvals`
+        and `periods` only hold those.
+
     verbose : bool
         If this is True, will indicate progress and details about the frequency
         grid used for the period search.
@@ -743,9 +958,8 @@ def aov_periodfind(times,
 
         else:
             # this gets an automatic grid of frequencies to use
-            frequencies = get_frequency_grid(stimes,
-                                             minfreq=startf,
-                                             maxfreq=endf)
+            frequencies = trial_grid(stimes, 1.0/endf, 1.0/startf,
+                                     samplesperpeak).frequencies
 
         # renormalize the working mags to zero and scale them so that the
         # variance = 1 for use with our LSP functions
@@ -755,13 +969,12 @@ def aov_periodfind(times,
             nmags = smags
 
 
-        lsp=[]
-        for x in frequencies:
-            theta = aov_theta(stimes, nmags, serrs, x,
-                          binsize=phasebinsize, minbin=mindetperbin)
-            lsp.append(theta)
-
-        lsp = nparray(lsp)
+        search = partial(aov_periodogram, stimes, nmags, serrs,
+                         binsize=phasebinsize, minbin=mindetperbin, binstat=binstat)
+        if adaptive:
+            frequencies, lsp = coarse_to_fine(search, frequencies, stimes, nworkers=nworkers)
+        else:
+            lsp = parallel_periodogram(search, frequencies, nworkers)
         periods = 1.0/frequencies
 
         plt.plot(periods, lsp)
@@ -804,9 +1017,12 @@ def aov_periodfind(times,
                               'normalize':normalize,
                               'phasebinsize':phasebinsize,
                               'mindetperbin':mindetperbin,
+                              'binstat':binstat,
                               'autofreq':autofreq,
+                              'samplesperpeak':samplesperpeak,
                               'periodepsilon':periodepsilon,
                               'nbestpeaks':nbestpeaks,
+                              'adaptive':adaptive,
                               'sigclip':sigclip}}
 
         sortedlspind = npargsort(finlsp)[::-1]
@@ -859,9 +1075,12 @@ def aov_periodfind(times,
                           'normalize':normalize,
                           'phasebinsize':phasebinsize,
                           'mindetperbin':mindetperbin,
+                          'binstat':binstat,
                           'autofreq':autofreq,
+                          'samplesperpeak':samplesperpeak,
                           'periodepsilon':periodepsilon,
                           'nbestpeaks':nbestpeaks,
+                          'adaptive':adaptive,
                           'sigclip':sigclip}}
 
     else:
@@ -881,9 +1100,12 @@ def aov_periodfind(times,
                           'normalize':normalize,
                           'phasebinsize':phasebinsize,
                           'mindetperbin':mindetperbin,
+                          'binstat':binstat,
                           'autofreq':autofreq,
+                          'samplesperpeak':samplesperpeak,
                           'periodepsilon':periodepsilon,
                           'nbestpeaks':nbestpeaks,
+                          'adaptive':adaptive,
                           'sigclip':sigclip}}
 
 
@@ -964,7 +1186,8 @@ def phase_magseries_with_errs(times, mags, errs, period, epoch,
 
 def aovhm_theta(times, mags, errs, frequency,
                 nharmonics, magvariance):
-    '''This calculates the harmonic AoV theta statistic for a frequency.
+    '''This calculates the harmonic AoV theta statistic for a frequency, or for
+    each of a block of frequencies at once.
 
     This is a mostly faithful translation of the inner loop in `aovper.f90`. See
     the following for details:
@@ -991,8 +1214,11 @@ def aovhm_theta(times, mags, errs, frequency,
         The input time-series to calculate the test statistic for. These should
         all be of nans/infs and be normalized to zero.
 
-    frequency : float
-        The test frequency to calculate the statistic for.
+    frequency : float or np.array
+        The test frequency, or frequencies, to calculate the statistic for. An
+        evenly spaced block of frequencies is swept with trigonometric
+        recurrences (see `trial_phasors`) rather than phasing the time-series
+        again at every frequency.
 
     nharmonics : int
         The number of harmonics to calculate up to.The recommended range is 4 to
@@ -1006,66 +1232,58 @@ def aovhm_theta(times, mags, errs, frequency,
     Returns
     -------
 
-    aov_harmonic_theta : float
-        THe value of the harmonic AoV theta for the specified test `frequency`.
+    aov_harmonic_theta : float or np.array
+        THe value of the harmonic AoV theta for the specified test `frequency`,
+        or an array of values if an array of frequencies was given.
 
     '''
 
-    period = 1.0/frequency
+    frequencies = np.atleast_1d(frequency)
 
     ndet = times.size
     two_nharmonics = nharmonics + nharmonics
 
-    # phase with test period
-    phasedseries = phase_magseries_with_errs(
-        times, mags, errs, period, times[0],
-        sort=True, wrap=False
-    )
-
-    # get the phased quantities
-    phase = phasedseries['phase']
-    pmags = phasedseries['mags']
-    perrs = phasedseries['errs']
+    # get the finite quantities
+    finiteind = npisfinite(mags)
+    ftimes = times[finiteind] - times[0]
+    pmags = mags[finiteind]
+    perrs = errs[finiteind]
 
     # this is sqrt(1.0/errs^2) -> the weights
     pweights = 1.0/perrs
 
-    # multiply by 2.0*PI (for omega*time)
-    phase = phase * 2.0 * pi_value
+    # this is the z complex vector, exp(2 pi i phase), for each frequency, as
+    # an array of shape (frequencies, ndet). On a uniform grid of frequencies
+    # only the first row is phased: each later row is the one before
+    # multiplied by the fixed step exp(2 pi i df t)
+    z = trial_phasors(ftimes, frequencies)
 
-    # this is the z complex vector
-    z = npcos(phase) + 1.0j*npsin(phase)
-
-    # multiply phase with N
-    phase = nharmonics * phase
-
-    # this is the psi complex vector
-    psi = pmags * pweights * (npcos(phase) + 1j*npsin(phase))
+    # this is the psi complex vector, made with z^N in the same way
+    psi = (pmags * pweights) * trial_phasors(ftimes, nharmonics * frequencies)
 
     # this is the initial value of z^n
-    zn = 1.0 + 0.0j
+    zn = np.ones(z.shape, dtype=complex)
 
     # this is the initial value of phi
-    phi = pweights + 0.0j
+    phi = np.broadcast_to(pweights + 0.0j, z.shape)
 
     # initialize theta to zero
-    theta_aov = 0.0
+    theta_aov = np.zeros(frequencies.size)
 
     # go through all the harmonics now up to 2N
     for _ in range(two_nharmonics):
 
         # this is <phi, phi>
-        phi_dot_phi = npsum(phi * phi.conjugate())
+        phi_dot_phi = npsum((phi * phi.conjugate()).real, axis=1)
 
         # this is the alpha_n numerator
-        alpha = npsum(pweights * z * phi)
+        alpha = npsum(pweights * z * phi, axis=1)
 
-        # this is <phi, psi>. make sure to use npvdot and NOT npdot to get
-        # complex conjugate of first vector as expected for complex vectors
-        phi_dot_psi = npvdot(phi, psi)
+        # this is <phi, psi>, with the complex conjugate of phi
+        phi_dot_psi = npsum(phi.conjugate() * psi, axis=1)
 
         # make sure phi_dot_phi is not zero
-        phi_dot_phi = npmax([phi_dot_phi, 10.0e-9])
+        phi_dot_phi = np.maximum(phi_dot_phi, 10.0e-9)
 
         # this is the expression for alpha_n
         alpha = alpha / phi_dot_phi
@@ -1075,7 +1293,7 @@ def aovhm_theta(times, mags, errs, frequency,
                      npabs(phi_dot_psi) * npabs(phi_dot_psi) / phi_dot_phi)
 
         # use the recurrence relation to find the next phi
-        phi = phi * z - alpha * zn * phi.conjugate()
+        phi = phi * z - alpha[:,None] * zn * phi.conjugate()
 
         # update z^n
         zn = zn * z
@@ -1083,11 +1301,43 @@ def aovhm_theta(times, mags, errs, frequency,
     # done with all harmonics, calculate the theta_aov for this freq
     # the max below makes sure that magvariance - theta_aov > zero
     theta_aov = ( (ndet - two_nharmonics - 1.0) * theta_aov /
-                  (two_nharmonics * npmax([magvariance - theta_aov,
-                                           1.0e-9])) )
+                  (two_nharmonics * np.maximum(magvariance - theta_aov,
+                                               1.0e-9)) )
+
+    if np.ndim(frequency) == 0:
+        return theta_aov[0]
 
     return theta_aov
 
+def trial_phasors(times, frequencies):
+    '''
+    exp(2 pi i f t) for each of the frequencies f and times t, as an array of shape (frequencies, times)
+
+    When the frequencies are evenly spaced only the first row is worked out directly. Each later row is the row
+    before multiplied by exp(2 pi i df t), so no sines or cosines are needed for the rest of the grid.
+    '''
+    frequencies = np.atleast_1d(frequencies)
+    step = np.diff(frequencies)
+    if frequencies.size > 2 and np.allclose(step, step[0], rtol=1.0e-9, atol=0.0):
+        phase = times * frequencies[0]
+        phasors = np.empty((frequencies.size, times.size), dtype=complex)
+        phasors[0] = np.exp(2.0j * pi_value * (phase - np.floor(phase)))
+        phase = times * (frequencies[-1] - frequencies[0]) / (frequencies.size - 1)
+        phasors[1:] = np.exp(2.0j * pi_value * (phase - np.floor(phase)))
+        return np.cumprod(phasors, axis=0)
+    phase = times[None,:] * frequencies[:,None]
+    return np.exp(2.0j * pi_value * (phase - np.floor(phase)))
+
+def aovhm_periodogram(times, mags, errs, nharmonics, magvariance, frequencies):
+    '''
+    Harmonic AoV statistic at each of the test frequencies, worked out in blocks of frequencies small enough to
+    stay in the processor cache, see aovhm_theta
+    '''
+    lsp = np.zeros(len(frequencies))
+    for block in trial_blocks(len(frequencies), len(times), memory=AOVHM_BLOCK_MEMORY):
+        lsp[block] = aovhm_theta(times, mags, errs, frequencies[block], nharmonics, magvariance)
+    return lsp
+
 def aovhm_periodfind(times,
                      mags,
                      errs,
@@ -1096,12 +1346,14 @@ def aovhm_periodfind(times,
                      endp=None,
                      stepsize=1.0e-4,
                      autofreq=True,
+                     samplesperpeak=5,
                      normalize=True,
                      nharmonics=6,
                      nbestpeaks=5,
                      periodepsilon=0.1,
                      sigclip=10.0,
                      nworkers=None,
+                     adaptive=False,
                      verbose=True,
                      periodPath=None, variableName="NoName"):
     '''This runs a parallelized harmonic Analysis-of-Variance (AoV) period
@@ -1130,10 +1382,13 @@ def aovhm_periodfind(times,
 
     autofreq : bool
         If this is True, the value of `stepsize` will be ignored and the
-        :py:func:`astrobase.periodbase.get_frequency_grid` function will be used
-        to generate a frequency grid based on `startp`, and `endp`. If these are
-        None as well, `startp` will be set to 0.1 and `endp` will be set to
-        `times.max() - times.min()`.
+        :py:func:`trial_grid` function will be used to generate a frequency
+        grid based on `startp`, and `endp`. If these are None as well, `startp`
+        will be set to 0.1 and `endp` will be set to `times.max() - times.min()`.
+
+    samplesperpeak : float
+        The number of frequencies across the width of a periodogram peak in the
+        grid generated when `autofreq` is True.
 
     normalize : bool
         This sets if the input time-series is normalized to 0.0 and rescaled
@@ -1176,6 +1431,11 @@ def aovhm_periodfind(times,
     nworkers : int
         The number of parallel workers to use when calculating the periodogram.
 
+    adaptive : bool
+        If this is True, the periodogram is only calculated at the frequencies
+        :py:func:`coarse_to_fine` picks out around its best peaks, and `lspvals`
+        and `periods` only hold those.
+
     verbose : bool
         If this is True, will indicate progress and details about the frequency
         grid used for the period search.
@@ -1231,13 +1491,8 @@ def aovhm_periodfind(times,
 
         else:
             # this gets an automatic grid of frequencies to use
-            frequencies = get_frequency_grid(stimes,
-                                             minfreq=startf,
-                                             maxfreq=endf)
-
-        # map to parallel workers
-        if (not nworkers) or (nworkers > NCPUS):
-            nworkers = NCPUS
+            frequencies = trial_grid(stimes, 1.0/endf, 1.0/startf,
+                                     samplesperpeak).frequencies
 
         # renormalize the working mags to zero and scale them so that the
         # variance = 1 for use with our LSP functions
@@ -1252,14 +1507,12 @@ def aovhm_periodfind(times,
         magvariance_bot = (nmags.size - 1)*npsum(1.0/(serrs*serrs)) / nmags.size
         magvariance = magvariance_top/magvariance_bot
 
-        #tasks = [(stimes, nmags, serrs, x, nharmonics, magvariance)
-        #         for x in frequencies]
-
-        lsp=[]
-        for x in frequencies:
-            lsp.append(aovhm_theta(times, mags, errs, x, nharmonics, magvariance))
-
-        lsp = nparray(lsp)
+        # map to parallel workers
+        search = partial(aovhm_periodogram, stimes, nmags, serrs, nharmonics, magvariance)
+        if adaptive:
+            frequencies, lsp = coarse_to_fine(search, frequencies, stimes, nworkers=nworkers)
+        else:
+            lsp = parallel_periodogram(search, frequencies, nworkers)
         periods = 1.0/frequencies
 
         plt.plot(periods, lsp)
@@ -1303,8 +1556,10 @@ def aovhm_periodfind(times,
                               'normalize':normalize,
                               'nharmonics':nharmonics,
                               'autofreq':autofreq,
+                              'samplesperpeak':samplesperpeak,
                               'periodepsilon':periodepsilon,
                               'nbestpeaks':nbestpeaks,
+                              'adaptive':adaptive,
                               'sigclip':sigclip}}
 
         sortedlspind = npargsort(finlsp)[::-1]
@@ -1357,8 +1612,10 @@ def aovhm_periodfind(times,
                           'normalize':normalize,
                           'nharmonics':nharmonics,
                           'autofreq':autofreq,
+                          'samplesperpeak':samplesperpeak,
                           'periodepsilon':periodepsilon,
                           'nbestpeaks':nbestpeaks,
+                          'adaptive':adaptive,
                           'sigclip':sigclip}}
 
     else:
@@ -1378,46 +1635,35 @@ def aovhm_periodfind(times,
                           'normalize':normalize,
                           'nharmonics':nharmonics,
                           'autofreq':autofreq,
+                          'samplesperpeak':samplesperpeak,
                           'periodepsilon':periodepsilon,
                           'nbestpeaks':nbestpeaks,
+                          'adaptive':adaptive,
                           'sigclip':sigclip}}
 
 #########################################
 
-def sortByPhase (phases, fluxes):
-    phaseIndices = asarray(phases).argsort()
-    sortedPhases = []
-    sortedFluxes = []
-    for i in range(0,len(phases)):
-        sortedPhases.append(phases[phaseIndices[i]])
-        sortedFluxes.append(fluxes[phaseIndices[i]])
-
-    return (sortedPhases, sortedFluxes)
-
-#########################################
-
 def normalize(fluxes):
 
-    normalizedFluxes = []
-
-    for flux in fluxes:
-        normalizedFlux = (flux - min(fluxes)) / (max(fluxes) - min(fluxes))
-        normalizedFluxes.append(normalizedFlux)
+    fluxes = asarray(fluxes)
 
-    return(normalizedFluxes)
+    return (fluxes - min(fluxes)) / (max(fluxes) - min(fluxes))
 
 #########################################
 
 def getPhases(julian_dates, fluxes, period):
+    '''
+    Phase the data with each trial period in period and sort it by phase
 
-    phases = []
-
-    for jd in julian_dates:
-        phases.append((jd / period) % 1)
-
-    (sortedPhases, sortedFluxes) = sortByPhase(phases, fluxes)
+    Returns
+    -------
+    sortedPhases, sortedFluxes : numpy array
+            Arrays of shape (periods, datapoints), one row per trial period
+    '''
+    phases = (asarray(julian_dates)[None,:] / np.atleast_1d(period)[:,None]) % 1
+    phaseIndices = npargsort(phases, axis=1)
 
-    return(sortedPhases, sortedFluxes)
+    return np.take_along_axis(phases, phaseIndices, axis=1), asarray(fluxes)[phaseIndices]
 
 #########################################
 
@@ -1438,64 +1684,75 @@ def find_minimum(array1, array2):
 
 def sum_distances (sortedPhases, sortedNormalizedFluxes):
 
-    distanceSum = 0.0
+    # String length of each row of phased data
+    fluxdiff = np.diff(sortedNormalizedFluxes, axis=1)
+    phasediff = np.diff(sortedPhases, axis=1)
 
-    for i in range(0, (len(sortedPhases) - 1)):
-        fluxdiff = sortedNormalizedFluxes[i + 1] - sortedNormalizedFluxes[i]
-        phasediff = sortedPhases[i + 1] - sortedPhases[i]
-
-        distanceSum = distanceSum + (((fluxdiff ** 2) + (phasediff ** 2)) ** 0.5)
-
-    return(distanceSum)
+    return np.sqrt((fluxdiff ** 2) + (phasediff ** 2)).sum(axis=1)
 
 #########################################
 
 def sum_stdevs (sortedPhases, sortedNormalizedFluxes, numBins):
 
-    stdevSum = 0.0
+    # Bins hold equal numbers of consecutive points in phase order, so the same positions fall in each bin
+    # whatever the trial period
+    positions = nparange(sortedPhases.shape[1])
+    stdevSum = np.zeros(sortedPhases.shape[0])
 
     for i in range (0, numBins):
-        fluxes_inrange = []
-        minIndex = (float(i) / float(numBins)) * float(len(sortedPhases))
-        maxIndex = (float(i + 1) / float(numBins)) * float(len(sortedPhases))
-
-        for j in range (0, len(sortedPhases)):
-            if (j >= minIndex and j < maxIndex):
-                fluxes_inrange.append(sortedNormalizedFluxes[j])
+        minIndex = (float(i) / float(numBins)) * float(len(positions))
+        maxIndex = (float(i + 1) / float(numBins)) * float(len(positions))
+        inRange = (positions >= minIndex) & (positions < maxIndex)
 
-        stdev_of_bin_i = std(fluxes_inrange)
+        stdev_of_bin_i = std(sortedNormalizedFluxes[:, inRange], axis=1)
         stdevSum = stdevSum + stdev_of_bin_i
 
     return(stdevSum)
 
 #########################################
 
-def phase_dispersion_minimization(varData, periodsteps, minperiod, maxperiod, numBins, periodPath, variableName):
+def pdm_periodogram(julian_dates, normalizedFluxes, numBins, periods):
 
-    periodguess_array = []
-    distance_results = []
-    stdev_results = []
+    # String lengths and summed bin standard deviations for each trial period, in the first and second rows.
+    # Trial periods are phased and sorted in blocks, as large as PERIOD_BLOCK_MEMORY allows
+    results = np.zeros((2, len(periods)))
 
-    (julian_dates, fluxes) = (varData[:,0],varData[:,1])
-    normalizedFluxes = normalize(fluxes)
+    for block in trial_blocks(len(periods), len(julian_dates)):
+        (sortedPhases, sortedNormalizedFluxes) = getPhases(julian_dates, normalizedFluxes, periods[block])
+
+        results[0, block] = sum_distances(sortedPhases, sortedNormalizedFluxes)
+        results[1, block] = sum_stdevs(sortedPhases, sortedNormalizedFluxes, numBins)
+
+    return results
+
+#########################################
 
-    for r in range(periodsteps):
-        periodguess = minperiod + (r * ((maxperiod-minperiod)/periodsteps))
-        (sortedPhases, sortedNormalizedFluxes) = getPhases(julian_dates, normalizedFluxes, periodguess)
+def phase_dispersion_minimization(varData, periodsteps, minperiod, maxperiod, numBins, periodPath, variableName, nworkers=1, adaptive=False,
+                                  oversampling=None):
 
-        distance_sum = sum_distances(sortedPhases, sortedNormalizedFluxes)
-        stdev_sum = sum_stdevs(sortedPhases, sortedNormalizedFluxes, numBins)
+    (julian_dates, fluxes) = (varData[:,0],varData[:,1])
+    normalizedFluxes = normalize(fluxes)
 
-        periodguess_array.append(periodguess)
-        distance_results.append(distance_sum)
-        stdev_results.append(stdev_sum)
+    # Trial periods are periodsteps evenly spaced periods, or with oversampling those of trial_grid.
+    # With adaptive, only the trial periods coarse_to_fine picks out are searched, and saved to the trials file
+    if oversampling:
+        periodguess_array = 1.0 / trial_grid(julian_dates, minperiod, maxperiod, oversampling).frequencies[::-1]
+    else:
+        periodguess_array = minperiod + (nparange(periodsteps) * ((maxperiod-minperiod)/periodsteps))
+    search = partial(pdm_periodogram, julian_dates, normalizedFluxes, numBins)
+    if adaptive:
+        (periodguess_array, (distance_results, stdev_results)) = coarse_to_fine(search, periodguess_array, julian_dates,
+                                                                                periods=True, minimum=True, nworkers=nworkers)
+    else:
+        (distance_results, stdev_results) = parallel_periodogram(search, periodguess_array, nworkers)
 
-    periodTrialMatrix=[]
-    for r in range(periodsteps):
-        periodTrialMatrix.append([periodguess_array[r],distance_results[r],stdev_results[r]])
-    periodTrialMatrix=np.asarray(periodTrialMatrix)
+    periodTrialMatrix = np.c_[periodguess_array, distance_results, stdev_results]
     np.savetxt(periodPath / f"{variableName}_Trials.csv", periodTrialMatrix, delimiter=",", fmt='%0.8f')
 
+    periodguess_array = periodguess_array.tolist()
+    distance_results = distance_results.tolist()
+    stdev_results = stdev_results.tolist()
+
     (distance_minperiod, distance_min) = find_minimum(distance_results, periodguess_array)
     (stdev_minperiod, stdev_min) = find_minimum(stdev_results, periodguess_array)
 
@@ -1535,7 +1792,7 @@ def phase_dispersion_minimization(varData, periodsteps, minperiod, maxperiod, nu
         thresholdvalue=beginValue+(0.5*totalRange)
 
         while True:
-            if beginIndex+stepper+1 == periodsteps:
+            if beginIndex+stepper+1 == len(periodguess_array):
                 righthandP=periodguess_array[beginIndex+stepper]
                 logger.debug("Warning: Peak period for stdev method too close to top of range")
                 break
@@ -1569,7 +1826,7 @@ def phase_dispersion_minimization(varData, periodsteps, minperiod, maxperiod, nu
     stepper=0
     thresholdvalue=beginValue+(0.5*totalRange)
     while True:
-        if beginIndex+stepper+1 == periodsteps:
+        if beginIndex+stepper+1 == len(periodguess_array):
             righthandP=periodguess_array[beginIndex+stepper]
             logger.debug("Warning: Peak period for distance method too close to top of range")
             break
@@ -1585,27 +1842,105 @@ def phase_dispersion_minimization(varData, periodsteps, minperiod, maxperiod, nu
 
 #########################################
 
-def LombScargleMultiterm(infile, t, m, d, periodlower=0.2, periodupper=2.5, nterms=1, multisearch=False, samples=5,
-                         disablelightcurve=False, periodPath=False, variableName="NoName"):
-    #print(
-    #    'using ' + str(samples) + ' samples per peak, start P = ' + str(periodlower) + ', end P = ' + str(periodupper))
-    # Calculate the Lomb-Scargle periodogram values
-    ls = LombScargle(t, m, d, nterms=nterms)
-    freq, power = ls.autopower(samples_per_peak=samples, minimum_frequency=1 / periodupper,
-                               maximum_frequency=1 / periodlower)
+def lomb_scargle_multiterm(t, m, d, frequency, nterms=(1, 2, 3, 4, 5, 6)):
+    '''
+    Lomb-Scargle periodograms of Fourier models with each number of terms in nterms, on one regular grid of frequencies
+
+    Models of more than one term are fitted as in the fastchi2 method of astropy, from sums of the sines and cosines
+    of the harmonics of each frequency. Here those sums are worked out once, up to the highest harmonic any of the
+    models needs, and shared between them, and the normal equations of a block of frequencies are solved at once.
+    A single term uses the fast method of astropy. Grids of 200 frequencies or fewer, for which astropy would not use
+    its fast methods, are left to astropy, as is every grid if the astropy version in use has no trig_sum.
 
+    Parameters
+    ----------
+    t, m, d : numpy array
+            Times, magnitudes and magnitude errors
+    frequency : numpy array
+            Evenly spaced frequencies, as from LombScargle.autofrequency
+    nterms : sequence of int
+            Numbers of Fourier terms of the models
+
+    Returns
+    -------
+    power : numpy array
+            Of shape (len(nterms), len(frequency)), the power of each model at each frequency, normalised as
+            LombScargle normalises it by default
+    '''
+    (t, m, d) = (np.asarray(t, dtype=float), np.asarray(m, dtype=float), np.asarray(d, dtype=float))
+    frequency = np.asarray(frequency, dtype=float)
+    power = np.zeros((len(nterms), len(frequency)))
+    if len(frequency) <= 200 or trig_sum is None:
+        for q, n in enumerate(nterms):
+            power[q] = LombScargle(t, m, d, nterms=n).power(frequency, assume_regular_frequency=True)
+        return power
+
+    (f0, df, nf) = (frequency[0], frequency[1] - frequency[0], len(frequency))
+    maxterms = int(np.max(nterms))
+    w = d**-2.0
+    y = m - np.dot(w, m) / np.sum(w)
+    chi2Reference = np.dot(y / d, y / d)
+
+    # Rows k and sinRow + k of weightSums are the sums of w cos and w sin of harmonic k, and rows k and maxterms + 1 + k
+    # of dataSums those of w y cos and w y sin
+    sinRow = 2 * maxterms + 1
+    (sinW, cosW) = zip(*([(np.zeros(nf), np.full(nf, np.sum(w)))] +
+                         [trig_sum(t, w, df, nf, f0=f0, freq_factor=k) for k in range(1, 2 * maxterms + 1)]))
+    (sinY, cosY) = zip(*([(np.zeros(nf), np.full(nf, np.sum(w * y)))] +
+                         [trig_sum(t, w * y, df, nf, f0=f0, freq_factor=k) for k in range(1, maxterms + 1)]))
+    weightSums = np.vstack(cosW + sinW)
+    dataSums = np.vstack(cosY + sinY)
+
+    for q, n in enumerate(nterms):
+        if n == 1:
+            power[q] = LombScargle(t, m, d).power(frequency, assume_regular_frequency=True)
+            continue
+
+        # Each element of the normal matrix is half the sum or difference of two rows of weightSums, from
+        # 2 sin(ax) sin(bx) = cos(a-b)x - cos(a+b)x, 2 cos(ax) cos(bx) = cos(a-b)x + cos(a+b)x and
+        # 2 sin(ax) cos(bx) = sin(a-b)x + sin(a+b)x
+        order = [('C', 0)] + [(kind, k) for k in range(1, n + 1) for kind in 'SC']
+        size = len(order)
+        (first, second) = (np.zeros((size, size), dtype=int), np.zeros((size, size), dtype=int))
+        (firstSign, secondSign) = (np.ones((size, size)), np.ones((size, size)))
+        for b, (kindB, kB) in enumerate(order):
+            for a, (kindA, kA) in enumerate(order):
+                if kindA == kindB:
+                    (first[b, a], second[b, a]) = (abs(kA - kB), kA + kB)
+                    secondSign[b, a] = -1 if kindA == 'S' else 1
+                else:
+                    (first[b, a], second[b, a]) = (sinRow + abs(kA - kB), sinRow + kA + kB)
+                    firstSign[b, a] = np.sign(kA - kB) if kindA == 'S' else np.sign(kB - kA)
+        dataRows = [k if kind == 'C' else maxterms + 1 + k for (kind, k) in order]
+
+        for block in trial_blocks(nf, size * size):
+            normal = 0.5 * (firstSign[..., None] * weightSums[first, block] + secondSign[..., None] * weightSums[second, block])
+            normal = np.moveaxis(normal, -1, 0)
+            projection = dataSums[dataRows, block].T
+            solution = np.linalg.solve(normal, projection[..., None])[..., 0]
+            power[q, block] = np.sum(projection * solution, axis=1) / chi2Reference
+
+    return power
+
+
+def lomb_scargle_figures(infile, t, m, d, nterms, frequency, power, periodlower, periodupper,
+                         disablelightcurve=False, periodPath=False, variableName="NoName"):
+    '''
+    Save the likelihood plot of a Lomb-Scargle periodogram and the lightcurve phased on its best period, with the
+    Fourier fit over it
+    '''
     # Create the likelihood plot
     fig2, ax2 = plt.subplots(figsize=(8, 6))
     ax2.set(xlabel='Period',
             ylabel='Power',
             title=' Lomb-Scargle N=' + str(nterms) + ' Likelihood\n Period Range [' + str(
                 periodlower) + ', ' + str(periodupper) + ']')
-    ax2.plot(1 / freq, power, '-k', rasterized=True)
+    ax2.plot(1 / frequency, power, '-k', rasterized=True)
     tempfile=str(f"{variableName}_LombScargle_N" + str(nterms) + "_LikelihoodPlot.png")
     plt.savefig(periodPath / tempfile)
 
     # Find peak of the likelihood plot (most likely frequency)
-    best_freq = freq[np.argmax(power)]
+    best_freq = frequency[np.argmax(power)]
 
     if not disablelightcurve:
         # Create phased lightcurve for fourier fit
@@ -1616,6 +1951,7 @@ def LombScargleMultiterm(infile, t, m, d, periodlower=0.2, periodupper=2.5, nter
         ax.errorbar((t * best_freq) % 1, m, d,
                     fmt='.', color='gray', ecolor='lightgray', capsize=0, zorder=1)
         # Plot Fourier fit over to of data
+        ls = LombScargle(t, m, d, nterms=nterms)
         ax.plot(phase_fit, ls.model(phase_fit / best_freq, best_freq), '-k', lw=2, zorder=5)
         ax.text(0.98, 0.03, "P = {0:.5f} days".format(1 / best_freq),
                 ha='right', va='bottom', transform=ax.transAxes)
@@ -1624,30 +1960,55 @@ def LombScargleMultiterm(infile, t, m, d, periodlower=0.2, periodupper=2.5, nter
         tempfile=str(f"{variableName}_LombScargle_N" + str(nterms) + "_Lightcurve.png")
         plt.savefig(periodPath / tempfile)
 
+    plt.close('all')
+
+
+def LombScargleMultiterm(infile, t, m, d, periodlower=0.2, periodupper=2.5, nterms=1, multisearch=False, samples=5,
+                         disablelightcurve=False, periodPath=False, variableName="NoName"):
+    #print(
+    #    'using ' + str(samples) + ' samples per peak, start P = ' + str(periodlower) + ', end P = ' + str(periodupper))
+    # Calculate the Lomb-Scargle periodogram values
+    freq = LombScargle(t, m, d).autofrequency(samples_per_peak=samples, minimum_frequency=1 / periodupper,
+                                              maximum_frequency=1 / periodlower)
+    power = lomb_scargle_multiterm(t, m, d, freq, nterms=[nterms])[0]
+
+    lomb_scargle_figures(infile, t, m, d, nterms, freq, power, periodlower, periodupper,
+                         disablelightcurve=disablelightcurve, periodPath=periodPath, variableName=variableName)
+
+    # Find peak of the likelihood plot (most likely frequency)
+    best_freq = freq[np.argmax(power)]
     best_period = 1 / best_freq
 
-    plt.close('all')
     return (best_period)
 
 
+def plot_lomb_scargle(periodPath, variableName, disablelightcurve=False):
+    '''
+    Save the Lomb-Scargle figures of the periodograms plot_with_period saved for variableName in periodPath, when
+    plot_with_period was asked to leave them for later
+    '''
+    with load(periodPath / f"{variableName}_LombScargle.npz") as saved:
+        for (nterms, power) in zip(saved['nterms'], saved['power']):
+            lomb_scargle_figures('periodifile', saved['times'], saved['mags'], saved['errs'], int(nterms), saved['frequency'],
+                                 power, float(saved['periodlower']), float(saved['periodupper']),
+                                 disablelightcurve=disablelightcurve, periodPath=periodPath, variableName=variableName)
+
+
 #########################################
 
 
-def plot_with_period(paths, filterCode, numBins = 10, minperiod=0.2, maxperiod=1.2, periodsteps=10000):
+def plot_with_period(paths, filterCode, numBins = 10, minperiod=0.2, maxperiod=1.2, periodsteps=10000, workers=1, adaptive=False, oversampling=None, deferplots=False):
 
     if minperiod==-99.9:
             minperiod=0.05
 
     if maxperiod==-99.9:
         # Load in list of used files
-        fileList = []
-        with open(paths['parent'] / "usedImages.txt", "r") as f:
-            for line in f:
-                fileList.append(line.strip())
+        fileList = used_images(paths['parent'])
 
         dateList=[]
         for file in fileList:
-            dateList.append(file.split('_')[2].replace('d','.'))
+            dateList.append(Path(file).name.split('_')[2].replace('d','.'))
         dateList=np.asarray(dateList,dtype=float)
         maxperiod=(np.max(dateList)-np.min(dateList))/3 # At least three periods should fit into the dataset.
 
@@ -1661,7 +2022,12 @@ def plot_with_period(paths, filterCode, numBins = 10, minperiod=0.2, maxperiod=1
 
     logger.info("Minimum Period Tested  : " +str(minperiod))
     logger.info("Maximum Period Tested  : " +str(maxperiod))
-    logger.info("Number of Period Trials: " +str(periodsteps))
+    if oversampling:
+        logger.info("Trial Periods Evenly Spaced in Frequency, Oversampling: " +str(oversampling))
+    else:
+        logger.info("Number of Period Trials: " +str(periodsteps))
+    if adaptive:
+        logger.info("Refining only the best peaks of a coarse search")
 
     trialRange=[minperiod, maxperiod]
 
@@ -1688,7 +2054,14 @@ def plot_with_period(paths, filterCode, numBins = 10, minperiod=0.2, maxperiod=1
         if calibFile.exists():
             calibData=genfromtxt(calibFile, dtype=float, delimiter=',')
 
-        pdm=phase_dispersion_minimization(varData, periodsteps, minperiod, maxperiod, numBins, periodPath, variableName)
+        if oversampling:
+            grid = trial_grid(varData[:,0], minperiod, maxperiod, oversampling)
+            logger.info("{} Trial Periods, Resolution {:.3g} d at {} d to {:.3g} d at {} d".format(
+                len(grid.frequencies), grid.resolution[0], minperiod, grid.resolution[1], maxperiod))
+
+        pdm=phase_dispersion_minimization(varData, periodsteps, minperiod, maxperiod, numBins, periodPath, variableName, nworkers=workers, adaptive=adaptive,
+                                          oversampling=oversampling)
+        trialCount=len(pdm["periodguess_array"])
 
         plt.figure(figsize=(15, 5))
 
@@ -1704,7 +2077,7 @@ def plot_with_period(paths, filterCode, numBins = 10, minperiod=0.2, maxperiod=1
 
         plt.plot(pdm["periodguess_array"], pdm["distance_results"])
         plt.gca().invert_yaxis()
-        plt.title("Range {0} d  Steps: {1}".format(trialRange, periodsteps))
+        plt.title("Range {0} d  Steps: {1}".format(trialRange, trialCount))
         plt.xlabel(r"Trial Period")
         plt.ylabel(r"Likelihood of Period")
         plt.savefig(periodPath / f"{variableName}_StringLikelihoodPlot.png")
@@ -1715,7 +2088,7 @@ def plot_with_period(paths, filterCode, numBins = 10, minperiod=0.2, maxperiod=1
         plt.errorbar(phaseTest, varData[:,1], yerr=varData[:,2], linestyle='None')
         plt.errorbar(phaseTest+1, varData[:,1], yerr=varData[:,2], linestyle='None')
         plt.gca().invert_yaxis()
-        plt.title("Period: {0} d  Steps: {1}".format(pdm["distance_minperiod"], periodsteps))
+        plt.title("Period: {0} d  Steps: {1}".format(pdm["distance_minperiod"], trialCount))
         plt.xlabel(r"Phase ($\phi$)")
         plt.ylabel(f"Differential {filterCode} Magnitude")
         plt.savefig(periodPath / f"{variableName}_StringTestPeriodPlot.png")
@@ -1728,7 +2101,7 @@ def plot_with_period(paths, filterCode, numBins = 10, minperiod=0.2, maxperiod=1
             plt.errorbar(phaseTestCalib, calibData[:,1], yerr=varData[:,2], linestyle='None')
             plt.errorbar(phaseTestCalib+1, calibData[:,1], yerr=varData[:,2], linestyle='None')
             plt.gca().invert_yaxis()
-            plt.title("Period: {0} d  Steps: {1}".format(pdm["distance_minperiod"], periodsteps))
+            plt.title("Period: {0} d  Steps: {1}".format(pdm["distance_minperiod"], trialCount))
             plt.xlabel(r"Phase ($\phi$)")
             plt.ylabel(f"Calibrated {filterCode} Magnitude")
             plt.savefig(periodPath / f"{variableName}_StringTestPeriodPlot_Calibrated.png")
@@ -1766,7 +2139,7 @@ def plot_with_period(paths, filterCode, numBins = 10, minperiod=0.2, maxperiod=1
 
         plt.plot(pdm["periodguess_array"], pdm["stdev_results"])
         plt.gca().invert_yaxis()
-        plt.title("Range {0} d  Steps: {1}".format(trialRange, periodsteps))
+        plt.title("Range {0} d  Steps: {1}".format(trialRange, trialCount))
         plt.xlabel(r"Trial Period")
         plt.ylabel(r"Likelihood of Period")
         plt.savefig(periodPath / f"{variableName}_PDMLikelihoodPlot.png")
@@ -1779,7 +2152,7 @@ def plot_with_period(paths, filterCode, numBins = 10, minperiod=0.2, maxperiod=1
         plt.errorbar(phaseTest, varData[:,1], yerr=varData[:,2], linestyle='None')
         plt.errorbar(phaseTest+1, varData[:,1], yerr=varData[:,2], linestyle='None')
         plt.gca().invert_yaxis()
-        plt.title("Period: {0} d  Steps: {1}".format(pdm["stdev_minperiod"], periodsteps))
+        plt.title("Period: {0} d  Steps: {1}".format(pdm["stdev_minperiod"], trialCount))
         plt.xlabel(r"Phase ($\phi$)")
         plt.ylabel(r"Differential " + str(filterCode) + " Magnitude")
         plt.savefig(periodPath / f"{variableName}_PDMTestPeriodPlot.png")
@@ -1792,7 +2165,7 @@ def plot_with_period(paths, filterCode, numBins = 10, minperiod=0.2, maxperiod=1
             plt.errorbar(phaseTestCalib, calibData[:,1], yerr=varData[:,2], linestyle='None')
             plt.errorbar(phaseTestCalib+1, calibData[:,1], yerr=varData[:,2], linestyle='None')
             plt.gca().invert_yaxis()
-            plt.title("Period: {0} d  Steps: {1}".format(pdm["stdev_minperiod"], periodsteps))
+            plt.title("Period: {0} d  Steps: {1}".format(pdm["stdev_minperiod"], trialCount))
             plt.xlabel(r"Phase ($\phi$)")
             plt.ylabel(r"Calibrated " + str(filterCode) + " Magnitude")
             plt.savefig(periodPath / f"{variableName}_PDMTestPeriodPlot_Calibrated.png")
@@ -1854,24 +2227,31 @@ def plot_with_period(paths, filterCode, numBins = 10, minperiod=0.2, maxperiod=1
             if minperbin > 10:
                 minperbin=10
 
-            aovoutput=aov_periodfind((calibData[:,0]),(calibData[:,1]),(calibData[:,2]), sigclip=False, autofreq=False, startp=minperiod, endp=maxperiod, phasebinsize=binsize, mindetperbin=minperbin, periodPath=periodPath, variableName=variableName)
+            aovoutput=aov_periodfind((calibData[:,0]),(calibData[:,1]),(calibData[:,2]), sigclip=False, autofreq=bool(oversampling), samplesperpeak=oversampling or 5, startp=minperiod, endp=maxperiod, phasebinsize=binsize, mindetperbin=minperbin, nworkers=workers, adaptive=adaptive, periodPath=periodPath, variableName=variableName)
 
             logger.debug("Theta Anova Method Estimate (days): " + str(aovoutput["bestperiod"]))
 
-            aovhmoutput=aovhm_periodfind((calibData[:,0]),(calibData[:,1]),(calibData[:,2]), sigclip=False, autofreq=False, startp=minperiod, endp=maxperiod, periodPath=periodPath, variableName=variableName)
+            aovhmoutput=aovhm_periodfind((calibData[:,0]),(calibData[:,1]),(calibData[:,2]), sigclip=False, autofreq=bool(oversampling), samplesperpeak=oversampling or 5, startp=minperiod, endp=maxperiod, nworkers=workers, adaptive=adaptive, periodPath=periodPath, variableName=variableName)
 
             logger.debug("Harmonic Anova Method Estimate (days): " + str(aovhmoutput["bestperiod"]))
 
 
             # LOMB SCARGLE
-            for nts in range(6):
-
-                lscargoutput = LombScargleMultiterm('periodifile', (calibData[:, 0]), (calibData[:, 1]), (calibData[:, 2]),
-                                                    nterms=nts+1,
-                                                    periodlower=minperiod, periodupper=maxperiod, samples=20,
-                                                    disablelightcurve=False, periodPath=periodPath, variableName=variableName)
+            # The periodograms of the 1 to 6 term models are worked out together and saved, so their figures can be
+            # left for plot_lomb_scargle to make later
+            lsNterms = np.arange(1, 7)
+            lsFrequency = LombScargle(calibData[:, 0], calibData[:, 1], calibData[:, 2]).autofrequency(
+                samples_per_peak=20, minimum_frequency=1 / maxperiod, maximum_frequency=1 / minperiod)
+            lsPower = lomb_scargle_multiterm(calibData[:, 0], calibData[:, 1], calibData[:, 2], lsFrequency, nterms=lsNterms)
+            np.savez(periodPath / f"{variableName}_LombScargle.npz", times=calibData[:, 0], mags=calibData[:, 1], errs=calibData[:, 2],
+                     frequency=lsFrequency, power=lsPower, nterms=lsNterms, periodlower=minperiod, periodupper=maxperiod)
 
+            for nts in range(6):
+                lscargoutput = 1 / lsFrequency[np.argmax(lsPower[nts])]
                 logger.debug('Lomb-Scargle N=' + str(nts+1) + ' Period Best Estimate: ' + str(lscargoutput))
 
+            if not deferplots:
+                plot_lomb_scargle(periodPath, variableName)
+
 
     return pdm["distance_minperiod"]
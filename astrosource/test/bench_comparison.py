@@ -0,0 +1,31 @@
+'''
+Time the array comparison statistics against the loop over every star in every image they replaced
+
+Run with python -m astrosource.test.bench_comparison
+'''
+from timeit import timeit
+
+import numpy
+
+from astrosource.comparison import ensemble_comparisons, calculate_comparison_variation
+from astrosource.test.test_comparison import comparison_variation_reference
+
+
+def bench(nImages=200, nComps=50, repeat=3):
+    rng = numpy.random.default_rng(1)
+    compFile = numpy.c_[rng.uniform(0, 360, nComps), rng.uniform(-90, 90, nComps)]
+    photFileArray = [numpy.c_[compFile, numpy.zeros((nComps, 2)), rng.uniform(1e3, 1e6, (nComps, 2))] for q in range(nImages)]
+    compIdx = [numpy.arange(nComps)] * nImages
+    compCounts = numpy.array([p[idx, 4] for p, idx in zip(photFileArray, compIdx)])
+
+    def array_version():
+        calculate_comparison_variation(compFile, compCounts, ensemble_comparisons(compCounts))
+
+    loopTime = timeit(lambda: comparison_variation_reference(compFile, photFileArray, compIdx), number=repeat) / repeat
+    arrayTime = timeit(array_version, number=repeat) / repeat
+    print("{} images, {} comparisons: loop {:.4f}s, arrays {:.4f}s ({:.0f}x)".format(nImages, nComps, loopTime, arrayTime, loopTime / arrayTime))
+
+
+if __name__ == '__main__':
+    for nImages, nComps in ((50, 10), (200, 50), (1000, 100)):
+        bench(nImages, nComps)
@@ -86,3 +86,7 @@ def mock_vizier_ps_r(*args, **kwargs):
 def mock_vizier_sdss_r(*args, **kwargs):
     mock = MagicMock(query_region=mock_vizier_query_region_sdss_r)
     return mock
+
+def mock_vizier_vsx(*args, **kwargs):
+    mock = MagicMock(query_region=mock_vizier_query_region_vsx)
+    return mock
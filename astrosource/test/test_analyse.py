@@ -0,0 +1,50 @@
+import numpy
+import os
+from pathlib import Path
+import pytest
+import shutil
+
+from astrosource.analyse import clip_outliers, get_total_counts, masked_stats, photometric_calculations
+from astrosource.utils import AstrosourceException, folder_setup
+
+
+TEST_PATH = Path(os.path.dirname(__file__)) / 'test_files' / 'comparison'
+
+
+def test_clip_outliers():
+    values = numpy.zeros((3, 40))
+    values[:, ::2] = 0.01
+    values[0, 5] = 1.0
+    values[1, 7] = numpy.inf
+    keep = numpy.ones(values.shape, dtype=bool)
+    keep[2, :] = False
+    clipped = clip_outliers(values, keep)
+    # The outlier is rejected and the rest kept
+    assert not clipped[0, 5]
+    assert clipped[0].sum() == 39
+    # Rows with unusable values or no values are left alone
+    assert (clipped[1] == keep[1]).all()
+    assert not clipped[2].any()
+
+    mean, std = masked_stats(values[0:1], clipped[0:1])
+    assert mean[0] == numpy.mean(values[0][clipped[0]])
+    assert abs(std[0] - numpy.std(values[0][clipped[0]])) < 1e-15
+
+def test_get_total_counts():
+    compData = numpy.random.default_rng(1).uniform(1e3, 1e6, (4, 30, 6))
+    # The counts of each file are added up comparison by comparison, as they always have been
+    totals = get_total_counts(compData)
+    for q in range(4):
+        assert totals[q, 0] == compData[q, :, 4].cumsum()[-1]
+        assert totals[q, 1] == compData[q, :, 5].cumsum()[-1]
+    assert (get_total_counts(numpy.zeros((4, 0, 6))) == 0).all()
+
+def test_photometry_no_targets(tmp_path):
+    paths = folder_setup(tmp_path)
+    for f in list(TEST_PATH.glob('*.npy')) + [TEST_PATH / 'compsUsed.csv']:
+        shutil.copy(f, tmp_path)
+    (tmp_path / 'usedImages.txt').write_text('\n'.join(f.name for f in sorted(TEST_PATH.glob('*.npy'))))
+    # A target far from every source is not in any image
+    targets = numpy.array([(10.0, 20.0, 0.0, 0.0)])
+    with pytest.raises(AstrosourceException, match="No target stars were detected"):
+        photometric_calculations(targets, paths)
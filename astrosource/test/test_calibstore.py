@@ -0,0 +1,49 @@
+import numpy
+
+from astrosource.calibstore import CalibratedStore
+
+
+def test_calibrated_store(tmp_path):
+    frames = {'frameA.npy': (numpy.arange(22.).reshape(2, 11), numpy.arange(9.).reshape(1, 9)),
+              'frameB.npy': (numpy.arange(33.).reshape(3, 11) + 100, numpy.zeros((0, 9)))}
+    store = CalibratedStore.create(tmp_path)
+    for name, (calibrated, compared) in frames.items():
+        store.append(name, calibrated, compared)
+    store.close()
+
+    store = CalibratedStore.open(tmp_path)
+    assert store.files == ['frameA', 'frameB']
+    assert (store.calibrated('frameB.npy') == frames['frameB.npy'][0]).all()
+    assert (store.compared('frameA') == frames['frameA.npy'][1]).all()
+    assert store.compared('frameB').shape == (0, 9)
+    assert store.calibrated_table().shape == (5, 11)
+
+    # Changes made to the whole table in place are seen frame by frame
+    table = store.calibrated_table(mode='r+')
+    table[:, 4] += 1
+    table.flush()
+    del table
+    assert (store.calibrated('frameA')[:, 4] == frames['frameA.npy'][0][:, 4] + 1).all()
+
+    store.export_csv()
+    assert (numpy.loadtxt(tmp_path / 'frameB.calibrated.csv', delimiter=',')[:, 0] == [100, 111, 122]).all()
+    assert (tmp_path / 'frameB.compared.csv').exists()
+    assert CalibratedStore.open(tmp_path / 'missing') is None
+
+
+def test_calibrated_store_discarded_on_error(tmp_path):
+    with CalibratedStore.create(tmp_path) as store:
+        store.append('frameA', numpy.zeros((2, 11)), numpy.zeros((1, 9)))
+    assert CalibratedStore.open(tmp_path).files == ['frameA']
+
+    # A run that fails part way leaves neither its own half-written files nor the previous index behind
+    try:
+        with CalibratedStore.create(tmp_path) as store:
+            store.append('frameB', numpy.zeros((2, 11)), numpy.zeros((1, 9)))
+            raise RuntimeError('calibration failed')
+    except RuntimeError:
+        pass
+    assert store._handles is None
+    assert CalibratedStore.open(tmp_path) is None
+    assert not (tmp_path / 'calibrated.dat').exists()
+    assert not (tmp_path / 'compared.dat').exists()
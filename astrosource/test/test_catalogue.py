@@ -0,0 +1,107 @@
+import time
+import pytest
+from collections import OrderedDict
+from functools import partial
+from astropy.coordinates import SkyCoord
+from astropy.units import degree
+
+from astrosource.catalogue import cached_query, sky_tile, retry_query, fetch_catalogues
+from astrosource.utils import AstrosourceException
+
+from astrosource.test.mocks import mock_vizier_query_region_vsx
+
+
+class LocalCatalogue:
+    # Stand-in for Vizier which counts the queries made and can be taken offline
+    def __init__(self):
+        self.calls = 0
+        self.online = True
+
+    def __call__(self, coord, radius):
+        if not self.online:
+            raise ConnectionError
+        self.calls += 1
+        return mock_vizier_query_region_vsx()
+
+
+@pytest.fixture()
+def field():
+    return SkyCoord(ra=163.26*degree, dec=-49.93*degree)
+
+def test_sky_tile(field):
+    name, centre = sky_tile(field)
+    assert centre.separation(field).degree < 0.1
+    # Nearby positions share the tile
+    assert sky_tile(SkyCoord(ra=centre.ra + 0.001*degree, dec=centre.dec))[0] == name
+    assert sky_tile(SkyCoord(ra=0*degree, dec=90*degree))[0] == sky_tile(SkyCoord(ra=10*degree, dec=89.99*degree))[0]
+
+def test_cached_query_offline(tmp_path, field):
+    catalogue = LocalCatalogue()
+    first = cached_query(catalogue, field, '0.33 deg', 'VSX', cachePath=tmp_path)
+    assert catalogue.calls == 1
+    assert len(first['B/vsx/vsx']) == 7
+
+    # The same field again, and one slightly offset, come from the cache without the network
+    catalogue.online = False
+    again = cached_query(catalogue, field, '0.33 deg', 'VSX', cachePath=tmp_path)
+    assert (again['B/vsx/vsx']['RAJ2000'] == first['B/vsx/vsx']['RAJ2000']).all()
+    nearby = SkyCoord(ra=field.ra, dec=field.dec + 0.001*degree)
+    assert len(cached_query(catalogue, nearby, '0.33 deg', 'VSX', cachePath=tmp_path)['B/vsx/vsx']) == 7
+
+    # Rows are cut to the cone that was asked for
+    assert len(cached_query(catalogue, field, '0.05 deg', 'VSX', cachePath=tmp_path)['B/vsx/vsx']) == 0
+
+    # Out of date tiles are fetched again, or used as they are when the catalogue cannot be reached
+    assert len(cached_query(catalogue, field, '0.33 deg', 'VSX', cachePath=tmp_path, ttl=0)['B/vsx/vsx']) == 7
+    catalogue.online = True
+    cached_query(catalogue, field, '0.33 deg', 'VSX', cachePath=tmp_path, ttl=0)
+    assert catalogue.calls == 2
+
+def test_cached_query_no_cache(field):
+    catalogue = LocalCatalogue()
+    cached_query(catalogue, field, '0.33 deg', 'VSX')
+    cached_query(catalogue, field, '0.33 deg', 'VSX')
+    assert catalogue.calls == 2
+
+def test_retry_query():
+    catalogue = LocalCatalogue()
+    attempts = []
+    def flaky():
+        attempts.append(1)
+        catalogue.online = len(attempts) > 2
+        return catalogue(None, None)
+    assert len(retry_query(flaky, 'VSX', backoff=0.01)['B/vsx/vsx']) == 7
+    assert len(attempts) == 3
+
+    catalogue.online = False
+    with pytest.raises(AstrosourceException):
+        retry_query(lambda: catalogue(None, None), 'VSX', deadline=0.05, backoff=0.01)
+
+def test_fetch_catalogues():
+    def slow(result, stop=None):
+        time.sleep(0.5)
+        return result
+    def unreachable(stop=None):
+        time.sleep(0.5)
+        raise AstrosourceException("Could not reach SDSS")
+    fetches = OrderedDict([('APASS', partial(slow, 'apass')), ('SDSS', unreachable), ('PanSTARRS', partial(slow, 'ps1'))])
+    start = time.monotonic()
+    with fetch_catalogues(fetches) as results:
+        assert list(results.keys()) == ['APASS', 'SDSS', 'PanSTARRS']
+        assert results['APASS'] == 'apass'
+        assert isinstance(results['SDSS'], AstrosourceException)
+        assert results['PanSTARRS'] == 'ps1'
+    # The queries run side by side
+    assert time.monotonic() - start < 1.0
+
+def test_fetch_catalogues_close():
+    catalogue = LocalCatalogue()
+    catalogue.online = False
+    fetches = OrderedDict([('APASS', lambda stop=None: 'apass'),
+                           ('SDSS', lambda stop=None: retry_query(lambda: catalogue(None, None), 'SDSS', deadline=60, stop=stop))])
+    start = time.monotonic()
+    results = fetch_catalogues(fetches)
+    assert results['APASS'] == 'apass'
+    # Once APASS has given enough stars the unreachable SDSS is not waited on
+    results.close()
+    assert time.monotonic() - start < 5.0
@@ -1,19 +1,23 @@
 from astropy.io import fits
 from astropy.coordinates import SkyCoord
-from astropy.units import degree
+from astropy.units import degree, arcsecond
 from numpy import array as nparray
 import os
 import pytest
-from numpy import asarray
+import shutil
+from numpy import asarray, log10, std, median, add, append, isnan, nanmedian
 from pathlib import Path
 from unittest.mock import patch, Mock
 
-from astrosource.identify import convert_photometry_files
+from astrosource.analyse import photometric_calculations
+from astrosource.identify import convert_photometry_files, gather_files, find_stars
+from astrosource.utils import folder_setup, used_images
 from astrosource.comparison import find_comparisons, read_data_files, find_reference_frame, \
-    remove_stars_targets, find_comparisons_calibrated, catalogue_call
+    remove_stars_targets, find_comparisons_calibrated, catalogue_call, ensemble_comparisons, \
+    calculate_comparison_variation, remove_from_ensemble, calibrate_frame
 
-from astrosource.test.mocks import mock_vizier_query_region_vsx, mock_vizier_apass_v, mock_vizier_apass_b, \
-    mock_vizier_ps_r, mock_vizier_sdss_r
+from astrosource.test.mocks import mock_vizier_apass_v, mock_vizier_apass_b, \
+    mock_vizier_ps_r, mock_vizier_sdss_r, mock_vizier_vsx
 
 
 TEST_PATH_PARENT = Path(os.path.dirname(__file__)) / 'test_files'
@@ -22,12 +26,15 @@ TEST_PATHS = {'parent': TEST_PATH_PARENT / 'comparison'}
 
 
 class TestSetup:
-    def __init__(self):
+    def __init__(self, tmpPath):
+        # Work on a copy of the test files, so the files made along the way are not left among them
+        self.paths = {'parent': tmpPath / 'comparison'}
+        shutil.copytree(TEST_PATHS['parent'], self.paths['parent'])
         # Create tmp files we need
-        used_files = TEST_PATHS['parent'] / 'usedImages.txt'
+        used_files = self.paths['parent'] / 'usedImages.txt'
         if used_files.exists():
             used_files.unlink()
-        files = TEST_PATHS['parent'].glob('*.psx')
+        files = self.paths['parent'].glob('*.psx')
         files = convert_photometry_files(files)
         with used_files.open(mode='w') as fid:
             for f in files:
@@ -36,14 +43,19 @@ class TestSetup:
         self.targets = nparray([(163.260366, -49.9063184, 0.00000000, 0.00000000)])
 
 @pytest.fixture()
-def setup():
-    return TestSetup()
+def setup(tmp_path):
+    return TestSetup(tmp_path)
+
+def find_test_comparisons(setup):
+    # stdComps.csv and compsUsed.csv as find_comparisons makes them, with VSX replaced by the local stand-in
+    with patch('astrosource.comparison.Vizier', mock_vizier_vsx):
+        return find_comparisons(targets=setup.targets, parentPath=setup.paths['parent'], fileList=setup.paths['parent'].glob('*.npy'))
 
 def test_read_data_files(setup):
-    files = os.listdir(TEST_PATHS['parent'])
-    fileslist = TEST_PATHS['parent'].glob('*.npy')
+    files = os.listdir(setup.paths['parent'])
+    fileslist = setup.paths['parent'].glob('*.npy')
     assert 'screenedComps.csv' in files
-    compFile, photFileArray = read_data_files(TEST_PATHS['parent'], fileslist)
+    compFile, photFileArray = read_data_files(setup.paths['parent'], fileslist)
     referenceFrame, fileRaDec = find_reference_frame(photFileArray)
     assert list(referenceFrame[0]) == [163.0227125,-49.9894795,2010.8022,14.4506,2957.311,79.35149,6.66097e-06,5.715005e-06]
     assert (fileRaDec[0].ra.degree, fileRaDec[0].dec.degree) == (163.0227125,-49.9894795)
@@ -52,32 +64,93 @@ def test_read_data_files(setup):
 
 def test_comparison(setup):
     # All files are present so we are ready to continue
-    filelist = TEST_PATHS['parent'].glob('*.npy')
-    outfile, num_cands = find_comparisons(targets=setup.targets, parentPath=TEST_PATHS['parent'], fileList=filelist)
+    outfile, num_cands = find_test_comparisons(setup)
 
-    assert outfile == TEST_PATHS['parent'] / "compsUsed.csv"
+    assert outfile == setup.paths['parent'] / "compsUsed.csv"
     assert num_cands == 19
 
-@patch('astrosource.comparison.Vizier.query_region',mock_vizier_query_region_vsx)
+@patch('astrosource.comparison.Vizier', mock_vizier_vsx)
 def test_remove_targets_calibrated(setup):
-    parentPath = TEST_PATHS['parent']
-    fileslist = TEST_PATHS['parent'].glob('*.npy')
+    parentPath = setup.paths['parent']
+    fileslist = setup.paths['parent'].glob('*.npy')
     compFile, photFileArray = read_data_files(parentPath, fileslist)
     assert compFile.shape == (101,2)
     compFile_out = remove_stars_targets(parentPath, compFile, acceptDistance=5.0, targetFile=setup.targets, removeTargets=1)
-    # 4 stars are removed because they are variable
-    assert compFile_out.shape == (97,2)
+    # The 7 variable stars of the stand-in VSX catalogue are all among the candidates, so 7 stars are removed
+    assert compFile_out.shape == (94,2)
 
 @patch('astrosource.comparison.Vizier',mock_vizier_apass_b)
 def test_find_comparisons_calibrated_b(setup):
-    compFile = find_comparisons_calibrated(filterCode='B', paths=TEST_PATHS, targets=setup.targets)
-
-    assert asarray(compFile).shape == (3,)
+    find_test_comparisons(setup)
+    compFile = find_comparisons_calibrated(filterCode='B', paths=setup.paths, targets=setup.targets)
+    assert asarray(compFile, dtype=object).shape == (3,)
 
 @patch('astrosource.comparison.Vizier',mock_vizier_apass_v)
 def test_find_comparisons_calibrated_v(setup):
-    compFile = find_comparisons_calibrated(filterCode='V', paths=TEST_PATHS, targets=setup.targets)
-    assert asarray(compFile).shape == (3,)
+    find_test_comparisons(setup)
+    compFile = find_comparisons_calibrated(filterCode='V', paths=setup.paths, targets=setup.targets)
+    assert asarray(compFile, dtype=object).shape == (3,)
+
+def test_comparison_variation():
+    compFile = nparray([[10.0, 20.0], [10.1, 20.1], [10.2, 20.2]])
+    compCounts = nparray([[1000.0, 2000.0, 500.0], [1100.0, 2000.0, 450.0], [900.0, 2100.0, 520.0], [1000.0, 1900.0, 0.0]])
+    fileCount = ensemble_comparisons(compCounts)
+    assert list(fileCount) == [3500.0, 3550.0, 3520.0, 2900.0]
+    stdCompStar, sortStars = calculate_comparison_variation(compFile, compCounts, fileCount)
+    for j in range(2):
+        diffMags = [2.5 * log10(compCounts[q, j] / fileCount[q]) for q in range(4)]
+        assert stdCompStar[j] == std(diffMags)
+        assert sortStars[j][3] == median(diffMags)
+    # A star with no counts in one image is flagged as invalid
+    assert stdCompStar[2] == 99
+    assert sortStars.shape == (3, 13)
+
+def comparison_variation_reference(compFile, photFileArray, compIdx):
+    # The ensemble counts and the variation of each comparison worked out one star and one image at a time
+    fileCount = []
+    for q, photFile in enumerate(photFileArray):
+        allCounts = 0.0
+        for j in range(len(compFile)):
+            allCounts = add(allCounts, photFile[compIdx[q][j]][4])
+        fileCount.append(allCounts)
+    stdCompStar = []
+    sortStars = []
+    for j, cf in enumerate(compFile):
+        compDiffMags = []
+        for q, photFile in enumerate(photFileArray):
+            compDiffMags = append(compDiffMags, 2.5 * log10(photFile[compIdx[q][j]][4] / fileCount[q]))
+            instrMags = -2.5 * log10(photFile[compIdx[q][j]][4])
+        stdCompDiffMags = std(compDiffMags)
+        if isnan(stdCompDiffMags):
+            stdCompDiffMags = 99
+        stdCompStar.append(stdCompDiffMags)
+        sortStars.append([cf[0], cf[1], stdCompDiffMags, nanmedian(compDiffMags), nanmedian(instrMags)] + [0.0] * 8)
+    return fileCount, stdCompStar, sortStars
+
+def test_comparison_variation_matches_loop():
+    fileList = sorted(TEST_PATHS['parent'].glob('*.npy'))
+    compFile, photFileArray = read_data_files(TEST_PATHS['parent'], fileList)
+    compCoords = SkyCoord(ra=compFile[:,0]*degree, dec=compFile[:,1]*degree)
+    compIdx = [compCoords.match_to_catalog_sky(SkyCoord(ra=p[:,0]*degree, dec=p[:,1]*degree))[0] for p in photFileArray]
+    compCounts = nparray([p[idx, 4] for p, idx in zip(photFileArray, compIdx)])
+    fileCount = ensemble_comparisons(compCounts)
+    stdCompStar, sortStars = calculate_comparison_variation(compFile, compCounts, fileCount)
+    # The array version gives exactly the numbers of the loop over every star in every image
+    refCount, refStd, refSort = comparison_variation_reference(compFile, photFileArray, compIdx)
+    assert list(fileCount) == refCount
+    assert list(stdCompStar) == refStd
+    assert sortStars.tolist() == refSort
+
+def test_ensemble_no_comparisons():
+    # Images with no comparisons left have an empty ensemble rather than raising
+    assert list(ensemble_comparisons(nparray([[], []]))) == [0.0, 0.0]
+
+def test_remove_from_ensemble():
+    compCounts = nparray([[1000.0, 2000.0, 500.0], [1100.0, 2000.0, 450.0]])
+    fileCount = ensemble_comparisons(compCounts)
+    fileCount = remove_from_ensemble(fileCount, compCounts, [0, 2])
+    assert list(fileCount) == [2000.0, 2000.0]
+    assert remove_from_ensemble(fileCount, compCounts, []) is fileCount
 
 @patch('astrosource.comparison.Vizier', mock_vizier_ps_r)
 def test_catalogue_call_panstarrs(setup):
@@ -91,3 +164,52 @@ def test_catalogue_call_sdss(setup):
     coord=SkyCoord(ra=163.096971*degree, dec=(-49.8792031*degree))
     resp = catalogue_call(coord,opt={'filter' : 'rmag', 'error' : 'e_rmag', 'colmatch' : 'imag', 'colerr' : 'e_imag', 'colname' : 'r-i', 'colrev' : '0'},cat_name='SDSS', targets=setup.targets, closerejectd=5.0)
     assert resp.ra.shape == (4,)
+
+@patch('astrosource.comparison.Vizier', mock_vizier_ps_r)
+def test_catalogue_call_removes_targets(setup):
+    coord=SkyCoord(ra=163.096971*degree, dec=(-49.8792031*degree))
+    opt={'filter' : 'rmag', 'error' : 'e_rmag', 'colmatch' : 'imag', 'colerr' : 'e_imag', 'colname' : 'r-i', 'colrev' : '0'}
+    # Only the catalogue star at the target position is removed, not others at a similar RA or Dec
+    targets = nparray([(163.096971, -49.8792031, 0.0, 0.0), (163.1466597, -40.0, 0.0, 0.0), (100.0, -50.0239071, 0.0, 0.0)])
+    resp = catalogue_call(coord, opt=opt, cat_name='PanSTARRS', targets=targets, closerejectd=5.0)
+    assert resp.ra.shape == (4,)
+    assert 163.096971 not in resp.ra
+
+def test_calibrate_frame():
+    from collections import namedtuple
+    cat = namedtuple('data', ['ra', 'dec', 'mag', 'emag', 'colmatch', 'colerr'])(
+        nparray([10.0, 10.01]), nparray([20.0, 20.0]), nparray([12.0, 13.0]), nparray([0.03, 0.04]), nparray([12.5, 13.2]), nparray([0.04, 0.03]))
+    catCoords = SkyCoord(ra=cat.ra*degree, dec=cat.dec*degree)
+    # Two stars in the catalogue and one that is not
+    photFile = nparray([[10.0, 20.0, 0, 0, 10000.0, 100.0, 0, 0],
+                        [10.01, 20.0, 0, 0, 1000.0, 10.0, 0, 0],
+                        [10.02, 20.0, 0, 0, 100.0, 1.0, 0, 0]])
+    calibStands = nparray([[10.0, 20.0, 0, 12.0, 0.03, 0, 12.5, 0.04, 0], [10.01, 20.0, 0, 13.0, 0.04, 0, 13.2, 0.03, 0]])
+    out, calibOut, zp = calibrate_frame(photFile, catCoords, cat, 2.5*arcsecond, 1, 0.1, calibStands, nparray([0, 1]))
+    assert list(out[:, 10]) == [1, 1, 0]
+    assert out[:, 8] == pytest.approx([0.5, 0.2, 0.35])
+    instMag = -2.5*log10(photFile[:, 4]) - 0.1*out[:, 8]
+    assert zp == pytest.approx(median(calibStands[:, 3] - instMag[:2]))
+    assert out[:, 4] == pytest.approx(instMag + zp)
+    assert out[:, 5] == pytest.approx(1.0857*0.01)
+    assert calibOut.shape == (2, 9)
+    assert calibOut[:, 5] == pytest.approx(calibStands[:, 3] - instMag[:2] - zp)
+
+@patch('astrosource.comparison.Vizier', mock_vizier_vsx)
+def test_pipeline_cache_path(tmp_path):
+    # Photometry files kept in a cache directory are listed by path, so every later stage can load them
+    paths = folder_setup(tmp_path / 'data')
+    for f in TEST_PATHS['parent'].glob('*.psx'):
+        shutil.copy(f, paths['parent'])
+    targets = nparray([(163.260366, -49.9063184, 0.00000000, 0.00000000)])
+    phot_files, filtercode = gather_files(paths, filetype='psx', cachePath=tmp_path / 'cache')
+    usedImages, stars = find_stars(targets, paths, phot_files)
+    assert usedImages
+    assert used_images(paths['parent']) == [str(tmp_path / 'cache' / Path(f).name) for f in usedImages]
+    assert not list(paths['parent'].glob('*.npy'))
+
+    find_comparisons(targets, paths['parent'], usedImages, removeTargets=False)
+    assert (paths['parent'] / 'compsUsed.csv').exists()
+    outputPhot = photometric_calculations(targets, paths)
+    assert len(outputPhot) == 1
+    assert len(outputPhot[0]) > 0
@@ -0,0 +1,47 @@
+import numpy
+import os
+from pathlib import Path
+import shutil
+
+from astrosource.identify import gather_files
+from astrosource.cube import build_cube, save_cube, load_cube, cube_stars, frame_metadata, reference_row
+
+
+TEST_PATH_PARENT = Path(os.path.dirname(__file__)) / 'test_files'
+
+TEST_PATHS = {'parent': TEST_PATH_PARENT / 'stars'}
+
+def test_frame_metadata():
+    files = ['XOd2_ip_57757d0532642000_2017d01d04T01d16d43d571_1a089113_22d284_kb29.npy', 'not_a_frame.npy']
+    time, airmass, exptime = frame_metadata(files)
+    assert time[0] == 57757.0532642
+    assert airmass[0] == 1.089113
+    assert exptime[0] == 22.284
+    assert numpy.isnan(time[1])
+
+def test_build_cube(tmp_path):
+    # Extract the photometry from a copy of the test images, so it is not left among them
+    paths = {'parent': tmp_path / 'stars'}
+    shutil.copytree(TEST_PATHS['parent'], paths['parent'])
+    phot_files, filtercode = gather_files(paths, filetype="fits")
+    phot_files = sorted(paths['parent'] / f for f in phot_files)
+    frames = [numpy.load(f) for f in phot_files]
+    stars = frames[0][:20]
+    cube = build_cube(tmp_path, stars, phot_files)
+    assert cube.data.shape == (2, 20, 6)
+    # Stars were taken from the first frame so they are measured exactly there
+    assert (cube.data[0] == frames[0][:20, 0:6]).all()
+    assert (cube.sep[0] == 0).all()
+    assert reference_row(cube) == int(numpy.argmax([f.shape[0] for f in frames]))
+
+    save_cube(tmp_path, cube)
+    loaded = load_cube(tmp_path)
+    assert isinstance(loaded.data, numpy.memmap)
+    assert (loaded.data == cube.data).all()
+    assert list(loaded.files) == list(cube.files)
+
+    # Stars missing from the cube are matched from the frames
+    data, sep = cube_stars(loaded, frames[0][10:30], paths['parent'])
+    assert (data[:, :10] == cube.data[:, 10:]).all()
+    assert (data[0, 10:] == frames[0][20:30, 0:6]).all()
+    assert load_cube(tmp_path / 'missing') is None
@@ -2,15 +2,32 @@ from astropy.io import fits
 import numpy
 import os
 from pathlib import Path
+import shutil
+import warnings
 
+from astrosource import identify
 from astrosource.identify import (rename_data_file, export_photometry_files,
-    extract_photometry, gather_files, find_stars)
+    extract_photometry, gather_files, find_stars, image_bjd_times, convert_photometry_files)
+from astrosource.utils import load_manifest, cleanup
+from astrosource.crossmatch import presence_matrix, build_match_index, save_match_index, frame_matches
 
 
 TEST_PATH_PARENT = Path(os.path.dirname(__file__)) / 'test_files'
 
 TEST_PATHS = {'parent': TEST_PATH_PARENT / 'stars'}
 
+def copy_test_files(tmp_path):
+    # A copy of the test files to work on, so the files made along the way are not left among them
+    paths = {'parent': tmp_path / 'stars'}
+    shutil.copytree(TEST_PATHS['parent'], paths['parent'])
+    return paths
+
+def extracted_frames(tmp_path):
+    # Photometry files extracted from a copy of the test images
+    paths = copy_test_files(tmp_path)
+    phot_files, filtercode = gather_files(paths, filetype="fits")
+    return sorted(paths['parent'] / f for f in phot_files)
+
 def test_rename_object():
     header = {  "OBJECT"    : "M1",
                 "FILTER1"   : "ip",
@@ -56,6 +73,42 @@ def test_rename_nomjd():
     exp_name = "M1_ip_UNKNOWN_2019d01d25T15d54d10d861857_1a6_20d0_kb92.npy"
     assert name == exp_name
 
+def test_rename_bjd_given():
+    header = {  "OBJECT"    : "M1",
+                "FILTER"    : "ip",
+                'EXPTIME'   : 20.0,
+                'DATE-OBS'  : "2019-01-25T15:54:10.861857",
+                'AIRMASS'   : 1.6,
+                'INSTRUME'  : 'kb92',
+                'MJD-OBS'   : 58508.3265502,
+                }
+    # A BJD worked out beforehand (see batch_mjd_bjd) is used as it is
+    name = rename_data_file(header, bjd=True, bjdTime=2458508.8307)
+    assert name == "M1_ip_2458508.8307_2019d01d25T15d54d10d861857_1a6_20d0_kb92.npy"
+
+def test_batch_mjd_bjd_offline(monkeypatch):
+    calls = []
+    def offline_bjd(JDUTC, leap_update=True, **kwargs):
+        # Stand-in for barycorrpy that fails like a leap second update without a network
+        calls.append(leap_update)
+        if leap_update:
+            raise OSError('Name or service not known')
+        return JDUTC.jd + 0.005, [], []
+    monkeypatch.setattr(identify.utc_tdb, 'JDUTC_to_BJDTDB', offline_bjd)
+
+    header = {'MJD-OBS': 58508.3265502, 'RA': '10:00:00', 'DEC': '-20:00:00', 'LONGITUD': -70.8, 'LATITUDE': -30.2, 'HEIGHT': 2200.}
+    headers = [header, dict(header, RA='11:00:00'), dict(header, **{'MJD-OBS': 58508.5})]
+    bjd = identify.batch_mjd_bjd(headers)
+    # The first batch is retried with the local table and the update is not tried again
+    assert calls == [True, False, False]
+    assert numpy.allclose(bjd, [2458508.8315502, 2458508.8315502, 2458509.005])
+
+def test_image_bjd_times_unreadable(tmp_path):
+    bad_file = tmp_path / 'broken_e91.fits'
+    bad_file.write_text('not a fits file')
+    # Images whose header cannot be read are left to fail on their own when extracted
+    assert image_bjd_times([bad_file]) == {}
+
 def test_extract_photometry(tmp_path):
     # tmp_path is a Path object for a temporary directory
     infile = TEST_PATHS['parent'] / 'photometry_teste91_1.fits'
@@ -69,24 +122,111 @@ def test_extract_photometry(tmp_path):
     # Test if csv file is as we expect
     assert result_phot.all() == test_phot.all()
 
-def test_gather_files():
+def test_gather_files(tmp_path):
 
-    phot_files, filtercode = gather_files(TEST_PATHS, filetype="fits")
+    phot_files, filtercode = gather_files(copy_test_files(tmp_path), filetype="fits")
     test_files = ['XOd2_ip_57757d0532642000_2017d01d04T01d16d43d571_1a089113_22d284_kb29.npy', 'XOd2_ip_57757d0522793000_2017d01d04T01d15d18d519_1a0899013_22d293_kb29.npy']
     assert phot_files.sort() == test_files.sort()
 
-def test_find_stars():
+def test_export_photometry_files_workers(tmp_path):
+    fits_files = sorted(TEST_PATHS['parent'].glob('*e91*.fits'))
+    (tmp_path / 'serial').mkdir()
+    (tmp_path / 'parallel').mkdir()
+    bad_file = tmp_path / 'broken_e91.fits'
+    bad_file.write_text('not a fits file')
+    filelist = [fits_files[0], bad_file, fits_files[1]]
+    serial = export_photometry_files(filelist, tmp_path / 'serial')
+    parallel = export_photometry_files(filelist, tmp_path / 'parallel', workers=2)
+    # The broken file is skipped and the others keep their order and names
+    assert list(parallel.items()) == list(serial.items())
+    assert list(parallel.values()) == [f.name for f in fits_files]
+
+def test_find_stars(tmp_path):
     targets = numpy.array([[117.0269708, 50.2258111, 0,0]])
-    phot_files, filtercode = gather_files(TEST_PATHS, filetype="fits")
-    usedImages = find_stars(targets, TEST_PATHS, phot_files)
+    paths = copy_test_files(tmp_path)
+    phot_files, filtercode = gather_files(paths, filetype="fits")
+    usedImages = find_stars(targets, paths, phot_files)
     images_list = [str(u) for u in usedImages]
     # Check the right files are saved
-    test_list = (TEST_PATHS['parent'] / 'usedImages_test.txt').read_text().strip().split('\n')
+    test_list = (paths['parent'] / 'usedImages_test.txt').read_text().strip().split('\n')
     assert images_list.sort() == test_list.sort()
-    # Clean up
-    (TEST_PATHS['parent'] / 'usedImages.txt').unlink()
-    test_files = ['XOd2_ip_57757d0522793000_2017d01d04_1a0899013_22d293_kb29.npy',
-                  'XOd2_ip_57757d0532642000_2017d01d04_1a089113_22d284_kb29.npy',
-                  'screenedComps.csv']
-    # for tf in test_files:
-    #     (TEST_PATHS['parent'] / tf).unlink()
+
+def test_presence_matrix(tmp_path):
+    phot_files = extracted_frames(tmp_path)
+    frames = [numpy.load(f) for f in phot_files]
+    stars = frames[0][:50]
+    present = presence_matrix(stars, frames, acceptDistance=1.0)
+    assert present.shape == (2, 50)
+    # Every star is trivially present in the frame it was taken from
+    assert present[0].all()
+    # A star well away from anything in the frame is not matched
+    present = presence_matrix(numpy.array([[0.0, 0.0]]), frames)
+    assert not present.any()
+    # A frame that cannot be matched has no stars present
+    present = presence_matrix(stars, [frames[0], None])
+    assert present[0].all() and not present[1].any()
+
+
+def test_frame_matches_uses_index(tmp_path):
+    phot_files = extracted_frames(tmp_path)
+    frames = [numpy.load(f) for f in phot_files]
+    stars = frames[0][:20]
+    idx, sep = build_match_index(stars, frames)
+    save_match_index(tmp_path, stars[:10], phot_files, frames)
+    # Half the stars come from the index, the rest are matched directly
+    idx_index, sep_index = frame_matches(tmp_path, stars, phot_files, frames)
+    assert (idx_index == idx).all()
+    assert numpy.allclose(sep_index, sep)
+    # Without an index everything is matched directly
+    idx_direct, _ = frame_matches(tmp_path / 'missing', stars, phot_files, frames)
+    assert (idx_direct == idx).all()
+
+def test_export_photometry_files_manifest(tmp_path):
+    fits_files = sorted(TEST_PATHS['parent'].glob('*e91*.fits'))
+    phot_dict = export_photometry_files(fits_files, tmp_path)
+    manifest = load_manifest(tmp_path)
+    assert sorted(e['output'] for e in manifest.values()) == sorted(phot_dict.keys())
+    # Unchanged images are not extracted again
+    for name in phot_dict:
+        (tmp_path / name).write_bytes(b'cached')
+    assert export_photometry_files(fits_files, tmp_path) == phot_dict
+    assert all((tmp_path / name).read_bytes() == b'cached' for name in phot_dict)
+    # A missing output is made again
+    first = list(phot_dict)[0]
+    (tmp_path / first).unlink()
+    export_photometry_files(fits_files, tmp_path)
+    assert numpy.load(tmp_path / first).shape[1] == 8
+    # cleanup removes exactly the generated files and the manifest
+    (tmp_path / 'other.npy').write_bytes(b'')
+    cleanup(tmp_path)
+    assert sorted(f.name for f in tmp_path.iterdir()) == ['other.npy']
+
+def test_convert_photometry_files_cache(tmp_path):
+    rows = ['163.01,-49.90,1531.3,7.4,3469.4,105.1,8.0e-06,6.5e-06'] * 4
+    rows[1] = '163.01,,1531.3,7.4,3469.4,105.1,8.0e-06,6.5e-06'
+    infile = tmp_path / 'test_V_1d0_2_1a0_1d0_kb.psx'
+    infile.write_text('\n'.join(rows) + '\n')
+    cache = tmp_path / 'cache'
+    new_files = convert_photometry_files([infile], cachePath=cache)
+    assert new_files == [str(cache / 'test_V_1d0_2_1a0_1d0_kb.npy')]
+    # The row with an empty field is dropped
+    assert numpy.load(new_files[0]).shape == (3, 8)
+    assert not (tmp_path / 'test_V_1d0_2_1a0_1d0_kb.npy').exists()
+
+def test_convert_photometry_files_chunks(tmp_path, monkeypatch):
+    rows = ['163.{:02d},-49.90,1531.3,7.4,3469.4,105.1,8.0e-06,6.5e-06'.format(q) for q in range(20)]
+    rows[5] = '163.05,,1531.3,7.4,3469.4,105.1,8.0e-06,6.5e-06'
+    infile = tmp_path / 'test_V_1d0_2_1a0_1d0_kb.psx'
+    infile.write_text('\n'.join(rows) + '\n')
+    whole = numpy.load(tmp_path / convert_photometry_files([infile], cachePath=tmp_path / 'whole')[0])
+    # Read a few rows at a time, the rows with nan are dropped from each chunk and the rest kept in order
+    monkeypatch.setattr(identify, 'PHOTOMETRY_CHUNK_ROWS', 3)
+    chunked = numpy.load(tmp_path / convert_photometry_files([infile], cachePath=tmp_path / 'chunked')[0])
+    assert whole.shape == (19, 8)
+    assert (chunked == whole).all()
+    # An empty file gives no photometry, and no warning
+    empty = tmp_path / 'empty_V_1d0_2_1a0_1d0_kb.psx'
+    empty.write_text('')
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert convert_photometry_files([empty], cachePath=tmp_path / 'chunked') == []
@@ -1,9 +1,13 @@
 from astropy.io import fits
+from astropy.timeseries import LombScargle
+from functools import partial
 import numpy as np
 import os
 from pathlib import Path
 import pytest
+import shutil
 
+from astrosource import periodic
 from astrosource.periodic import plot_with_period, phase_dispersion_minimization
 
 
@@ -27,30 +31,151 @@ TEST_FILES = [
             'V1_StringTestPeriodPlot_Calibrated.png',
             'V1_PDM_PhasedCalibMags.csv',
             'V1_StringTrial.csv',
+            'V1_LombScargle.npz',
 ]
 
-def test_pdm():
+def copy_test_files(tmp_path):
+    # A copy of the test files to work on, so the files made along the way are not left among them
+    shutil.copytree(TEST_PATHS['parent'], tmp_path / 'period')
+    return {'parent': tmp_path / 'period', 'outcatPath': tmp_path / 'period', 'periods': tmp_path / 'period'}
+
+def test_pdm(tmp_path):
     vardata = np.genfromtxt(TEST_PATHS['parent'] / 'V1_diffExcel.csv', dtype=float, delimiter=',')
     num = 10000
     minperiod = 0.2
     maxperiod = 1.2
     numBins= 10
-    periodPath = TEST_PATHS['periods']
+    periodPath = tmp_path
     variableName = 'V1'
     pdm = phase_dispersion_minimization(vardata, num,  minperiod, maxperiod, numBins, periodPath, variableName)
     assert 0.0045 == pytest.approx(pdm['stdev_error'])
     assert 0.0053 == pytest.approx(pdm['distance_error'])
     assert len(pdm['periodguess_array']) == num
-    teardown_function()
 
-def test_period_files_created():
-    plot_with_period(paths=TEST_PATHS, filterCode='B')
+def test_pdm_blocks(tmp_path, monkeypatch):
+    vardata = np.genfromtxt(TEST_PATHS['parent'] / 'V1_diffExcel.csv', dtype=float, delimiter=',')
+    whole = phase_dispersion_minimization(vardata, 1000, 0.2, 1.2, 10, tmp_path, 'V1')
+    # Trial periods worked through a few at a time give the same results
+    monkeypatch.setattr(periodic, 'PERIOD_BLOCK_MEMORY', 5000)
+    blocks = phase_dispersion_minimization(vardata, 1000, 0.2, 1.2, 10, tmp_path, 'V1')
+    assert blocks['distance_results'] == whole['distance_results']
+    assert blocks['stdev_results'] == whole['stdev_results']
+    assert (tmp_path / 'V1_Trials.csv').exists()
+
+def test_parallel_periodogram(tmp_path, monkeypatch):
+    vardata = np.genfromtxt(TEST_PATHS['parent'] / 'V1_diffExcel.csv', dtype=float, delimiter=',')
+    serial = phase_dispersion_minimization(vardata, 1000, 0.2, 1.2, 10, tmp_path, 'V1')
+    # Split across processes, the periodogram is joined back together in order
+    monkeypatch.setattr(periodic, 'NCPUS', 3)
+    split = phase_dispersion_minimization(vardata, 1000, 0.2, 1.2, 10, tmp_path, 'V1', nworkers=3)
+    assert split['distance_results'] == serial['distance_results']
+    assert split['stdev_results'] == serial['stdev_results']
+    assert periodic.parallel_periodogram(np.cumsum, np.ones(5), nworkers=3).shape == (5,)
+
+def aov_reference(times, mags, frequency, binsize, minbin, average):
+    # The AoV statistic worked out one bin at a time
+    phases = ((times - times[0]) * frequency) % 1
+    binned = np.digitize(phases, np.arange(0.0, 1.0, binsize))
+    all_xbar = np.median(mags)
+    s1, s2, goodbins = 0.0, 0.0, 0
+    for b in np.unique(binned):
+        binmags = mags[binned == b]
+        if binmags.size > minbin:
+            s1 += binmags.size * (average(binmags) - all_xbar)**2
+            s2 += np.sum((binmags - all_xbar)**2)
+            goodbins += 1
+    return (s1 / (goodbins - 1.0)) / (s2 / (times.size - goodbins))
+
+def test_aov_theta():
+    caldata = np.genfromtxt(TEST_PATHS['parent'] / 'V1_calibExcel.csv', dtype=float, delimiter=',')
+    times, mags, errs = caldata[:,0], caldata[:,1], caldata[:,2]
+    frequencies = np.linspace(1/1.2, 1/0.2, 50)
+    for binstat, average in (('median', np.median), ('mean', np.mean)):
+        theta = periodic.aov_theta(times, mags, errs, frequencies, binsize=0.1, minbin=4, binstat=binstat)
+        assert theta.shape == frequencies.shape
+        for f, t in zip(frequencies, theta):
+            assert t == pytest.approx(aov_reference(times, mags, f, 0.1, 4, average), rel=1e-9)
+    assert np.ndim(periodic.aov_theta(times, mags, errs, frequencies[0], binsize=0.1, minbin=4)) == 0
+
+def test_aovhm_theta_recurrence():
+    caldata = np.genfromtxt(TEST_PATHS['parent'] / 'V1_calibExcel.csv', dtype=float, delimiter=',')
+    times, mags, errs = caldata[:,0], caldata[:,1], caldata[:,2]
+    frequencies = np.arange(1/1.2, 1/0.2, 1.0e-4)
+    # A long evenly spaced sweep drifts no further than this from phasing at each frequency
+    swept = periodic.aovhm_theta(times, mags, errs, frequencies, 6, 1.0)
+    direct = [periodic.aovhm_theta(times, mags, errs, f, 6, 1.0) for f in frequencies[::500]]
+    assert swept[::500] == pytest.approx(direct, rel=1e-9)
+    phasors = periodic.trial_phasors(times - times[0], frequencies)
+    assert np.abs(phasors[-1] - np.exp(2j * np.pi * frequencies[-1] * (times - times[0]))).max() < 1e-9
+
+def test_aovhm_periodfind(tmp_path):
+    caldata = np.genfromtxt(TEST_PATHS['parent'] / 'V1_calibExcel.csv', dtype=float, delimiter=',')
+    found = periodic.aovhm_periodfind(caldata[:,0], caldata[:,1], caldata[:,2], sigclip=False, autofreq=False,
+        startp=0.2, endp=1.2, nworkers=1, periodPath=tmp_path, variableName='V1')
+    assert found['bestperiod'] == pytest.approx(0.52996, abs=1e-5)
+    # The periodogram is of the sorted, normalised magnitudes, so neither the order of the measurements nor
+    # the zero point of the magnitudes changes it
+    shuffled = caldata[np.random.default_rng(1).permutation(len(caldata))]
+    moved = periodic.aovhm_periodfind(shuffled[:,0], shuffled[:,1] + 5.0, shuffled[:,2], sigclip=False, autofreq=False,
+        startp=0.2, endp=1.2, nworkers=1, periodPath=tmp_path, variableName='V1')
+    assert moved['lspvals'] == pytest.approx(found['lspvals'], rel=1e-6)
+    assert moved['bestperiod'] == found['bestperiod']
+
+def test_coarse_to_fine(tmp_path):
+    vardata = np.genfromtxt(TEST_PATHS['parent'] / 'V1_diffExcel.csv', dtype=float, delimiter=',')
+    full = phase_dispersion_minimization(vardata, 20000, 0.2, 1.2, 10, tmp_path, 'V1')
+    adaptive = phase_dispersion_minimization(vardata, 20000, 0.2, 1.2, 10, tmp_path, 'V1', adaptive=True)
+    # The best periods of the full search are found from a part of its trials
+    assert len(adaptive['periodguess_array']) < 0.3 * len(full['periodguess_array'])
+    assert adaptive['distance_minperiod'] == full['distance_minperiod']
+    assert adaptive['stdev_minperiod'] == full['stdev_minperiod']
+
+    caldata = np.genfromtxt(TEST_PATHS['parent'] / 'V1_calibExcel.csv', dtype=float, delimiter=',')
+    times, mags, errs = periodic.resort_by_time(caldata[:,0], caldata[:,1], caldata[:,2])
+    frequencies = np.arange(1/1.2, 1/0.2, 1.0e-4)
+    search = partial(periodic.aov_periodogram, times, mags, errs, binsize=0.1, minbin=4)
+    trials, results = periodic.coarse_to_fine(search, frequencies, times)
+    full = search(frequencies)
+    assert np.isin(trials, frequencies).all()
+    assert trials[np.nanargmax(np.where(np.isfinite(results), results, np.nan))] == \
+        frequencies[np.nanargmax(np.where(np.isfinite(full), full, np.nan))]
+
+def test_trial_grid(tmp_path):
+    vardata = np.genfromtxt(TEST_PATHS['parent'] / 'V1_diffExcel.csv', dtype=float, delimiter=',')
+    times = vardata[:,0]
+    baseline = times.max() - times.min()
+    grid = periodic.trial_grid(times, 0.2, 1.2, 20)
+    assert grid.step == pytest.approx(1 / baseline / 20)
+    assert np.diff(grid.frequencies) == pytest.approx(grid.step)
+    assert grid.frequencies[0] == pytest.approx(1 / 1.2)
+    assert grid.frequencies[-1] < 1 / 0.2
+    assert grid.resolution == pytest.approx((grid.step * 0.2**2, grid.step * 1.2**2))
+
+    # Evenly spaced in frequency, far fewer trials find the same peak as many evenly spaced periods
+    even = phase_dispersion_minimization(vardata, 100000, 0.2, 1.2, 10, tmp_path, 'V1')
+    pdm = phase_dispersion_minimization(vardata, None, 0.2, 1.2, 10, tmp_path, 'V1', oversampling=20)
+    assert len(pdm['periodguess_array']) == len(grid.frequencies)
+    assert np.all(np.diff(pdm['periodguess_array']) > 0)
+    assert abs(1 / pdm['stdev_minperiod'] - 1 / even['stdev_minperiod']) < 0.5 / baseline
+
+def test_lomb_scargle_multiterm(monkeypatch):
+    caldata = np.genfromtxt(TEST_PATHS['parent'] / 'V1_calibExcel.csv', dtype=float, delimiter=',')
+    times, mags, errs = caldata[:,0], caldata[:,1], caldata[:,2]
+    # Sharing the harmonic sums between models gives the periodograms astropy gives for each model on its own
+    for (minperiod, maxperiod) in ((0.2, 1.2), (0.5, 0.6)):
+        frequency = LombScargle(times, mags, errs).autofrequency(samples_per_peak=20, minimum_frequency=1/maxperiod,
+                                                                  maximum_frequency=1/minperiod)
+        power = periodic.lomb_scargle_multiterm(times, mags, errs, frequency, nterms=[1, 2, 4])
+        for (nterms, p) in zip([1, 2, 4], power):
+            expected = LombScargle(times, mags, errs, nterms=nterms).autopower(samples_per_peak=20,
+                minimum_frequency=1/maxperiod, maximum_frequency=1/minperiod)[1]
+            assert p == pytest.approx(expected, rel=1e-10, abs=1e-12)
+    # Without trig_sum astropy works out each model
+    monkeypatch.setattr(periodic, 'trig_sum', None)
+    assert periodic.lomb_scargle_multiterm(times, mags, errs, frequency, nterms=[1, 2, 4]) == pytest.approx(power, rel=1e-10, abs=1e-12)
+
+def test_period_files_created(tmp_path):
+    paths = copy_test_files(tmp_path)
+    plot_with_period(paths=paths, filterCode='B')
     for t in TEST_FILES:
-        assert (TEST_PATHS['periods'] / t).exists() == True
-    teardown_function()
-
-def teardown_function():
-    for tf in TEST_FILES:
-        f = TEST_PATHS['periods'] / tf
-        if f.exists():
-            os.remove(f)
+        assert (paths['periods'] / t).exists() == True
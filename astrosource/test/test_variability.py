@@ -0,0 +1,43 @@
+import numpy
+
+from astrosource.variability import variability_indices, pack_rows
+
+
+def test_pack_rows():
+    values = numpy.arange(6.).reshape(2, 3)
+    keep = numpy.array([[False, True, True], [True, False, True]])
+    packed = pack_rows(values, keep)
+    assert (packed[:, 0:2] == [[1, 2], [3, 5]]).all()
+    assert numpy.isnan(packed[:, 2]).all()
+
+def test_variability_indices():
+    rng = numpy.random.default_rng(0)
+    frames = 2000
+    time = numpy.linspace(0, 1, frames)
+    errors = numpy.full((3, frames), 0.01)
+    mags = numpy.vstack([rng.normal(0, 0.01, frames),
+                         0.1 * numpy.sin(2 * numpy.pi * time) + rng.normal(0, 0.01, frames),
+                         numpy.zeros(frames)])
+    keep = numpy.ones(mags.shape, dtype=bool)
+    keep[2, 1:] = False
+    indices = variability_indices(mags, errors, keep)
+
+    # Noise alone
+    assert abs(indices.chi2[0] - 1) < 0.1
+    assert abs(indices.vonNeumann[0] - 2) < 0.2
+    assert abs(indices.stetsonK[0] - numpy.sqrt(2 / numpy.pi)) < 0.05
+    assert abs(indices.stetsonJ[0]) < 0.1
+    assert abs(indices.iqr[0] - 2 * indices.mad[0]) < 0.002
+    # A slow variable
+    assert indices.chi2[1] > 20
+    assert indices.stetsonJ[1] > 2
+    assert indices.vonNeumann[1] < 0.1
+    # Too few measurements
+    assert all(numpy.isnan(index[2]) for index in indices)
+
+    # Measurements that are not kept make no difference
+    keep[0, ::3] = False
+    masked = variability_indices(mags[0:1], errors[0:1], keep[0:1])
+    packed = variability_indices(mags[0:1, keep[0]], errors[0:1, keep[0]])
+    for a, b in zip(masked, packed):
+        assert abs(a[0] - b[0]) < 1e-10
@@ -1,5 +1,7 @@
 from os import getcwd, makedirs, remove
 import shutil
+import hashlib
+import json
 import logging
 
 from numpy import asarray, genfromtxt, load, isnan, delete
@@ -58,16 +60,72 @@ def cleanup(parentPath):
 
     files = ['calibCompsUsed.csv', 'calibStands.csv', 'compsUsed.csv','screenedComps.csv', \
      'starVariability.csv', 'stdComps.csv', 'usedImages.txt', 'LightcurveStats.txt', \
-     'periodEstimates.txt','calibrationErrors.txt']
+     'periodEstimates.txt','calibrationErrors.txt','matchIndex.npz', \
+     'photometryCube.dat','photometryCube.npz']
 
     for fname in files:
         if (parentPath / fname).exists():
             (parentPath / fname).unlink()
 
-    for fname in parentPath.glob("*.npy"):
-        remove(fname)
+    # Remove the photometry files listed in the ingestion manifest, or every .npy file if there is none
+    manifest = load_manifest(parentPath)
+    if manifest:
+        for entry in manifest.values():
+            if entry['output'] and (parentPath / entry['output']).exists():
+                (parentPath / entry['output']).unlink()
+        (parentPath / MANIFEST_FILE).unlink()
+    else:
+        for fname in parentPath.glob("*.npy"):
+            remove(fname)
     return
 
+# The ingestion manifest (ingestManifest.json, next to the photometry files) records the size, modification time
+# and content hash of every input file along with the photometry file made from it, so unchanged inputs are not
+# extracted again and cleanup knows exactly which files were generated.
+MANIFEST_FILE = "ingestManifest.json"
+
+def file_hash(path, blocksize=1048576):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def load_manifest(parentPath):
+    if not (Path(parentPath) / MANIFEST_FILE).exists():
+        return {}
+    with open(Path(parentPath) / MANIFEST_FILE, 'r') as f:
+        return json.load(f)
+
+def save_manifest(parentPath, manifest):
+    with open(Path(parentPath) / MANIFEST_FILE, 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+def manifest_entry(manifest, source, parentPath, **options):
+    '''
+    Return the manifest entry of source if it is unchanged since it was ingested with the same options, else None.
+    A file is unchanged if its size and modification time match, or failing that its content hash.
+    '''
+    entry = manifest.get(str(Path(source).resolve()))
+    if entry is None or entry['options'] != options:
+        return None
+    if entry['output'] and not (Path(parentPath) / entry['output']).exists():
+        return None
+    stat = Path(source).stat()
+    if stat.st_size != entry['size']:
+        return None
+    if stat.st_mtime != entry['mtime']:
+        if file_hash(source) != entry['hash']:
+            return None
+        entry['mtime'] = stat.st_mtime
+    return entry
+
+def update_manifest(manifest, source, output, **options):
+    # output is the name of the photometry file made from source, or None if source gave no usable photometry
+    stat = Path(source).stat()
+    manifest[str(Path(source).resolve())] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': file_hash(source),
+                                            'output': output, 'options': options}
+
 def folder_setup(parentPath=None):
     #create directory structure for output files
     if not parentPath:
@@ -86,12 +144,15 @@ def folder_setup(parentPath=None):
 
     return paths
 
+def used_images(parentPath):
+    # The photometry files listed in usedImages.txt. Files in parentPath are listed by name and files kept elsewhere
+    # (a --cachedir cache) by absolute path, so parentPath / file loads either of them.
+    usedFile = Path(parentPath) / "usedImages.txt"
+    return [line.strip() for line in usedFile.read_text().split('\n') if line.strip()]
+
 def photometry_files_to_array(parentPath):
     # Load in list of used files
-    fileList=[]
-    with open(parentPath / "usedImages.txt", "r") as f:
-      for line in f:
-        fileList.append(line.strip())
+    fileList = used_images(parentPath)
 
     # LOAD Phot FILES INTO LIST
     photFileArray=[]
@@ -0,0 +1,88 @@
+from collections import namedtuple
+import warnings
+
+from numpy import asarray, where, take_along_axis, argsort, isfinite, nan, nansum, nanmedian, nanpercentile, \
+    nanvar, sqrt, sign, absolute, diff, errstate, full, isnan
+
+import logging
+
+logger = logging.getLogger('astrosource')
+
+# Variability indices of many stars at once.
+#
+# The measurements are given as arrays of shape (stars, frames), with the frames in time order and a boolean array of
+# the same shape marking the measurements to use. Each row is packed so its kept measurements come first, still in
+# time order, with nan after them, and every index is then a reduction along the rows, so the cost is much the same
+# for one star or for a whole field.
+#
+# stetsonJ and stetsonK are the Stetson (1996, PASP 108, 851) indices. For J each measurement is paired with the next
+# one in time, the first with the second, the third with the fourth and so on, and an odd one out is left unpaired.
+# iqr is the interquartile range, mad the median absolute deviation from the median, vonNeumann the ratio of the mean
+# square successive difference to the variance (about 2 for noise, small for slow trends) and chi2 the reduced chi
+# squared against the weighted mean magnitude.
+
+VARIABILITY_INDICES = ('stetsonJ', 'stetsonK', 'iqr', 'vonNeumann', 'chi2', 'mad')
+
+VariabilityIndices = namedtuple('VariabilityIndices', VARIABILITY_INDICES)
+
+
+def pack_rows(values, keep):
+    '''
+    Move the kept values of each row to its start, keeping their order, and fill the rest of the row with nan
+    '''
+    order = argsort(~keep, axis=1, kind='stable')
+    return take_along_axis(where(keep, values, nan), order, axis=1)
+
+
+def variability_indices(mags, errors, keep=None):
+    '''
+    Variability indices of each star
+
+    Parameters
+    ----------
+    mags : numpy array
+            Magnitudes, of shape (stars, frames), with the frames in time order
+    errors : numpy array
+            Error of each magnitude
+    keep : numpy array
+            Boolean array of the same shape, True for the measurements to use. All finite measurements are used if
+            not given.
+
+    Returns
+    -------
+    indices : VariabilityIndices
+            Arrays of length stars for each index. A star with fewer than two measurements gets nan.
+    '''
+    mags = asarray(mags, dtype=float)
+    errors = asarray(errors, dtype=float)
+    usable = isfinite(mags) & isfinite(errors) & (errors > 0)
+    keep = usable if keep is None else (asarray(keep, dtype=bool) & usable)
+    count = keep.sum(axis=1)
+    mags = pack_rows(mags, keep)
+    errors = pack_rows(errors, keep)
+
+    with errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        weights = 1 / errors**2
+        weightedMean = nansum(weights * mags, axis=1) / nansum(weights, axis=1)
+        residual = (mags - weightedMean[:,None]) / errors
+        chi2 = nansum(residual**2, axis=1) / (count - 1)
+
+        delta = sqrt(count / (count - 1))[:,None] * residual
+        first = delta[:, 0::2]
+        second = full(first.shape, nan)
+        second[:, 0:delta[:, 1::2].shape[1]] = delta[:, 1::2]
+        p = where(isnan(second), first**2 - 1, first * second)
+        stetsonJ = nansum(sign(p) * sqrt(absolute(p)), axis=1) / ((count + 1) // 2)
+        stetsonK = (nansum(absolute(delta), axis=1) / count) / sqrt(nansum(delta**2, axis=1) / count)
+
+        upper, lower = nanpercentile(mags, [75, 25], axis=1)
+        median = nanmedian(mags, axis=1)
+        mad = nanmedian(absolute(mags - median[:,None]), axis=1)
+        vonNeumann = (nansum(diff(mags, axis=1)**2, axis=1) / (count - 1)) / nanvar(mags, axis=1, ddof=1)
+
+    indices = VariabilityIndices(stetsonJ, stetsonK, upper - lower, vonNeumann, chi2, mad)
+    few = count < 2
+    for index in indices:
+        index[few] = nan
+    return indices